@@ -0,0 +1,61 @@
+"""Measure RecordStore throughput with concurrent writers and readers
+
+Run from the project root with `python -m benchmarks.bench_concurrency`
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks.generate import generate_records
+from record_lib import RecordSortOrder, RecordStore
+
+
+def run(store: RecordStore, records: list, writers: int, readers: int):
+    """Add the records one at a time from writer threads while readers page
+
+    Returns:
+        (records added per second, pages read per second)
+    """
+    done = threading.Event()
+    pages_read = [0] * readers
+
+    def write(writer):
+        for record in records[writer::writers]:
+            store.add(record)
+
+    def read(reader):
+        while not done.is_set():
+            store.page(RecordSortOrder.DATE_OF_BIRTH_ASCENDING, limit=100)
+            pages_read[reader] += 1
+
+    writer_threads = [threading.Thread(target=write, args=(n,)) for n in range(writers)]
+    reader_threads = [threading.Thread(target=read, args=(n,)) for n in range(readers)]
+    start = time.perf_counter()
+    for thread in writer_threads + reader_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    for thread in reader_threads:
+        thread.join()
+    return len(records) / elapsed, sum(pages_read) / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark concurrent access.")
+    parser.add_argument("--preload", type=int, default=100_000)
+    parser.add_argument("--records", type=int, default=20_000)
+    parser.add_argument("--readers", type=int, default=2)
+    args = parser.parse_args()
+
+    records = generate_records(args.preload + args.records)
+    for writers in (1, 2, 4, 8):
+        store = RecordStore(records[: args.preload])
+        added, read = run(store, records[args.preload :], writers, args.readers)
+        assert len(store) == len(records), "records were lost"
+        print(
+            f"{writers} writers: {added:10,.0f} adds/sec "
+            f"{read:10,.0f} pages/sec with {args.readers} readers"
+        )
@@ -0,0 +1,52 @@
+"""Compare record parsing throughput with the strptime based parser
+
+Run from the project root with `python -m benchmarks.bench_parse`
+"""
+
+import argparse
+import time
+from datetime import datetime
+from typing import List
+
+from benchmarks.generate import format_record, generate_records
+from record_lib import Gender, Record, parse_record
+
+
+def strptime_parse_record(line: str, delimiter: str) -> Record:
+    """Parse a record the way update_records originally did"""
+    fields = [field.strip() for field in line.split(delimiter)]
+
+    if len(fields) != 5:
+        raise ValueError(f"record '{line}' does not have 5 fields")
+
+    return Record(
+        last_name=fields[0],
+        first_name=fields[1],
+        gender=Gender(fields[2]),
+        favorite_color=fields[3],
+        date_of_birth=datetime.strptime(fields[4], "%m/%d/%Y").date(),
+    )
+
+
+def records_per_second(parse, lines: List[str], repeat: int) -> float:
+    """Best throughput of parsing all the lines over several runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line, ",")
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark record parsing.")
+    parser.add_argument("--records", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    lines = [format_record(record, ",") for record in generate_records(args.records)]
+    before = records_per_second(strptime_parse_record, lines, args.repeat)
+    after = records_per_second(parse_record, lines, args.repeat)
+    print(f"strptime parser: {before:12,.0f} records/sec")
+    print(f"fast parser:     {after:12,.0f} records/sec ({after / before:.1f}x)")
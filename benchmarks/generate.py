@@ -0,0 +1,125 @@
+"""Generate synthetic record files for benchmarks
+
+Run from the project root with
+    python -m benchmarks.generate DIRECTORY --records 1000000
+to write comma.txt, pipe.txt and space.txt to DIRECTORY for record_cli.
+"""
+
+import argparse
+import itertools
+import os
+import random
+from datetime import date, timedelta
+from typing import List, Tuple
+
+from record_lib import Gender, Record
+
+COLORS = ("red", "orange", "yellow", "green", "blue", "purple", "brown", "black")
+
+FIRST_DAY = date(1940, 1, 1)
+DAYS = 80 * 365
+
+
+def zipf_weights(count: int, skew: float) -> List[float]:
+    """Return cumulative weights where item i is picked about 1/(i+1)^skew often
+
+    A skew of 0 picks every item equally often.
+    """
+    return list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(count)))
+
+
+def generate_records(
+    count: int,
+    seed: int = 0,
+    names: int = 1000,
+    name_skew: float = 0.0,
+    date_skew: float = 0.0,
+) -> List[Record]:
+    """Generate random records
+
+    Args:
+        count: number of records
+        seed: seed of the random number generator
+        names: number of distinct first and last names
+        name_skew: zipf exponent of the name frequencies, 0 for uniform
+        date_skew: fraction of dates of birth that fall in a single popular
+            year rather than being spread over 80 years
+    Returns:
+        the records
+    """
+    rng = random.Random(seed)
+    weights = zipf_weights(names, name_skew)
+    last_names = rng.choices(range(names), cum_weights=weights, k=count)
+    first_names = rng.choices(range(names), cum_weights=weights, k=count)
+    popular_year = rng.randrange(DAYS // 365) * 365
+
+    records = []
+    for last_name, first_name in zip(last_names, first_names):
+        if rng.random() < date_skew:
+            day = popular_year + rng.randrange(365)
+        else:
+            day = rng.randrange(DAYS)
+        records.append(
+            Record(
+                f"Last{last_name}",
+                f"First{first_name}",
+                rng.choice((Gender.MALE, Gender.FEMALE)),
+                rng.choice(COLORS),
+                FIRST_DAY + timedelta(days=day),
+            )
+        )
+    return records
+
+
+def format_record(record: Record, delimiter: str) -> str:
+    """Format a record as a line of a record file"""
+    separator = delimiter if delimiter == " " else f" {delimiter} "
+    return separator.join(
+        (
+            record.last_name,
+            record.first_name,
+            record.gender.value,
+            record.favorite_color,
+            f"{record.date_of_birth:%m/%d/%Y}",
+        )
+    )
+
+
+def write_record_files(directory: str, records: List[Record]) -> Tuple[str, str, str]:
+    """Split records between a comma, pipe and space separated file
+
+    Args:
+        directory: directory to write the files to
+        records: records to write
+    Returns:
+        paths of the comma, pipe and space separated files
+    """
+    paths = []
+    for part, (name, delimiter) in enumerate(
+        (("comma.txt", ","), ("pipe.txt", "|"), ("space.txt", " "))
+    ):
+        path = os.path.join(directory, name)
+        with open(path, "w") as file:
+            for record in records[part::3]:
+                file.write(format_record(record, delimiter) + "\n")
+        paths.append(path)
+    return tuple(paths)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate record files.")
+    parser.add_argument("directory")
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--names", type=int, default=1000)
+    parser.add_argument("--name-skew", type=float, default=0.0)
+    parser.add_argument("--date-skew", type=float, default=0.0)
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    write_record_files(
+        args.directory,
+        generate_records(
+            args.records, args.seed, args.names, args.name_skew, args.date_skew
+        ),
+    )
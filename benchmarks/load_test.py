@@ -0,0 +1,94 @@
+"""Load test a running record server
+
+Start the server to test, for example one of
+    flask run --with-threads --port 5000
+    uvicorn record_asgi:app --port 8000
+then run from the project root
+    python -m benchmarks.load_test --url http://localhost:5000
+and compare the requests per second and latencies of each server.
+"""
+
+import argparse
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+
+from benchmarks.generate import format_record, generate_records
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    """Return the latency below which the given fraction of requests finished"""
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def run(url: str, clients: int, requests: int, write_fraction: float, page: int):
+    """Send requests from concurrent clients each with a kept alive connection
+
+    Returns:
+        (requests per second, sorted latencies in seconds, number of errors)
+    """
+    address = urllib.parse.urlsplit(url)
+    lines = [format_record(record, ",") for record in generate_records(requests)]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client(number):
+        connection = http.client.HTTPConnection(address.hostname, address.port)
+        own_latencies = []
+        own_errors = 0
+        for index in range(number, requests, clients):
+            if index % 100 < write_fraction * 100:
+                method, path = "POST", "/records?return=record"
+                body = json.dumps({"separator": ",", "record": lines[index]})
+                headers = {"Content-Type": "application/json"}
+            else:
+                method, path, body, headers = (
+                    "GET",
+                    f"/records/birthdate?limit={page}",
+                    None,
+                    {},
+                )
+            start = time.perf_counter()
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            own_latencies.append(time.perf_counter() - start)
+            own_errors += response.status >= 400
+        connection.close()
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return requests / elapsed, sorted(latencies), errors[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a record server.")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument(
+        "--write-fraction",
+        type=float,
+        default=0.2,
+        help="fraction of requests that add a record rather than read a page",
+    )
+    parser.add_argument("--page", type=int, default=100, help="records per page read")
+    args = parser.parse_args()
+
+    rate, latencies, errors = run(
+        args.url, args.clients, args.requests, args.write_fraction, args.page
+    )
+    print(f"{rate:,.0f} requests/sec with {args.clients} clients, {errors} errors")
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        print(f"{name}: {percentile(latencies, fraction) * 1000:.1f}ms")
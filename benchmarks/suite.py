@@ -0,0 +1,381 @@
+"""Benchmark parsing, sorting and serving records
+
+Run from the project root with
+    python -m benchmarks.suite --output results.json --baseline benchmarks/baseline.json
+to write the results as json and compare them with a stored baseline. The
+command exits with status 1 if any result is more than --tolerance worse
+than the baseline, by default the tolerance the baseline was written with.
+Refresh the baseline with --output benchmarks/baseline.json
+after a deliberate change, on the machine the baseline is compared on.
+"""
+
+import argparse
+import gc
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from typing import Callable, Dict, List
+
+import record_lib
+from benchmarks.generate import format_record, generate_records, write_record_files
+from record_lib import (
+    RecordSnapshot,
+    RecordSortOrder,
+    RecordStore,
+    RecordTable,
+    parse_table,
+    records_sorted_by_date_of_birth,
+    records_sorted_by_gender_and_last_name,
+    records_sorted_by_last_name_descending,
+    update_records,
+)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# default share of slowdown past which a result counts as a regression, back
+# to back runs on a busy machine differ by up to about 25%
+DEFAULT_TOLERANCE = 0.3
+
+
+def best_time(function: Callable[[], object], repeat: int) -> float:
+    """Return the fastest of several timed calls of function in seconds
+
+    Like timeit, the garbage collector is paused while timing so a collection
+    of objects left over from earlier benchmarks doesn't land in the result.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+
+def result(value: float, unit: str, higher_is_better: bool) -> Dict:
+    """Build the json entry of a single result"""
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    """Return the latency below which the given fraction of calls finished"""
+    latencies = sorted(latencies)
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def bench_library(records: list, repeat: int) -> Dict[str, Dict]:
+    """Measure parsing, sorting and serializing records in process"""
+    results = {}
+    for name, delimiter in (("comma", ","), ("pipe", "|"), ("space", " ")):
+        lines = [format_record(record, delimiter) for record in records]
+        seconds = best_time(lambda: update_records([], lines, delimiter), repeat)
+        results[f"update_records.{name}"] = result(
+            len(lines) / seconds, "records/s", True
+        )
+        seconds = best_time(lambda: parse_table(lines, delimiter), repeat)
+        results[f"parse_table.{name}"] = result(len(lines) / seconds, "records/s", True)
+
+    for function in (
+        records_sorted_by_gender_and_last_name,
+        records_sorted_by_date_of_birth,
+        records_sorted_by_last_name_descending,
+    ):
+        seconds = best_time(lambda: function(records), repeat)
+        results[function.__name__] = result(seconds, "s", False)
+
+    table = RecordTable(records)
+    for order in RecordSortOrder:
+        seconds = best_time(lambda: table.argsort(order), repeat)
+        results[f"RecordTable.argsort.{order.value}"] = result(seconds, "s", False)
+
+    # the snapshots record_shared workers read, written once and read in place
+    file = io.BytesIO()
+    RecordStore(records).snapshot().write_columns(file)
+    snapshot, _ = RecordSnapshot.from_columns(0, file.getvalue())
+    seconds = best_time(lambda: list(snapshot), repeat)
+    results["RecordSnapshot.from_columns.iterate"] = result(
+        len(records) / seconds, "records/s", True
+    )
+    order = RecordSortOrder.DATE_OF_BIRTH_ASCENDING
+    seconds = best_time(lambda: snapshot.page(order, 100, len(records) // 2), repeat)
+    results["RecordSnapshot.from_columns.page"] = result(seconds, "s", False)
+
+    seconds = best_time(lambda: [record.to_dict() for record in records], repeat)
+    results["Record.to_dict"] = result(len(records) / seconds, "records/s", True)
+    return results
+
+
+def bench_cli(records: list, repeat: int) -> Dict[str, Dict]:
+    """Measure record_cli end to end, including starting python
+
+    Each order is measured parsing the files, without the cache, and again
+    loading them from a cache filled beforehand.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_record_files(directory, records)
+        script = os.path.join(PROJECT_ROOT, "record_cli.py")
+        cache = os.path.join(directory, "cache")
+        cases = {"": ["--no-cache"], ".cached": ["--cache-dir", cache]}
+        for suffix, options in cases.items():
+            for order in RecordSortOrder:
+                command = [sys.executable, script, *options, *paths, order.value]
+                run = lambda: subprocess.run(
+                    command, check=True, stdout=subprocess.DEVNULL, cwd=PROJECT_ROOT
+                )
+                # an untimed run fills the cache for the cached runs
+                run()
+                seconds = best_time(run, repeat)
+                results[f"record_cli.{order.value}{suffix}"] = result(
+                    seconds, "s", False
+                )
+    return results
+
+
+def bench_server(records: list, requests: int) -> Dict[str, Dict]:
+    """Measure the latency of record_server endpoints with the flask test client"""
+    import record_server
+
+    record_server.current_records.extend(records)
+    client = record_server.app.test_client()
+    lines = [format_record(record, ",") for record in records]
+
+    calls = {
+        "POST /records": lambda number: client.post(
+            "/records?return=record",
+            json={"separator": ",", "record": lines[number % len(lines)]},
+        ),
+        "GET /records/birthdate page": lambda number: client.get(
+            f"/records/birthdate?limit=100&offset={number * 100 % len(lines)}"
+        ),
+        "GET /records/name cached": lambda number: client.get("/records/name"),
+        "GET /records/query": lambda number: client.get(
+            "/records/query?color=blue&gender=Female"
+        ),
+    }
+
+    results = {}
+    for name, call in calls.items():
+        call(0).get_data()
+        latencies = []
+        for number in range(requests):
+            start = time.perf_counter()
+            response = call(number)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name} failed with {response.status_code}")
+        for label, fraction in (("p50", 0.5), ("p99", 0.99)):
+            results[f"{name} {label}"] = result(
+                percentile(latencies, fraction), "s", False
+            )
+    return results
+
+
+def read_pages(url: str, records: int, seconds: float) -> int:
+    """Read pages of /records/birthdate for some seconds and count them"""
+    address = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(address.hostname, address.port)
+    deadline = time.perf_counter() + seconds
+    pages = 0
+    while time.perf_counter() < deadline:
+        offset = pages * 100 % records
+        connection.request("GET", f"/records/birthdate?limit=100&offset={offset}")
+        response = connection.getresponse()
+        response.read()
+        if response.status >= 400:
+            raise RuntimeError(f"Reading a page failed with {response.status}")
+        pages += 1
+    connection.close()
+    return pages
+
+
+def bench_shared(records: list, workers: int, seconds: float) -> Dict[str, Dict]:
+    """Measure how the pages record_shared serves scale with its workers
+
+    The pages are read for some seconds by one client process per worker,
+    from record_shared with a single worker and with the given number of
+    them. Reads only scale up to the number of cpus, including the ones the
+    clients use.
+    """
+    body = "\n".join(format_record(record, ",") for record in records).encode()
+    env = dict(os.environ, RECORD_SERVER_METRICS="0")
+    env.pop("RECORD_SERVER_DATA_DIR", None)
+    env.pop("RECORD_SERVER_IDENTITY", None)
+
+    results = {}
+    rates = {}
+    for label, count in (("1 worker", 1), ("workers", workers)):
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "record_shared.py",
+                "--workers",
+                str(count),
+                "--port",
+                "0",
+            ],
+            cwd=PROJECT_ROOT,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        try:
+            url = server.stdout.readline().split()[3]
+            address = urllib.parse.urlsplit(url)
+            connection = http.client.HTTPConnection(address.hostname, address.port)
+            connection.request(
+                "POST",
+                "/records/bulk?separator=,",
+                body,
+                {"Content-Type": "text/plain"},
+            )
+            connection.getresponse().read()
+            connection.close()
+
+            with multiprocessing.Pool(workers) as pool:
+                pages = pool.starmap(
+                    read_pages, [(url, len(records), seconds)] * workers
+                )
+        finally:
+            server.terminate()
+            server.wait()
+            server.stdout.close()
+        rates[label] = sum(pages) / seconds
+        results[f"record_shared {label} GET page"] = result(
+            rates[label], "requests/s", True
+        )
+    results["record_shared scaling"] = result(
+        rates["workers"] / rates["1 worker"], "x", True
+    )
+    return results
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Print how each result changed from the baseline
+
+    Returns:
+        names of the results that are more than tolerance worse
+    """
+    regressions = []
+    print(f"{'benchmark':45} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, current in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:45} {'':>12} {current['value']:12.4g} {'new':>8}")
+            continue
+        change = current["value"] / before["value"] - 1
+        # how much worse the result is, whichever direction is better
+        worse = -change if current["higher_is_better"] else change
+        flag = " REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(name)
+        print(
+            f"{name:45} {before['value']:12.4g} {current['value']:12.4g} "
+            f"{change:+8.1%}{flag}"
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--records", type=int, default=100_000)
+    parser.add_argument("--cli-records", type=int, default=20_000)
+    parser.add_argument("--server-records", type=int, default=20_000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--shared-workers",
+        type=int,
+        default=max(2, os.cpu_count() or 1),
+        help="workers record_shared is compared with a single worker at",
+    )
+    parser.add_argument("--shared-seconds", type=float, default=3.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--name-skew", type=float, default=1.0)
+    parser.add_argument("--date-skew", type=float, default=0.2)
+    parser.add_argument("--output", help="file to write the json results to")
+    parser.add_argument("--baseline", help="json results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="share of slowdown that counts as a regression (default: the one "
+        f"the baseline was written with, or {DEFAULT_TOLERANCE})",
+    )
+    parser.add_argument(
+        "--only",
+        choices=("library", "cli", "server", "shared"),
+        action="append",
+        help="only run these groups of benchmarks",
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    if args.tolerance is None:
+        tolerance = None
+        if baseline is not None:
+            tolerance = baseline["metadata"]["arguments"].get("tolerance")
+        args.tolerance = DEFAULT_TOLERANCE if tolerance is None else tolerance
+
+    def records(count):
+        return generate_records(
+            count, args.seed, name_skew=args.name_skew, date_skew=args.date_skew
+        )
+
+    groups = args.only or ("library", "cli", "server", "shared")
+    results = {
+        "metadata": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": record_lib.numpy.__version__ if record_lib.numpy else None,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "arguments": {
+                name: value
+                for name, value in vars(args).items()
+                if name not in ("output", "baseline")
+            },
+        },
+        "results": {},
+    }
+    if "library" in groups:
+        results["results"].update(bench_library(records(args.records), args.repeat))
+    if "cli" in groups:
+        results["results"].update(bench_cli(records(args.cli_records), args.repeat))
+    if "server" in groups:
+        results["results"].update(
+            bench_server(records(args.server_records), args.requests)
+        )
+    if "shared" in groups:
+        results["results"].update(
+            bench_shared(
+                records(args.server_records), args.shared_workers, args.shared_seconds
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+
+    if baseline is not None:
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    elif not args.output:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,283 @@
+import asyncio
+import functools
+import io
+import json
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict
+
+from werkzeug.exceptions import HTTPException, UnsupportedMediaType
+from werkzeug.wrappers import Request, Response
+
+import record_metrics
+import record_server
+from record_lib import RecordSortOrder
+from record_server import (
+    JSON_MIMETYPE,
+    BulkUpload,
+    InvalidUsage,
+    app as flask_app,
+    IDENTITY_MISSING_MESSAGE,
+    create_record,
+    delete_record_response,
+    metrics_response,
+    query_records_response,
+    request_seconds,
+    response_cache,
+    serialize_records,
+    sorted_records_response,
+)
+
+# asyncio entry point serving the same routes as record_server, for example
+# with `uvicorn record_asgi:app`. Requests are read and responses written on
+# the event loop, while parsing, sorting, serializing and writing to the
+# store run on the default executor, so a slow client or a large batch never
+# holds up other requests.
+
+
+class ClientDisconnected(Exception):
+    """Exception for a client that went away before sending its whole body"""
+
+
+async def app(scope: Dict, receive: Callable, send: Callable) -> None:
+    """Handle an ASGI connection"""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        raise ValueError(f"Unsupported scope type {scope['type']}")
+
+    start = time.perf_counter() if record_metrics.enabled else None
+    request = _request(scope)
+    try:
+        methods = ROUTES.get(request.path)
+        if methods is None:
+            raise InvalidUsage("Not found", status_code=404)
+        handler = methods.get(request.method)
+        if handler is None:
+            raise InvalidUsage("Method not allowed", status_code=405)
+        response = await handler(request, receive)
+    except InvalidUsage as error:
+        response = _json_response(error.to_dict(), error.status_code)
+    except HTTPException as error:
+        response = error.get_response()
+    except ClientDisconnected:
+        return
+    await _send_response(response, send)
+    if start is not None:
+        route = request.path if request.path in ROUTES else "other"
+        request_seconds.observe(
+            time.perf_counter() - start,
+            (route, request.method, str(response.status_code)),
+        )
+
+
+async def add_record(request: Request, receive: Callable) -> Response:
+    """Add a new person to the set of records, see record_server.add_record"""
+    content = await _json_body(request, receive)
+    new_record, created = await _run(create_record, content)
+    status = 201 if created else 200
+    if request.args.get("return") == "record":
+        return _json_response(new_record.to_dict(), status)
+    snapshot = record_server.current_records.snapshot()
+    return Response(
+        serialize_records(snapshot, JSON_MIMETYPE, snapshot),
+        status=status,
+        mimetype=JSON_MIMETYPE,
+    )
+
+
+async def put_record(request: Request, receive: Callable) -> Response:
+    """Add a person or replace the record with the same identity
+
+    See record_server.put_record
+    """
+    if record_server.current_records.identity is None:
+        raise InvalidUsage(IDENTITY_MISSING_MESSAGE, status_code=400)
+    content = await _json_body(request, receive)
+    new_record, created = await _run(create_record, content)
+    return _json_response(new_record.to_dict(), 201 if created else 200)
+
+
+async def delete_record(request: Request, receive: Callable) -> Response:
+    """Delete the record with an identity, see record_server.delete_record"""
+    return await _run(delete_record_response, request)
+
+
+async def add_records_in_bulk(request: Request, receive: Callable) -> Response:
+    """Add many records from a single streamed request
+
+    See record_server.add_records_in_bulk. Each chunk of the body is parsed
+    on the executor as soon as it arrives.
+    """
+    upload = BulkUpload(request.mimetype, request.args.get("separator"))
+    async for chunk in _iter_body(receive):
+        await _run(upload.feed, chunk)
+    await _run(upload.feed, b"", True)
+    return _json_response(upload.result(), 201)
+
+
+def sorted_records_route(
+    order: RecordSortOrder,
+) -> Callable[[Request, Callable], Awaitable[Response]]:
+    """Return the handler listing the current records in the given order
+
+    See record_server.sorted_records_response for the query parameters and
+    headers.
+    """
+
+    async def list_records(request: Request, receive: Callable) -> Response:
+        return await _run(sorted_records_response, order, request)
+
+    return list_records
+
+
+async def query_records(request: Request, receive: Callable) -> Response:
+    """Get the current records matching query parameters
+
+    See record_server.query_records_response
+    """
+    return await _run(query_records_response, request)
+
+
+async def get_metrics(request: Request, receive: Callable) -> Response:
+    """Get the metrics in the Prometheus text format, see record_server.get_metrics"""
+    return await _run(metrics_response)
+
+
+async def get_cache_stats(request: Request, receive: Callable) -> Response:
+    """Get the hit and miss counters of the sorted record response cache"""
+    return _json_response(response_cache.stats(), 200)
+
+
+ROUTES = {
+    "/records": {"POST": add_record, "PUT": put_record, "DELETE": delete_record},
+    "/records/bulk": {"POST": add_records_in_bulk},
+    "/records/gender": {
+        "GET": sorted_records_route(RecordSortOrder.GENDER_AND_LAST_NAME_ASCENDING)
+    },
+    "/records/birthdate": {
+        "GET": sorted_records_route(RecordSortOrder.DATE_OF_BIRTH_ASCENDING)
+    },
+    "/records/name": {
+        "GET": sorted_records_route(RecordSortOrder.LAST_NAME_DESCENDING)
+    },
+    "/records/query": {"GET": query_records},
+    "/metrics": {"GET": get_metrics},
+    "/cache/stats": {"GET": get_cache_stats},
+}
+
+
+def _run(function: Callable, *args) -> Awaitable:
+    """Run a blocking function on the default executor"""
+    return asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(function, *args)
+    )
+
+
+def _json_response(value, status_code: int) -> Response:
+    """Build a json response the same way jsonify does in record_server"""
+    response = flask_app.json.response(value)
+    response.status_code = status_code
+    return response
+
+
+async def _json_body(request: Request, receive: Callable):
+    """Receive and decode the json body of a request
+
+    Raises:
+        UnsupportedMediaType: if the body isn't json, with the same response
+            as flask's request.json
+        InvalidUsage: if the body isn't valid json
+    """
+    if not request.is_json:
+        raise UnsupportedMediaType(
+            "Did not attempt to load JSON data because the request Content-Type"
+            " was not 'application/json'."
+        )
+    body = b"".join([chunk async for chunk in _iter_body(receive)])
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise InvalidUsage("Invalid json palyload", status_code=400)
+
+
+def _request(scope: Dict) -> Request:
+    """Build a request without a body from the scope of an http connection
+
+    The request gives handlers the same parsed query parameters and headers
+    as record_server gets from flask.
+    """
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+    }
+    for name, value in scope.get("headers", ()):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = f"HTTP_{key}"
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return Request(environ)
+
+
+async def _iter_body(receive: Callable) -> AsyncIterator[bytes]:
+    """Lazily receive the chunks of a request body
+
+    Raises:
+        ClientDisconnected if the client goes away first
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        if message.get("body"):
+            yield message["body"]
+        if not message.get("more_body", False):
+            return
+
+
+async def _send_response(response: Response, send: Callable) -> None:
+    """Send a response, producing each chunk of a streamed body on the executor"""
+    await send(
+        {
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in response.headers.items()
+            ],
+        }
+    )
+    chunks = iter(response.iter_encoded())
+    try:
+        while True:
+            chunk = await _run(next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+    finally:
+        response.close()
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def _lifespan(receive: Callable, send: Callable) -> None:
+    """Close the record store, flushing any log, when the server shuts down"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await _run(record_server.current_records.close)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from record_lib import RecordSortOrder, RecordTable
+
+# header of a cache file: magic, length of the json key and number of records
+_CACHE_MAGIC = b"RECCACH2"
+_CACHE_HEADER = struct.Struct("<8sIQ")
+
+# widest cell of each column of the cached records
+_WIDTHS = struct.Struct("<5I")
+
+# a cache is valid for the files its key was taken from as long as none of
+# them is moved, resized or modified: [[absolute path, delimiter, size,
+# modification time in ns], ...]
+CacheKey = List[list]
+
+
+class CachedRecords(NamedTuple):
+    """Records of a set of files loaded from their cache
+
+    Attributes:
+        table: records of the files in file order
+        rows: rows of the table in the requested sort order
+        widths: length of the longest cell of each column of a table of the
+            records, in the order of record_cli.HEADERS
+    """
+
+    table: RecordTable
+    rows: array
+    widths: List[int]
+
+
+def default_cache_dir() -> str:
+    """Return the directory record_cli caches parsed records in by default
+
+    This is record_cli in $XDG_CACHE_HOME, or in ~/.cache if it isn't set.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "record_cli")
+
+
+def cache_key(record_files: Iterable[Tuple[str, str]]) -> CacheKey:
+    """Return the key a cache of the records of a set of files is valid for
+
+    Args:
+        record_files: (file name, delimiter) of each file
+    Returns:
+        the key, see CacheKey
+    Raises:
+        OSError: if one of the files doesn't exist
+    """
+    key = []
+    for file_name, delimiter in record_files:
+        stat = os.stat(file_name)
+        key.append(
+            [os.path.abspath(file_name), delimiter, stat.st_size, stat.st_mtime_ns]
+        )
+    return key
+
+
+def cache_path(cache_dir: str, key: CacheKey) -> str:
+    """Return the path of the cache file of a key
+
+    The name only depends on the paths and delimiters of the files, so the
+    cache of files that changed is replaced rather than left behind.
+    """
+    files = json.dumps([[path, delimiter] for path, delimiter, *_ in key])
+    digest = hashlib.sha256(files.encode()).hexdigest()
+    return os.path.join(cache_dir, f"{digest[:32]}.cache")
+
+
+def load_cache(
+    cache_dir: str, key: CacheKey, order: RecordSortOrder
+) -> Optional[CachedRecords]:
+    """Load the cached records of a set of files
+
+    The cache is mapped into memory and only the permutation of the
+    requested order is read, along with the columns of the records.
+
+    Args:
+        cache_dir: directory holding the cache files
+        key: key of the files, from cache_key
+        order: order to read the rows of the records in
+    Returns:
+        the cached records, or None if the files aren't cached, changed
+        since they were cached, or the cache can't be read
+    """
+    try:
+        with open(cache_path(cache_dir, key), "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as buffer:
+            return _read_cache(buffer, key, order)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def _read_cache(
+    buffer: mmap.mmap, key: CacheKey, order: RecordSortOrder
+) -> Optional[CachedRecords]:
+    """Read the records in a cache file if it is valid for key
+
+    Raises:
+        ValueError: if the file is not a whole record cache
+    """
+    magic, key_length, count = _CACHE_HEADER.unpack_from(buffer)
+    if magic != _CACHE_MAGIC:
+        raise ValueError("Not a record cache")
+    position = _CACHE_HEADER.size
+    if json.loads(buffer[position : position + key_length]) != key:
+        return None
+    position += key_length
+    widths = list(_WIDTHS.unpack_from(buffer, position))
+    position += _WIDTHS.size
+
+    orders = list(RecordSortOrder)
+    rows = array("I")
+    start = position + orders.index(order) * rows.itemsize * count
+    rows.frombytes(buffer[start : start + rows.itemsize * count])
+    if sys.byteorder == "big":
+        rows.byteswap()
+    position += len(orders) * rows.itemsize * count
+
+    table, _ = RecordTable.read(buffer, position)
+    if len(rows) != count or len(table) != count:
+        raise ValueError(f"Cache has {len(table)} records rather than {count}")
+    return CachedRecords(table, rows, widths)
+
+
+def write_cache(
+    cache_dir: str,
+    key: CacheKey,
+    table: RecordTable,
+    rows: Dict[RecordSortOrder, array],
+    widths: List[int],
+) -> None:
+    """Atomically replace the cache of a set of files
+
+    Args:
+        cache_dir: directory to write the cache file to, created if it
+            doesn't exist
+        key: key of the files, taken before they were parsed
+        table: records of the files in file order
+        rows: rows of the table sorted in each RecordSortOrder
+        widths: length of the longest cell of each column of the records
+    Raises:
+        OSError: if the cache can't be written
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    encoded_key = json.dumps(key).encode()
+    descriptor, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with open(descriptor, "wb") as file:
+            file.write(_CACHE_HEADER.pack(_CACHE_MAGIC, len(encoded_key), len(table)))
+            file.write(encoded_key)
+            file.write(_WIDTHS.pack(*widths))
+            for order in RecordSortOrder:
+                order_rows = rows[order]
+                if sys.byteorder == "big":
+                    order_rows = array("I", order_rows)
+                    order_rows.byteswap()
+                file.write(order_rows.tobytes())
+            table.write(file)
+        os.replace(temp_path, cache_path(cache_dir, key))
+    except BaseException:
+        os.remove(temp_path)
+        raise
@@ -1,8 +1,54 @@
 import argparse
+import contextlib
+import csv
+import functools
+import itertools
+import json
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import date
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple
 
-import tabulate
+from record_cache import cache_key, default_cache_dir, load_cache, write_cache
+from record_lib import (
+    DEFAULT_CHUNK_SIZE,
+    IDENTITY_FIELDS,
+    Gender,
+    Record,
+    RecordQuery,
+    RecordSortOrder,
+    RecordTable,
+    deduplicated_rows,
+    external_sort,
+    filter_records,
+    filter_records_in_range,
+    identity_getter,
+    iter_records_mapped,
+    iter_records_parallel,
+    parse_date,
+    parse_field_value,
+    range_field,
+    read_table_mapped,
+    records_top_k,
+)
+from record_metrics import NO_PROFILE, Profile
 
-from record_lib import RecordSortOrder, update_records, records_sorted_by_order
+HEADERS = ("Last Name", "First Name", "Gender", "Favorite Color", "Date of Birth")
+
+# formats records can be printed in
+#   table: aligned columns for reading, laid out the same way as tabulate
+#   csv: comma separated values with a header row
+#   ndjson: one json object per line with the keys of Record.to_dict
+OUTPUT_FORMATS = ("table", "csv", "ndjson")
+
+# number of spaces tabulate pads the header of each table column with
+TABLE_PADDING = 2
+
+# number of records formatted before they are written out together
+WRITE_CHUNK_RECORDS = 1000
+
+# default amount of memory to sort records in before spilling them to disk
+DEFAULT_MEMORY_LIMIT = 512 << 20
 
 
 def main(
@@ -10,6 +56,18 @@ def main(
     pipe_separated_file_name: str,
     space_separated_file_name: str,
     sort_order: RecordSortOrder,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    workers: int = 1,
+    use_external_sort: bool = False,
+    memory_limit: int = DEFAULT_MEMORY_LIMIT,
+    top: Optional[int] = None,
+    low=None,
+    high=None,
+    query: Optional[RecordQuery] = None,
+    output_format: str = "table",
+    profile: bool = False,
+    cache_dir: Optional[str] = None,
+    identity: Optional[Sequence[str]] = None,
 ) -> None:
     """Read records from provided files and print them in the desired order
     
@@ -18,36 +76,412 @@ def main(
         pipe_separated_file_name: name of the file with pipe separated records
         space_separated_file_name: name of the file with space separated records
         sort_order: order to print the parsed records in
+        chunk_size: approximate number of bytes to parse from a file at a time
+        workers: number of processes to parse the files with
+        use_external_sort: sort the records on disk and stream them to stdout
+            rather than holding them all in memory
+        memory_limit: approximate number of bytes of records to keep in memory
+            when using the external sort
+        top: only print the first top records, which are found without
+            sorting every record or using the external sort
+        low: only print records whose first sort field is at least low
+        high: only print records whose first sort field is less than high
+        query: only print records matching the query
+        output_format: one of OUTPUT_FORMATS
+        profile: write the time spent parsing, filtering, sorting and writing
+            the records to stderr
+        cache_dir: directory to cache the parsed and sorted records of the
+            files in, so later runs over the same files skip parsing and
+            sorting. Nothing is cached if None or when using the external
+            sort.
+        identity: names of the fields identifying a record, such as
+            IDENTITY_FIELDS, to only print the last of the records with
+            the same identity. The records are held in memory to find the
+            duplicates, even when using the external sort.
+    """
+    record_files = list(
+        zip(
+            (
+                comma_separated_file_name,
+                pipe_separated_file_name,
+                space_separated_file_name,
+            ),
+            (",", "|", " "),
+        )
+    )
+    # time spent in each stage, where a stage that pulls records from another
+    # isn't charged for the time the other takes
+    stages = Profile() if profile else NO_PROFILE
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(workers))
+        records = stages.iterate(
+            "parse", read_records(record_files, chunk_size, executor)
+        )
+        widths = [len(header) + TABLE_PADDING for header in HEADERS]
+        filtered = (
+            query is not None
+            or low is not None
+            or high is not None
+            or identity is not None
+        )
+
+        if cache_dir is not None and not use_external_sort:
+            sorted_records, cell_widths = cached_sorted_records(
+                record_files,
+                functools.partial(
+                    read_table, record_files, chunk_size, executor, stages
+                ),
+                sort_order,
+                cache_dir,
+                stages,
+                identity,
+            )
+            # filtering keeps the records sorted
+            if query is not None:
+                sorted_records = stages.iterate(
+                    "filter", filter_records(sorted_records, query)
+                )
+            if low is not None or high is not None:
+                sorted_records = stages.iterate(
+                    "filter",
+                    filter_records_in_range(sorted_records, sort_order, low, high),
+                )
+            if top is not None:
+                sorted_records = itertools.islice(sorted_records, top)
+            if output_format == "table" and (filtered or top is not None):
+                # the table fits the records that are printed, like without
+                # the cache, so they are measured before any is written
+                sorted_records = iter(
+                    list(
+                        stages.iterate(
+                            "measure", track_column_widths(sorted_records, widths)
+                        )
+                    )
+                )
+            elif output_format == "table":
+                widths[:] = map(max, widths, cell_widths)
+        elif not filtered and top is None and not use_external_sort:
+            # nothing reads the records before they are sorted, so they are
+            # parsed into a table and only built as they are written
+            table = read_table(record_files, chunk_size, executor, stages)
+            if output_format == "table":
+                with stages.stage("measure"):
+                    widths[:] = map(max, widths, table_cell_widths(table))
+            with stages.stage("sort"):
+                rows = table.argsort(sort_order)
+            sorted_records = stages.iterate("sort", table.take(rows))
+        else:
+            if identity is not None:
+                with stages.stage("dedupe"):
+                    table = RecordTable(records)
+                    rows = deduplicated_rows(table.take(range(len(table))), identity)
+                records = stages.iterate("dedupe", table.take(rows))
+            if query is not None:
+                records = stages.iterate("filter", filter_records(records, query))
+            if low is not None or high is not None:
+                records = stages.iterate(
+                    "filter", filter_records_in_range(records, sort_order, low, high)
+                )
+            if output_format == "table" and top is None:
+                records = stages.iterate(
+                    "measure", track_column_widths(records, widths)
+                )
+
+            with stages.stage("sort"):
+                if top is not None:
+                    sorted_records = iter(records_top_k(records, sort_order, top))
+                elif use_external_sort:
+                    sorted_records = external_sort(records, sort_order, memory_limit)
+                else:
+                    sorted_records = RecordTable(records).sorted_by(sort_order)
+            sorted_records = stages.iterate("sort", sorted_records)
+            if output_format == "table" and top is not None:
+                # the table only fits the records that are printed
+                sorted_records = iter(
+                    list(
+                        stages.iterate(
+                            "measure", track_column_widths(sorted_records, widths)
+                        )
+                    )
+                )
+
+            # every record has been read, and so measured, by the time the
+            # first sorted record comes out
+            first_record = next(sorted_records, None)
+            if first_record is not None:
+                sorted_records = itertools.chain([first_record], sorted_records)
+
+        with stages.stage("write"):
+            if output_format == "csv":
+                write_csv(sorted_records, sys.stdout)
+            elif output_format == "ndjson":
+                write_ndjson(sorted_records, sys.stdout)
+            else:
+                write_table(sorted_records, widths, sys.stdout)
+            sys.stdout.flush()
+
+    if profile:
+        stages.write(sys.stderr)
+
+
+def read_records(
+    record_files: Iterable[Tuple[str, str]],
+    chunk_size: int,
+    executor: Optional[Executor] = None,
+) -> Iterator[Record]:
+    """Lazily parse the records in each file
+
+    Args:
+        record_files: (file name, delimiter) of each file to read
+        chunk_size: approximate number of bytes to parse from a file at a time
+        executor: executor to parse the files with, if any
+    Yields:
+        the records of each file in order
+    """
+    for file_name, delimiter in record_files:
+        if executor is None:
+            yield from iter_records_mapped(file_name, delimiter, chunk_size)
+        else:
+            yield from iter_records_parallel(file_name, delimiter, executor, chunk_size)
+
+
+def read_table(
+    record_files: Iterable[Tuple[str, str]],
+    chunk_size: int,
+    executor: Optional[Executor] = None,
+    stages: Profile = NO_PROFILE,
+) -> RecordTable:
+    """Parse the records of each file into a table
+
+    Without an executor the lines are parsed straight into the columns of
+    the table, see read_table_mapped.
+
+    Args:
+        record_files: (file name, delimiter) of each file to read
+        chunk_size: approximate number of bytes to parse from a file at a time
+        executor: executor to parse the files with, if any
+        stages: profile to count the time of parsing towards
+    Returns:
+        the records of each file in order
+    """
+    if executor is not None:
+        records = read_records(record_files, chunk_size, executor)
+        return RecordTable(stages.iterate("parse", records))
+    table = RecordTable()
+    with stages.stage("parse"):
+        for file_name, delimiter in record_files:
+            read_table_mapped(file_name, delimiter, chunk_size, table=table)
+    return table
+
+
+def cached_sorted_records(
+    record_files: Sequence[Tuple[str, str]],
+    parse: Callable[[], RecordTable],
+    sort_order: RecordSortOrder,
+    cache_dir: str,
+    stages: Profile = NO_PROFILE,
+    identity: Optional[Sequence[str]] = None,
+) -> Tuple[Iterator[Record], List[int]]:
+    """Read sorted records from the cache of a set of files
+
+    If the files aren't cached, or changed since they were cached, their
+    records are parsed and sorted in every order, then cached for the next
+    run. A cache that can't be written is reported on stderr and otherwise
+    ignored.
+
+    Args:
+        record_files: (file name, delimiter) of each file
+        parse: parses the records of the files into a table, only called if
+            the files aren't cached
+        sort_order: order to read the records in
+        cache_dir: directory holding the cache files
+        stages: profile to count the time of each stage towards
+        identity: names of the fields identifying a record, to only read the
+            last of the records with the same identity
+    Returns:
+        (records in sorted order, length of the longest cell of each column
+        of a table of all the records)
+    """
+    # taken before parsing, so files that change while they are parsed
+    # invalidate the cache
+    key = cache_key(record_files)
+    with stages.stage("load"):
+        cached = load_cache(cache_dir, key, sort_order)
+
+    if cached is None:
+        table = parse()
+        with stages.stage("measure"):
+            cell_widths = table_cell_widths(table)
+        with stages.stage("sort"):
+            rows = {order: table.argsort(order) for order in RecordSortOrder}
+        with stages.stage("cache"):
+            try:
+                write_cache(cache_dir, key, table, rows, cell_widths)
+            except OSError as e:
+                sys.stderr.write(f"Not caching the parsed records: {e}\n")
+        sorted_rows = rows[sort_order]
+    else:
+        table, sorted_rows, cell_widths = cached
+
+    if identity is not None:
+        with stages.stage("dedupe"):
+            kept = set(deduplicated_rows(table.take(range(len(table))), identity))
+            sorted_rows = [row for row in sorted_rows if row in kept]
+    return stages.iterate("sort", table.take(sorted_rows)), cell_widths
+
+
+def record_cells(record: Record) -> Tuple[str, ...]:
+    """Return the text of each table cell of a record"""
+    return (
+        record.last_name,
+        record.first_name,
+        str(record.gender),
+        record.favorite_color,
+        str(record.date_of_birth),
+    )
+
+
+def track_column_widths(
+    records: Iterable[Record], widths: List[int]
+) -> Iterator[Record]:
+    """Widen widths to fit the cells of each record as it passes through
+
+    Args:
+        records: records to measure
+        widths: width of each column, updated in place
+    Yields:
+        the records unchanged
+    """
+    for record in records:
+        for column, cell in enumerate(record_cells(record)):
+            if len(cell) > widths[column]:
+                widths[column] = len(cell)
+        yield record
+
+
+def table_cell_widths(table: RecordTable) -> List[int]:
+    """Return the length of the longest cell of each column of a RecordTable
+
+    The same widths as track_column_widths, measured from the distinct
+    values of each field rather than from every record.
+    """
+    return [
+        max(map(len, map(str, table.distinct(field))), default=0)
+        for field in Record._fields
+    ]
+
+
+def write_table(records: Iterable[Record], widths: List[int], file: TextIO) -> None:
+    """Write records as a table laid out the same way as tabulate
+
+    Unlike tabulate the records are written as they are read, so the column
+    widths must be known up front, for example from track_column_widths.
+    Every column is left aligned, where tabulate would right align a column
+    in which every cell is a number.
+
+    Args:
+        records: records to write
+        widths: width of each column
+        file: file to write the table to
     """
-    records = []
-    record_files = zip(
+    row = "  ".join(f"{{:<{width}}}" for width in widths).format
+    file.write(row(*HEADERS).rstrip() + "\n")
+    file.write(row(*("-" * width for width in widths)).rstrip() + "\n")
+    _write_chunked(
         (
-            comma_separated_file_name,
-            pipe_separated_file_name,
-            space_separated_file_name,
+            row(
+                record.last_name,
+                record.first_name,
+                record.gender.value,
+                record.favorite_color,
+                record.date_of_birth.isoformat(),
+            ).rstrip()
+            for record in records
         ),
-        (",", "|", " "),
+        file,
     )
-    for file_name, delimiter in record_files:
-        with open(file_name) as file:
-            records = update_records(records, file.readlines(), delimiter)
-
-    sorted_records = records_sorted_by_order(records, sort_order)
-
-    print(
-        tabulate.tabulate(
-            sorted_records,
-            headers=(
-                "Last Name",
-                "First Name",
-                "Gender",
-                "Favorite Color",
-                "Date of Birth",
-            ),
-        )
+
+
+def write_csv(records: Iterable[Record], file: TextIO) -> None:
+    """Write records as comma separated values with a header row
+
+    The columns are the keys of Record.to_dict and dates are written in
+    MM/DD/YYYY format, like in the record files.
+
+    Args:
+        records: records to write
+        file: file to write the values to
+    """
+    writer = csv.writer(file, lineterminator="\n")
+    writer.writerow(Record._fields)
+    writer.writerows(record.to_dict().values() for record in records)
+
+
+def write_ndjson(records: Iterable[Record], file: TextIO) -> None:
+    """Write each record as a json object of its to_dict on its own line
+
+    Args:
+        records: records to write
+        file: file to write the records to
+    """
+    _write_chunked(
+        (json.dumps(record.to_dict(), separators=(",", ":")) for record in records),
+        file,
     )
 
 
+def _write_chunked(lines: Iterable[str], file: TextIO) -> None:
+    """Write lines, joining WRITE_CHUNK_RECORDS of them into each write"""
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, WRITE_CHUNK_RECORDS))
+        if not chunk:
+            return
+        chunk.append("")
+        file.write("\n".join(chunk))
+
+
+def positive_int(value: str) -> int:
+    """Parse a command line argument that must be a positive integer"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+def date_argument(value: str) -> date:
+    """Parse a command line argument that is a date in MM/DD/YYYY format"""
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a MM/DD/YYYY date")
+
+
+def identity_argument(value: str) -> Tuple[str, ...]:
+    """Parse a command line argument that is a comma separated list of fields"""
+    fields = tuple(field.strip() for field in value.split(","))
+    try:
+        identity_getter(fields)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return fields
+
+
+def memory_size(value: str) -> int:
+    """Parse a command line argument that is a number of bytes
+
+    The number may have a K, M or G suffix, for example 512M.
+    """
+    multiplier = 1
+    suffix = value[-1:].upper()
+    if suffix in ("K", "M", "G"):
+        multiplier = 1 << (10 * ("KMG".index(suffix) + 1))
+        value = value[:-1]
+    return positive_int(value) * multiplier
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Sort records.")
     parser.add_argument(
@@ -62,11 +496,133 @@ if __name__ == "__main__":
     parser.add_argument(
         "output_sort_order", type=RecordSortOrder, choices=list(RecordSortOrder)
     )
+    parser.add_argument(
+        "--chunk-size",
+        type=positive_int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="approximate number of bytes to parse from a file at a time, by "
+        "each worker when using --workers",
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=1,
+        help="number of processes to parse the files with",
+    )
+    parser.add_argument(
+        "--external-sort",
+        action="store_true",
+        help="sort records on disk and stream them out, for inputs larger than "
+        "memory",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=memory_size,
+        default=DEFAULT_MEMORY_LIMIT,
+        help="approximate amount of memory to sort records in before spilling "
+        "them to disk when using --external-sort, for example 512M",
+    )
+    parser.add_argument(
+        "--top",
+        type=positive_int,
+        help="only print the first TOP records, without sorting all of them",
+    )
+    parser.add_argument(
+        "--from",
+        dest="low",
+        help="only print records whose first sort field, such as the gender for "
+        "gender_and_last_name_ascending, is at least FROM. Genders and dates are "
+        "written the same way as in the record files",
+    )
+    parser.add_argument(
+        "--to",
+        dest="high",
+        help="only print records whose first sort field is less than TO",
+    )
+    parser.add_argument(
+        "--gender",
+        type=Gender,
+        choices=list(Gender),
+        help="only print records of this gender",
+    )
+    parser.add_argument("--color", help="only print records with this favorite color")
+    parser.add_argument(
+        "--born-after",
+        type=date_argument,
+        help="only print records born after this MM/DD/YYYY date",
+    )
+    parser.add_argument(
+        "--born-before",
+        type=date_argument,
+        help="only print records born before this MM/DD/YYYY date",
+    )
+    parser.add_argument(
+        "--format",
+        dest="output_format",
+        choices=OUTPUT_FORMATS,
+        default="table",
+        help="print the records as an aligned table (default), comma separated "
+        "values or one json object per line",
+    )
+    parser.add_argument(
+        "--dedupe",
+        dest="identity",
+        nargs="?",
+        type=identity_argument,
+        const=IDENTITY_FIELDS,
+        metavar="FIELDS",
+        help="only print the last of the records with the same comma separated "
+        f"FIELDS, {','.join(IDENTITY_FIELDS)} by default",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir(),
+        help="directory to cache the parsed records of the files in, so later "
+        "runs over the same unchanged files skip parsing and sorting them "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache_dir",
+        action="store_const",
+        const=None,
+        help="parse the files without reading or writing the cache",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write the time spent in each stage, such as parsing and sorting, "
+        "to stderr",
+    )
     args = parser.parse_args()
 
+    query = RecordQuery(args.gender, args.color, args.born_after, args.born_before)
+    if query == RecordQuery():
+        query = None
+
+    bounds = []
+    for option, value in (("--from", args.low), ("--to", args.high)):
+        try:
+            if value is not None:
+                value = parse_field_value(range_field(args.output_sort_order), value)
+        except ValueError as e:
+            parser.error(f"argument {option}: {e}")
+        bounds.append(value)
+
     main(
         args.comma_separated_records_file,
         args.pipe_separated_records_file,
         args.space_separated_records_file,
         args.output_sort_order,
+        args.chunk_size,
+        args.workers,
+        args.external_sort,
+        args.memory_limit,
+        args.top,
+        *bounds,
+        query,
+        args.output_format,
+        args.profile,
+        args.cache_dir,
+        args.identity,
     )
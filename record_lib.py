@@ -1,9 +1,46 @@
+import bisect
+import collections
+import contextlib
 import datetime
 import functools
+import gc
+import heapq
+import itertools
+import locale
+import mmap
 import operator
+import os
+import struct
+import sys
+import tempfile
+import threading
+import weakref
+from array import array
+from concurrent.futures import Executor
 from datetime import date, datetime
 from enum import unique, Enum
-from typing import NamedTuple, List
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    List,
+    Optional,
+    Sequence,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+import record_metrics
+from record_metrics import Counter, Histogram
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 @unique
@@ -59,6 +96,173 @@ class RecordSortOrder(Enum):
         return self.value
 
 
+# lookup table from the string value of a gender to the gender, which is
+# cheaper than the Gender(value) enum lookup
+_GENDERS_BY_VALUE = {gender.value: gender for gender in Gender}
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def parse_date(text: str) -> date:
+    """Parse a date in MM/DD/YYYY format
+
+    Dates with exactly two digit months and days are converted directly,
+    which is much faster than strptime. Anything else falls back to strptime
+    so the accepted dates and the error messages are the same. Results are
+    cached since the same birth dates come up over and over.
+
+    Args:
+        text: date to parse
+    Returns:
+        the parsed date
+    Raises:
+        ValueError if the date could not be parsed
+    """
+    if len(text) == 10 and text.isascii() and text[2] == "/" and text[5] == "/":
+        month, day, year = text[:2], text[3:5], text[6:]
+        if month.isdigit() and day.isdigit() and year.isdigit():
+            try:
+                return date(int(year), int(month), int(day))
+            except ValueError:
+                pass
+    return datetime.strptime(text, "%m/%d/%Y").date()
+
+
+class SortField(NamedTuple):
+    """A record field to sort by and the direction to sort it in"""
+
+    name: str
+    descending: bool = False
+
+
+# fields to sort by, most significant first
+SortSpec = Tuple[SortField, ...]
+
+SORT_SPECS = {
+    RecordSortOrder.GENDER_AND_LAST_NAME_ASCENDING: (
+        SortField("gender"),
+        SortField("last_name"),
+    ),
+    RecordSortOrder.DATE_OF_BIRTH_ASCENDING: (SortField("date_of_birth"),),
+    RecordSortOrder.LAST_NAME_DESCENDING: (SortField("last_name", descending=True),),
+}
+
+# position of each gender in sorted order, so sorting by gender compares
+# integers rather than calling Gender.__lt__
+_GENDER_SORT_CODES = {gender: code for code, gender in enumerate(sorted(Gender))}
+
+# the same codes by the value of each gender, which avoids the Python level
+# Enum.__hash__ when looking up the code of a record
+_GENDER_SORT_CODES_BY_VALUE = {
+    gender.value: code for gender, code in _GENDER_SORT_CODES.items()
+}
+
+# functions returning the primitive sort key of each field of a record
+_FIELD_SORT_KEYS = {
+    "last_name": operator.attrgetter("last_name"),
+    "first_name": operator.attrgetter("first_name"),
+    "gender": lambda record: _GENDER_SORT_CODES_BY_VALUE[record.gender._value_],
+    "favorite_color": operator.attrgetter("favorite_color"),
+    "date_of_birth": lambda record: record.date_of_birth.toordinal(),
+}
+
+
+def _inverted_string(value: str) -> Tuple[int, ...]:
+    """Return a key that sorts strings in descending order
+
+    The trailing 1 sorts after every negated character so a string comes
+    after any longer string it is a prefix of.
+    """
+    return (*(-ord(character) for character in value), 1)
+
+
+def _field_key(field: SortField, invert: bool):
+    """Return the key function of a single field, inverted if requested"""
+    key = _FIELD_SORT_KEYS.get(field.name)
+    if key is None:
+        raise ValueError(f"Unknown sort field {field.name}")
+    if not invert:
+        return key
+    if field.name in ("gender", "date_of_birth"):
+        return lambda record: -key(record)
+    return lambda record: _inverted_string(key(record))
+
+
+def sort_key(spec: SortSpec):
+    """Return a key function and reverse flag that sort records by a spec
+
+    Keys are built from primitive values, ints for genders and dates of birth
+    and strings for everything else, so comparing them never calls back into
+    Python code. When every field is descending the keys are ascending and
+    reverse is True. Otherwise descending fields are inverted in the key so
+    mixed directions still take a single stable sort.
+
+    Args:
+        spec: fields to sort by
+    Returns:
+        (key, reverse) to pass to sorted
+    Raises:
+        ValueError: if the spec is empty or has an unknown field
+    """
+    if not spec:
+        raise ValueError("Sort spec has no fields")
+    reverse = all(field.descending for field in spec)
+    keys = [_field_key(field, field.descending and not reverse) for field in spec]
+    if len(keys) == 1:
+        return keys[0], reverse
+    if len(keys) == 2:
+        # the common case gets a key without a loop over the fields
+        first, second = keys
+        return (lambda record: (first(record), second(record))), reverse
+    return (lambda record: tuple([key(record) for key in keys])), reverse
+
+
+# key function and reverse flag for each sort order
+_SORT_KEYS = {order: sort_key(spec) for order, spec in SORT_SPECS.items()}
+
+
+def parse_record(line: str, delimiter: str) -> Record:
+    """Parse a single record
+
+    Args:
+        line: str to parse into a record
+        delimiter: separator between the fields of the record
+    Returns:
+        the parsed record
+    Raises:
+        ValueError if the record could not be parsed
+    """
+    fields = [field.strip() for field in line.split(delimiter)]
+
+    if len(fields) != 5:
+        raise ValueError(f"record '{line}' does not have 5 fields")
+
+    gender = _GENDERS_BY_VALUE.get(fields[2])
+    if gender is None:
+        # raises the same error as any other invalid gender
+        gender = Gender(fields[2])
+    date_of_birth = parse_date(fields[4])
+
+    return Record(
+        last_name=fields[0],
+        first_name=fields[1],
+        gender=gender,
+        favorite_color=fields[3],
+        date_of_birth=date_of_birth,
+    )
+
+
+# metrics of parsing records with update_records or from files, recorded
+# while record_metrics is enabled
+_RECORDS_PARSED = Counter("record_lib_records_parsed_total", "Records parsed")
+_PARSE_ERRORS = Counter(
+    "record_lib_parse_errors_total", "Batches of records that failed to parse"
+)
+_PARSE_SECONDS = Histogram(
+    "record_lib_parse_seconds", "Time taken to parse a batch of records"
+)
+
+
+@record_metrics.timed(_PARSE_SECONDS)
 def update_records(
     current_records: List[Record], new_records: List[str], delimiter: str
 ) -> List[Record]:
@@ -73,77 +277,3122 @@ def update_records(
     Raises:
         ValueError if one of the new records could not be parsed
     """
+    parsed = _parse_line_list(list(new_records), delimiter)
+    if parsed.error is not None:
+        _PARSE_ERRORS.inc()
+        raise ValueError(parsed.error)
+    _RECORDS_PARSED.inc(len(parsed.records))
     combined_records = current_records.copy()
-    for line in new_records:
-        fields = [field.strip() for field in line.split(delimiter)]
+    combined_records.extend(parsed.records)
+    return combined_records
 
-        if len(fields) != 5:
-            raise ValueError(f"record '{line}' does not have 5 fields")
 
-        gender = Gender(fields[2])
-        date_of_birth = datetime.strptime(fields[4], "%m/%d/%Y").date()
+@record_metrics.timed(_PARSE_SECONDS)
+def parse_table(
+    lines: List[str], delimiter: str, table: Optional["RecordTable"] = None
+) -> "RecordTable":
+    """Parse lines of records straight into the columns of a RecordTable
 
-        combined_records.append(
-            Record(
-                last_name=fields[0],
-                first_name=fields[1],
-                gender=gender,
-                favorite_color=fields[3],
-                date_of_birth=date_of_birth,
+    Like _parse_lines each step runs over every line at once, but no Record
+    is built: the strings are dictionary encoded, the genders become codes
+    and the dates of birth day ordinals, all converted together with numpy
+    when it is installed. Records are only built for the rows read from the
+    table, so sorting it and reading the first rows leaves the rest as plain
+    columns.
+
+    Args:
+        lines: lines to parse, one record each
+        delimiter: separator between the fields of a record
+        table: table to add the records to, a new table by default
+    Returns:
+        the table with the parsed records added in line order
+    Raises:
+        ValueError if one of the lines could not be parsed, in which case
+        none of them is added to the table
+    """
+    table = RecordTable() if table is None else table
+    fields = _split_fields(lines, delimiter) if lines else None
+    ordinals = None
+    try:
+        if fields is not None:
+            gender_codes = list(map(_GENDER_CODES_BY_VALUE.get, fields[2::5]))
+            if None not in gender_codes:
+                ordinals = _date_ordinals(fields[4::5])
+        if ordinals is not None:
+            table._extend_columns(
+                fields[0::5], fields[1::5], gender_codes, fields[3::5], ordinals
             )
-        )
-    return combined_records
+        else:
+            # finds the bad line and raises its error
+            table.extend(list(map(parse_record, lines, itertools.repeat(delimiter))))
+    except ValueError:
+        _PARSE_ERRORS.inc()
+        raise
+    _RECORDS_PARSED.inc(len(lines))
+    return table
 
 
-def records_sorted_by_gender_and_last_name(records: List[Record]) -> List[Record]:
-    """Return a list of records sorted by gender and last name
+# day ordinal of the numpy datetime64 epoch
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _date_ordinals(texts: List[str]) -> Optional[array]:
+    """Return the day ordinal of each date in MM/DD/YYYY format
 
-    Args:
-        records: list of records to sort
     Returns:
-        records sorted by gender and last name
+        the ordinals, or None if one of the dates is invalid
     """
-    return sorted(records, key=operator.attrgetter("gender", "last_name"))
+    if numpy is not None:
+        ordinals = _numpy_date_ordinals(texts)
+        if ordinals is not None:
+            return ordinals
+    try:
+        return array("i", map(date.toordinal, map(parse_date, texts)))
+    except ValueError:
+        return None
 
 
-def records_sorted_by_date_of_birth(records: List[Record]) -> List[Record]:
-    """Return a list of records sorted by date of birth
+def _numpy_date_ordinals(texts: List[str]) -> Optional[array]:
+    """Convert dates with two digit months and days together with numpy
 
-    Args:
-        records: list of records to sort
     Returns:
-        records sorted by date of birth
+        the day ordinal of each date, or None if one of them isn't in the
+        fixed format or isn't a valid date, which parse_date then handles
     """
-    return sorted(records, key=operator.attrgetter("date_of_birth"))
+    if not texts or min(map(len, texts)) != 10 or max(map(len, texts)) != 10:
+        return None
+    text = "".join(texts)
+    if not text.isascii():
+        return None
+    characters = numpy.frombuffer(text.encode("ascii"), numpy.uint8).reshape(-1, 10)
+    if not (characters[:, [2, 5]] == ord("/")).all():
+        return None
+    digits = characters[:, [0, 1, 3, 4, 6, 7, 8, 9]].astype(numpy.int64) - ord("0")
+    if ((digits < 0) | (digits > 9)).any():
+        return None
 
+    month = digits[:, 0] * 10 + digits[:, 1]
+    day = digits[:, 2] * 10 + digits[:, 3]
+    year = digits[:, 4:] @ numpy.array([1000, 100, 10, 1])
+    months = (year - 1970) * 12 + month - 1
+    first_day = months.astype("datetime64[M]").astype("datetime64[D]")
+    next_first_day = (months + 1).astype("datetime64[M]").astype("datetime64[D]")
+    days_in_month = (next_first_day - first_day).astype(numpy.int64)
+    if not (
+        (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= days_in_month)
+    ).all():
+        return None
+    ordinals = first_day.astype(numpy.int64) + day - 1 + _EPOCH_ORDINAL
+    return array("i", ordinals.astype(numpy.intc).tobytes())
+
+
+# approximate number of characters read from a file at a time by iter_records
+DEFAULT_CHUNK_SIZE = 1 << 20
 
-def records_sorted_by_last_name_descending(records: List[Record]) -> List[Record]:
-    """Return a list of records sorted by last name descending
+
+def iter_records(
+    file: TextIO, delimiter: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[Record]:
+    """Lazily parse the records in a file
+
+    Lines are read a chunk at a time so only about chunk_size characters of
+    the file are held in memory at once.
 
     Args:
-        records: list of records to sort
+        file: file with one record per line
+        delimiter: separator to use when parsing the records
+        chunk_size: approximate number of characters to read at a time
+    Yields:
+        the parsed records in file order
+    Raises:
+        ValueError if one of the records could not be parsed. The message
+        includes the line number of the record.
+    """
+    line_number = 0
+    while True:
+        lines = file.readlines(chunk_size)
+        if not lines:
+            return
+        parsed = _parse_text("".join(lines), delimiter)
+        yield from parsed.records
+        if parsed.error is not None:
+            raise ValueError(f"line {line_number + parsed.line_count}: {parsed.error}")
+        line_number += parsed.line_count
+
+
+def iter_records_mapped(
+    file_name: str,
+    delimiter: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    encoding: Optional[str] = None,
+) -> Iterator[Record]:
+    """Lazily parse the records in a file mapped into memory
+
+    Each chunk of the file is decoded straight from the mapping, rather
+    than being copied into a read buffer and split into lines first, and
+    is parsed with every line at once. The records are the same as opening
+    the file in text mode and parsing it with iter_records.
+
+    Args:
+        file_name: name of the file with one record per line
+        delimiter: separator to use when parsing the records
+        chunk_size: approximate number of bytes to parse at a time
+        encoding: encoding of the file, which must encode newlines as a
+            single b"\n" like utf-8 does. Defaults to the encoding open uses.
+    Yields:
+        the parsed records in file order
+    Raises:
+        ValueError if one of the records could not be parsed. The message
+        includes the line number of the record.
+    """
+    line_number = 0
+    for text in _mapped_chunks(file_name, chunk_size, encoding):
+        parsed = _parse_text(text, delimiter)
+        yield from parsed.records
+        if parsed.error is not None:
+            raise ValueError(f"line {line_number + parsed.line_count}: {parsed.error}")
+        line_number += parsed.line_count
+
+
+def read_table_mapped(
+    file_name: str,
+    delimiter: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    encoding: Optional[str] = None,
+    table: Optional["RecordTable"] = None,
+) -> "RecordTable":
+    """Parse the records in a file mapped into memory into a RecordTable
+
+    Like iter_records_mapped, but each chunk is parsed straight into the
+    columns of the table with parse_table, so no Record is built.
+
+    Args:
+        file_name: name of the file with one record per line
+        delimiter: separator to use when parsing the records
+        chunk_size: approximate number of bytes to parse at a time
+        encoding: encoding of the file, see iter_records_mapped
+        table: table to add the records to, a new table by default
     Returns:
-        records sorted by last name descending
+        the table with the records of the file added in file order
+    Raises:
+        ValueError if one of the records could not be parsed. The message
+        includes the line number of the record.
     """
-    return sorted(records, key=operator.attrgetter("last_name"), reverse=True)
+    table = RecordTable() if table is None else table
+    line_number = 0
+    for text in _mapped_chunks(file_name, chunk_size, encoding):
+        lines = _split_lines(text)
+        try:
+            parse_table(lines, delimiter, table)
+        except ValueError:
+            # parses the lines one at a time to find the bad one
+            parsed = _parse_lines(text, delimiter)
+            raise ValueError(
+                f"line {line_number + parsed.line_count}: {parsed.error}"
+            ) from None
+        line_number += len(lines)
+    return table
 
 
-def records_sorted_by_order(records: List[Record], order: RecordSortOrder):
-    """Return records sorted by the given order
-    
+def _mapped_chunks(
+    file_name: str, chunk_size: int, encoding: Optional[str]
+) -> Iterator[str]:
+    """Lazily decode a file mapped into memory a chunk of whole lines at a time
+
+    The pages of a chunk are released once the next chunk is requested.
+    """
+    encoding = encoding or locale.getpreferredencoding(False)
+    with _mapped(file_name) as buffer:
+        start = 0
+        while start < len(buffer):
+            end = buffer.find(b"\n", start + chunk_size - 1) + 1 or len(buffer)
+            yield _decode(buffer, start, end, encoding)
+            _release(buffer, start, end)
+            start = end
+
+
+def file_ranges(file_name: str, chunk_size: int) -> Iterator[Tuple[int, int]]:
+    """Split a file into byte ranges that start and end on line boundaries
+
     Args:
-        records: records to sort
-        order: order to sort the records into
+        file_name: name of the file to split
+        chunk_size: approximate number of bytes in each range
+    Yields:
+        (start, end) byte offsets of each range in file order
+    """
+    size = os.path.getsize(file_name)
+    with open(file_name, "rb") as file:
+        start = 0
+        while start < size:
+            # extend the range to the end of the line it would otherwise split
+            file.seek(start + chunk_size)
+            file.readline()
+            end = min(file.tell(), size)
+            yield start, end
+            start = end
+
+
+# the genders in the order their codes are assigned in compact records. Codes
+# follow the declaration order of Gender, which is also its sort order
+_GENDERS = tuple(Gender)
+_GENDER_CODES = {gender: code for code, gender in enumerate(_GENDERS)}
+
+# the same codes by the value of each gender, see _GENDER_SORT_CODES_BY_VALUE
+_GENDER_CODES_BY_VALUE = {gender.value: code for gender, code in _GENDER_CODES.items()}
+_gender_value = operator.attrgetter("_value_")
+
+# translation table from the code of a gender to its sort code
+_GENDER_SORT_CODES_BY_CODE = bytes(
+    _GENDER_SORT_CODES[_GENDERS[code]] if code < len(_GENDERS) else 0
+    for code in range(256)
+)
+
+# a record as plain values that are cheap to send between processes:
+# (last_name, first_name, gender code, favorite_color, date of birth ordinal)
+_CompactRecord = Tuple[str, str, int, str, int]
+
+
+class _ParsedRange(NamedTuple):
+    """Result of parsing a range of lines
+
+    When parsing failed line_count is the line number of the bad record within
+    the range, records are the records before it and error is the message
+    describing what was wrong with it. Worker processes send back compact
+    records.
+    """
+
+    line_count: int
+    records: Union[List[Record], List[_CompactRecord]]
+    error: Optional[str]
+
+
+def _parse_text(text: str, delimiter: str) -> _ParsedRange:
+    """Parse every line of a text into records, see _parse_lines"""
+    with _PARSE_SECONDS.time():
+        parsed = _parse_lines(text, delimiter)
+    _RECORDS_PARSED.inc(len(parsed.records))
+    if parsed.error is not None:
+        _PARSE_ERRORS.inc()
+    return parsed
+
+
+def _parse_lines(text: str, delimiter: str) -> _ParsedRange:
+    """Parse every line of a text into records, see _parse_line_list"""
+    return _parse_line_list(_split_lines(text), delimiter)
+
+
+def _parse_line_list(lines: List[str], delimiter: str) -> _ParsedRange:
+    """Parse lines into records
+
+    Rather than parsing a line at a time, each step runs over every line at
+    once. The fields of all the lines are split and stripped together and
+    each column is converted before the records are zipped together from
+    the columns, so the loops run in C rather than in python. Text that
+    can't be parsed that way, because a line doesn't have 5 fields or has
+    an invalid gender or date, is parsed line by line with parse_record to
+    find the bad line.
+
+    Args:
+        lines: lines to parse
+        delimiter: separator to use when parsing the records
     Returns:
-        sorted records
+        the records and number of lines parsed
+    """
+    fields = _split_fields(lines, delimiter)
+    if fields is not None:
+        genders = list(map(_GENDERS_BY_VALUE.get, fields[2::5]))
+        if None not in genders:
+            try:
+                dates = list(map(parse_date, fields[4::5]))
+            except ValueError:
+                pass
+            else:
+                columns = zip(fields[0::5], fields[1::5], genders, fields[3::5], dates)
+                # how Record._make builds a record, without calling python code
+                with gc_paused():
+                    records = list(
+                        map(tuple.__new__, itertools.repeat(Record), columns)
+                    )
+                return _ParsedRange(len(lines), records, None)
+
+    records = []
+    for line_number, line in enumerate(lines, 1):
+        try:
+            records.append(parse_record(line, delimiter))
+        except ValueError as e:
+            return _ParsedRange(line_number, records, str(e))
+    return _ParsedRange(len(lines), records, None)
+
+
+def _split_lines(text: str) -> List[str]:
+    """Split a text into lines the same way as reading it in text mode"""
+    if "\r" in text:
+        # the same newlines as reading the text from a file in text mode
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    lines = text.split("\n")
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def _split_fields(lines: List[str], delimiter: str) -> Optional[List[str]]:
+    """Split and strip the fields of every line at once
+
+    Returns:
+        the fields of all the lines one after the other, or None if a line
+        doesn't have 5 fields or the delimiter is longer than a character
+    """
+    field_counts = list(map(str.count, lines, itertools.repeat(delimiter)))
+    if len(delimiter) != 1 or field_counts.count(4) != len(lines):
+        return None
+    return list(map(str.strip, delimiter.join(lines).split(delimiter)))
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector
+
+    Building many records at once allocates objects that all outlive the
+    build, and without pausing the collector it repeatedly scans them for
+    cycles there can't be, which can take longer than the build itself.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+@contextlib.contextmanager
+def _mapped(file_name: str) -> Iterator[Union[mmap.mmap, bytes]]:
+    """Map a file into memory read only
+
+    Empty files can't be mapped, so they are read as empty bytes.
+    """
+    with open(file_name, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
+
+
+def _release(buffer, start: int, end: int) -> None:
+    """Drop the pages of a range of a mapped file that has been read
+
+    The pages stay in the operating system's cache of the file, but no
+    longer count towards the memory of the process.
+    """
+    # every byte before end has been parsed, so the page start is on can go
+    start -= start % mmap.PAGESIZE
+    end -= end % mmap.PAGESIZE
+    if isinstance(buffer, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED") and end > start:
+        buffer.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def _decode(buffer, start: int, end: int, encoding: str) -> str:
+    """Decode a range of a buffer without copying it out of the buffer"""
+    with memoryview(buffer) as view, view[start:end] as chunk:
+        return str(chunk, encoding)
+
+
+def _parse_file_range(
+    file_name: str, start: int, end: int, delimiter: str
+) -> _ParsedRange:
+    """Parse the records in a byte range of a file into compact records
+
+    Every worker maps the file, so they all read the same pages of the
+    operating system's cache of the file rather than their own copies.
+    """
+    with _mapped(file_name) as buffer:
+        # decode the same way as opening the file in text mode would
+        text = _decode(buffer, start, end, locale.getpreferredencoding(False))
+    parsed = _parse_text(text, delimiter)
+    return parsed._replace(
+        records=[
+            (
+                record.last_name,
+                record.first_name,
+                _GENDER_CODES[record.gender],
+                record.favorite_color,
+                record.date_of_birth.toordinal(),
+            )
+            for record in parsed.records
+        ]
+    )
+
+
+def iter_records_parallel(
+    file_name: str,
+    delimiter: str,
+    executor: Executor,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[Record]:
+    """Parse the records in a file with a pool of worker processes
+
+    The file is split into byte ranges aligned on line boundaries which are
+    parsed concurrently by the executor. Records are yielded in file order so
+    the result is the same as parsing the file with iter_records.
+
+    Args:
+        file_name: name of the file with one record per line
+        delimiter: separator to use when parsing the records
+        executor: executor to parse the ranges with, usually a
+            ProcessPoolExecutor
+        chunk_size: approximate number of bytes in each range
+    Yields:
+        the parsed records in file order
     Raises:
-        ValueError: if the provided order is unknown
+        ValueError if one of the records could not be parsed. The message
+        includes the line number of the record within the file.
+    """
+    ranges = list(file_ranges(file_name, chunk_size))
+    results = executor.map(
+        _parse_file_range,
+        [file_name] * len(ranges),
+        [start for start, _ in ranges],
+        [end for _, end in ranges],
+        [delimiter] * len(ranges),
+    )
+
+    lines_before = 0
+    for result in results:
+        if result.error is not None:
+            raise ValueError(f"line {lines_before + result.line_count}: {result.error}")
+        lines_before += result.line_count
+        for last_name, first_name, gender, favorite_color, ordinal in result.records:
+            yield Record(
+                last_name,
+                first_name,
+                _GENDERS[gender],
+                favorite_color,
+                date.fromordinal(ordinal),
+            )
+
+
+class _SortedEntries:
+    """Immutable sorted sequence of (sort key, sequence number, record) entries
+
+    Entries are split into blocks of bounded size, so a copy with a few
+    entries inserted or removed only copies the blocks they land in plus a
+    list with one item per block. Everything else is shared with the
+    original, which is never modified once it has been built.
+    """
+
+    # blocks are split in two when they reach twice this size
+    _BLOCK_SIZE = 1024
+
+    def __init__(
+        self, blocks: Optional[List[list]] = None, maxes: Optional[List[tuple]] = None
+    ):
+        """Initialize a sequence from sorted, non empty blocks of entries
+
+        Args:
+            blocks: blocks of entries, which are not copied
+            maxes: (sort key, sequence number) of the last entry of each
+                block, if already known
+        """
+        self._blocks = blocks if blocks is not None else []
+        if maxes is None:
+            maxes = [block[-1][:2] for block in self._blocks]
+        self._maxes = maxes
+        # position of the first entry of each block within the sequence
+        self._starts = list(itertools.accumulate(map(len, self._blocks), initial=0))
+        self._length = self._starts.pop()
+
+    @classmethod
+    def from_sorted(cls, entries: List[tuple]) -> "_SortedEntries":
+        """Build a sequence from a sorted list of entries"""
+        return cls(
+            [
+                entries[start : start + cls._BLOCK_SIZE]
+                for start in range(0, len(entries), cls._BLOCK_SIZE)
+            ]
+        )
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self) -> Iterator[tuple]:
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __reversed__(self) -> Iterator[tuple]:
+        return itertools.chain.from_iterable(
+            reversed(block) for block in reversed(self._blocks)
+        )
+
+    def bisect_left(self, position: tuple) -> int:
+        """Return the index of the first entry at or after a position
+
+        Args:
+            position: (sort key, sequence number) to search for
+        """
+        block = bisect.bisect_left(self._maxes, position)
+        if block == len(self._blocks):
+            return self._length
+        return self._starts[block] + bisect.bisect_left(self._blocks[block], position)
+
+    def slice(self, start: int, stop: int) -> List[tuple]:
+        """Return the entries from index start up to but not including stop"""
+        start = max(start, 0)
+        stop = min(stop, self._length)
+        entries = []
+        block = bisect.bisect_right(self._starts, start) - 1
+        while start < stop:
+            offset = start - self._starts[block]
+            entries.extend(self._blocks[block][offset : offset + stop - start])
+            start = self._starts[block] + len(self._blocks[block])
+            block += 1
+        return entries
+
+    def records(self, start: int, stop: int) -> List[Record]:
+        """Return the records of the entries from index start to stop"""
+        return list(map(operator.itemgetter(2), self.slice(start, stop)))
+
+    def inserted(self, entries: List[tuple]) -> "_SortedEntries":
+        """Return a copy of the sequence with the entries added
+
+        Args:
+            entries: entries to add, with sequence numbers not in the sequence
+        """
+        if not entries:
+            return self
+        if len(entries) >= max(self._BLOCK_SIZE, self._length // 8):
+            # rebuilding is cheaper than bisecting this many entries into place
+            merged = list(self)
+            merged.extend(entries)
+            merged.sort()
+            return self.from_sorted(merged)
+
+        blocks = list(self._blocks)
+        maxes = list(self._maxes)
+        copied = set()
+        for entry in entries:
+            if not blocks:
+                blocks.append([entry])
+                maxes.append(entry[:2])
+                copied.add(0)
+                continue
+
+            block = min(bisect.bisect_left(maxes, entry[:2]), len(blocks) - 1)
+            if block not in copied:
+                blocks[block] = list(blocks[block])
+                copied.add(block)
+            bisect.insort(blocks[block], entry)
+            maxes[block] = blocks[block][-1][:2]
+
+            if len(blocks[block]) >= 2 * self._BLOCK_SIZE:
+                half = blocks[block][self._BLOCK_SIZE :]
+                del blocks[block][self._BLOCK_SIZE :]
+                blocks.insert(block + 1, half)
+                maxes[block : block + 1] = [blocks[block][-1][:2], half[-1][:2]]
+                copied = {index + (index > block) for index in copied}
+                copied.add(block + 1)
+        return _SortedEntries(blocks, maxes)
+
+    def removed(self, entries: List[tuple]) -> "_SortedEntries":
+        """Return a copy of the sequence without the given entries
+
+        Blocks that lose every entry are dropped, while blocks that only
+        shrink are kept as they are rather than merged with a neighbour.
+
+        Args:
+            entries: entries of the sequence to remove, each at most once
+        Raises:
+            ValueError: if one of the entries is not in the sequence
+        """
+        if not entries:
+            return self
+        if len(entries) >= max(self._BLOCK_SIZE, self._length // 8):
+            # filtering every entry is cheaper than bisecting this many
+            positions = {entry[:2] for entry in entries}
+            kept = [entry for entry in self if entry[:2] not in positions]
+            if len(kept) != self._length - len(entries):
+                raise ValueError("Removed entries are not in the sequence")
+            return self.from_sorted(kept)
+
+        blocks = list(self._blocks)
+        maxes = list(self._maxes)
+        copied = set()
+        for entry in entries:
+            position = entry[:2]
+            block = bisect.bisect_left(maxes, position)
+            offset = 0
+            if block < len(blocks):
+                offset = bisect.bisect_left(blocks[block], position)
+            if block == len(blocks) or blocks[block][offset][:2] != position:
+                raise ValueError(f"Entry {position} is not in the sequence")
+
+            if block not in copied:
+                blocks[block] = list(blocks[block])
+                copied.add(block)
+            del blocks[block][offset]
+            if blocks[block]:
+                maxes[block] = blocks[block][-1][:2]
+            else:
+                del blocks[block]
+                del maxes[block]
+                copied = {index - (index > block) for index in copied - {block}}
+        return _SortedEntries(blocks, maxes)
+
+    def difference(self, other: "_SortedEntries") -> List[tuple]:
+        """Return the entries of the sequence that are not in another one
+
+        Blocks the sequences share are skipped without looking at their
+        entries, so comparing sequences copied from one another with
+        inserted and removed costs about as much as the blocks they copied.
+
+        Args:
+            other: sequence to compare with
+        """
+        ours = set(map(id, self._blocks))
+        theirs = set(map(id, other._blocks))
+        positions = {
+            entry[:2]
+            for block in other._blocks
+            if id(block) not in ours
+            for entry in block
+        }
+        return [
+            entry
+            for block in self._blocks
+            if id(block) not in theirs
+            for entry in block
+            if entry[:2] not in positions
+        ]
+
+
+# fields with a hash index in RecordSnapshot, mapping each value of the field
+# to a posting list of the records with that value
+HASH_INDEXED_FIELDS = ("gender", "favorite_color")
+
+_EMPTY_ENTRIES = _SortedEntries()
+
+
+class _EntrySlice:
+    """Lazy view of the entries of a _SortedEntries from index start to stop"""
+
+    def __init__(self, entries: _SortedEntries, start: int, stop: int):
+        self._entries = entries
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self) -> Iterator[tuple]:
+        return iter(self._entries.slice(self._start, self._stop))
+
+
+def _with_postings(
+    postings: Dict[str, Dict[object, _SortedEntries]],
+    entries: Iterable[tuple],
+    removed: Iterable[tuple] = (),
+) -> Dict[str, Dict[object, _SortedEntries]]:
+    """Return a copy of hash index posting lists with entries added and removed
+
+    Only the posting lists of values that gain or lose entries are copied,
+    and those only copy the blocks that change. Values left without entries
+    are dropped.
+
+    Args:
+        postings: posting lists of each field by value
+        entries: (0, sequence number, record) entries to add in sequence order
+        removed: (0, sequence number, record) entries to remove in sequence
+            order
+    """
+    updated = {}
+    for field, by_value in postings.items():
+        value_of = operator.attrgetter(field)
+        by_value = dict(by_value)
+        grouped = collections.defaultdict(list)
+        for entry in removed:
+            grouped[value_of(entry[2])].append(entry)
+        for value, old_entries in grouped.items():
+            by_value[value] = by_value[value].removed(old_entries)
+            if not by_value[value]:
+                del by_value[value]
+
+        grouped = collections.defaultdict(list)
+        for entry in entries:
+            grouped[value_of(entry[2])].append(entry)
+        for value, new_entries in grouped.items():
+            by_value[value] = by_value.get(value, _EMPTY_ENTRIES).inserted(new_entries)
+        updated[field] = by_value
+    return updated
+
+
+# header of the columns of a snapshot, see RecordSnapshot.write_columns:
+# number of records and next sequence number
+_COLUMNS_HEADER = struct.Struct("<QQ")
+_UINT32 = struct.Struct("<I")
+_UINT64 = struct.Struct("<Q")
+_UINT64_PAIR = struct.Struct("<QQ")
+
+# string fields of a record, which are dictionary encoded in the columns
+_STRING_FIELDS = ("last_name", "first_name", "favorite_color")
+
+
+class _EncodedRecord(Record):
+    """Record read from columns along with its encoding, see write_columns"""
+
+    encoding: bytes
+
+
+class _MappedColumns:
+    """Columns of the records of a snapshot in a buffer, see write_columns
+
+    Nothing is copied out of the buffer up front. Records are built from the
+    rows that are read, each time they are read, so reading a page of a
+    large snapshot costs about as much as the records on the page.
+    """
+
+    def __init__(self, buffer, position: int):
+        """Find the columns written by RecordSnapshot.write_columns at position
+
+        Raises:
+            ValueError: if the buffer doesn't hold all of the columns
+        """
+        try:
+            count, self.next_sequence = _COLUMNS_HEADER.unpack_from(buffer, position)
+            position += _COLUMNS_HEADER.size
+            self.count = count
+            self.sequences = position
+            position += 8 * count
+            self.positions = {}
+            for order in RecordSortOrder:
+                self.positions[order] = position
+                position += 4 * count
+            self.genders = position
+            position += count
+            self.dates = position
+            position += 4 * count
+            # (number of distinct strings, offset of their byte offsets, offset
+            # of the utf-8 strings sorted by value, offset of the codes)
+            self.strings = {}
+            for name in _STRING_FIELDS:
+                (distinct,) = _UINT64.unpack_from(buffer, position)
+                offsets = position + _UINT64.size
+                data = offsets + 8 * (distinct + 1)
+                (length,) = _UINT64.unpack_from(buffer, data - 8)
+                self.strings[name] = (distinct, offsets, data, data + length)
+                position = data + length + 4 * count
+            # (offset of where the rows of each code start, offset of the rows
+            # grouped by code)
+            self.postings = {}
+            for field in HASH_INDEXED_FIELDS:
+                values = len(_GENDERS) if field == "gender" else self.strings[field][0]
+                starts = position
+                position = starts + 4 * (values + 1)
+                self.postings[field] = (starts, position)
+                position += 4 * count
+            # (offset of the byte offsets of each encoding, offset of the
+            # encodings), or None if the records were written without them
+            self.encodings = None
+            (encoded,) = _UINT64.unpack_from(buffer, position)
+            position += _UINT64.size
+            if encoded:
+                data = position + 8 * (count + 1)
+                (length,) = _UINT64.unpack_from(buffer, data - 8)
+                self.encodings = (position, data)
+                position = data + length
+        except struct.error:
+            raise ValueError(f"Truncated record columns at offset {position}") from None
+        if position > len(buffer):
+            raise ValueError(f"Truncated record columns at offset {position}")
+        self.end = position
+        self._buffer = buffer
+
+    def uint32(self, offset: int, index: int) -> int:
+        """Return an item of an array of 32 bit unsigned integers"""
+        return _UINT32.unpack_from(self._buffer, offset + 4 * index)[0]
+
+    def rows(self, offset: int, start: int, stop: int) -> array:
+        """Return the items start to stop of an array of row numbers"""
+        return _read_array(self._buffer, "I", offset + 4 * start, stop - start)[0]
+
+    def string(self, name: str, code: int) -> str:
+        """Return the distinct string of a field with a code"""
+        _, offsets, data, _ = self.strings[name]
+        start, end = _UINT64_PAIR.unpack_from(self._buffer, offsets + 8 * code)
+        return str(self._buffer[data + start : data + end], "utf-8")
+
+    def code(self, name: str, value: str) -> Optional[int]:
+        """Return the code of a string, which are numbered in sorted order"""
+        low, high = 0, self.strings[name][0]
+        while low < high:
+            middle = (low + high) // 2
+            if self.string(name, middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.strings[name][0] and self.string(name, low) == value:
+            return low
+        return None
+
+    def gather(
+        self,
+        typecode: str,
+        offset: int,
+        rows: Sequence[int],
+        length: Optional[int] = None,
+    ) -> array:
+        """Return the items at rows of a column of numbers, see _write_array
+
+        Only the items of the rows are read, through a view of the column
+        that is released before returning, so the buffer can be closed once
+        the snapshot is gone. Columns have an item per record unless their
+        length says otherwise.
+        """
+        values = array(typecode)
+        end = offset + values.itemsize * (self.count if length is None else length)
+        with memoryview(self._buffer) as view, view[offset:end] as data:
+            with data.cast(typecode) as column:
+                values.extend(map(column.__getitem__, rows))
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def read(self, rows: Sequence[int]) -> Tuple[List[int], List[Record]]:
+        """Return the sequence number and record of each row"""
+        codes = {
+            name: self.gather("I", self.strings[name][3], rows)
+            for name in _STRING_FIELDS
+        }
+        sequences = self.gather("q", self.sequences, rows)
+        genders = self.gather("B", self.genders, rows)
+        dates = self.gather("i", self.dates, rows)
+
+        strings = []
+        for name in _STRING_FIELDS:
+            values = {code: self.string(name, code) for code in set(codes[name])}
+            strings.append(map(values.__getitem__, codes[name]))
+        last_names, first_names, favorite_colors = strings
+        fields = zip(
+            last_names,
+            first_names,
+            map(_GENDERS.__getitem__, genders),
+            favorite_colors,
+            map(date.fromordinal, dates),
+        )
+        if self.encodings is None:
+            return list(sequences), list(
+                map(tuple.__new__, itertools.repeat(Record), fields)
+            )
+
+        records = list(map(tuple.__new__, itertools.repeat(_EncodedRecord), fields))
+        offsets, data = self.encodings
+        starts = self.gather("Q", offsets, rows, self.count + 1)
+        ends = self.gather("Q", offsets + 8, rows, self.count)
+        with memoryview(self._buffer) as view, view[data:] as encodings:
+            for record, start, end in zip(records, starts, ends):
+                record.encoding = bytes(encodings[start:end])
+        return list(sequences), records
+
+
+class _MappedEntries:
+    """Lazy (sort key, sequence number, record) entries of _MappedColumns
+
+    It reads like a _SortedEntries of the snapshot the columns were written
+    from, and entries are built from their rows whenever they are read.
     """
-    if order == RecordSortOrder.GENDER_AND_LAST_NAME_ASCENDING:
-        return records_sorted_by_gender_and_last_name(records)
-    elif order == RecordSortOrder.DATE_OF_BIRTH_ASCENDING:
-        return records_sorted_by_date_of_birth(records)
-    elif order == RecordSortOrder.LAST_NAME_DESCENDING:
-        return records_sorted_by_last_name_descending(records)
-    else:
-        raise ValueError(f"Unhandled sort order {order}")
+
+    def __init__(
+        self,
+        columns: _MappedColumns,
+        key: Optional[Callable[[Record], object]],
+        descending: bool,
+        rows: Optional[int] = None,
+        start: int = 0,
+        stop: Optional[int] = None,
+    ):
+        """Initialize the entries of an array of rows
+
+        Args:
+            columns: columns the entries are read from
+            key: sort key of the entries, or None for a key of 0
+            descending: whether the sequence numbers are negated
+            rows: offset of the array of rows in entry order, or None for
+                every row in insertion order
+            start: first item of the array of rows
+            stop: item of the array of rows to stop at, by default the last
+        """
+        self._columns = columns
+        self._key = key
+        self._sign = -1 if descending else 1
+        self._rows = rows
+        self._start = start
+        self._stop = columns.count if stop is None else stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self) -> Iterator[tuple]:
+        for start in range(0, len(self), _TAKE_BATCH_ROWS):
+            yield from self.slice(start, start + _TAKE_BATCH_ROWS)
+
+    def __reversed__(self) -> Iterator[tuple]:
+        for stop in range(len(self), 0, -_TAKE_BATCH_ROWS):
+            yield from reversed(self.slice(stop - _TAKE_BATCH_ROWS, stop))
+
+    def bisect_left(self, position: tuple) -> int:
+        """Return the index of the first entry at or after a position"""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.slice(middle, middle + 1)[0][:2] < position:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def slice(self, start: int, stop: int) -> List[tuple]:
+        """Return the entries from index start up to but not including stop"""
+        sequences, records = self._columns.read(self._rows_between(start, stop))
+        if self._key is None:
+            keys = itertools.repeat(0)
+        else:
+            keys = map(self._key, records)
+        if self._sign < 0:
+            sequences = map(operator.neg, sequences)
+        return list(zip(keys, sequences, records))
+
+    def records(self, start: int, stop: int) -> List[Record]:
+        """Return the records of the entries from index start to stop"""
+        return self._columns.read(self._rows_between(start, stop))[1]
+
+    def _rows_between(self, start: int, stop: int) -> Sequence[int]:
+        """Return the rows of the entries from index start to stop"""
+        start = self._start + max(start, 0)
+        stop = self._start + min(stop, len(self))
+        if start >= stop:
+            return ()
+        if self._rows is None:
+            return range(start, stop)
+        return self._columns.rows(self._rows, start, stop)
+
+
+class _MappedPostings:
+    """Posting lists of a hash indexed field of _MappedColumns, by value"""
+
+    def __init__(self, columns: _MappedColumns, field: str):
+        self._columns = columns
+        self._field = field
+
+    def get(self, value, default=None):
+        """Return the (0, sequence number, record) entries of a value"""
+        if self._field == "gender":
+            code = _GENDER_CODES.get(value)
+        else:
+            code = self._columns.code(self._field, value)
+        if code is None:
+            return default
+        starts, rows = self._columns.postings[self._field]
+        start = self._columns.uint32(starts, code)
+        stop = self._columns.uint32(starts, code + 1)
+        if start == stop:
+            return default
+        return _MappedEntries(self._columns, None, False, rows, start, stop)
+
+
+class _OverlayEntries:
+    """Entries of a sorted sequence with some of them removed and others added
+
+    It reads like the _SortedEntries the changes would turn the sequence
+    into, without copying it, see RecordSnapshot.with_changes.
+    """
+
+    def __init__(
+        self,
+        entries,
+        positions: Tuple[Sequence[int], Sequence[int]],
+        added: List[tuple],
+    ):
+        """Initialize the entries of a sequence after some changes
+
+        Args:
+            entries: sequence the changes apply to, like a _SortedEntries
+            positions: (ascending index of each removed entry in entries,
+                index of the entry of entries each added entry goes before)
+            added: sorted entries to add
+        """
+        removed, befores = positions
+        self._entries = entries
+        self._removed = removed
+        self._added = _SortedEntries.from_sorted(added)
+        self._length = len(entries) - len(removed) + len(added)
+        # (entries or added, start, stop) of each run of consecutive entries
+        self._runs = []
+        start = added_start = 0
+        removed_set = set(removed)
+        for position in sorted(removed_set.union(befores, (len(entries),))):
+            if start < position:
+                self._runs.append((entries, start, position))
+            added_stop = bisect.bisect_right(befores, position, added_start)
+            if added_start < added_stop:
+                self._runs.append((self._added, added_start, added_stop))
+                added_start = added_stop
+            start = position + 1 if position in removed_set else position
+        self._starts = list(
+            itertools.accumulate(
+                (stop - start for _, start, stop in self._runs), initial=0
+            )
+        )
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self) -> Iterator[tuple]:
+        for entries, start, stop in self._runs:
+            for batch in range(start, stop, _TAKE_BATCH_ROWS):
+                yield from entries.slice(batch, min(batch + _TAKE_BATCH_ROWS, stop))
+
+    def __reversed__(self) -> Iterator[tuple]:
+        for entries, start, stop in reversed(self._runs):
+            for batch in range(stop, start, -_TAKE_BATCH_ROWS):
+                yield from reversed(
+                    entries.slice(max(batch - _TAKE_BATCH_ROWS, start), batch)
+                )
+
+    def bisect_left(self, position: tuple) -> int:
+        """Return the index of the first entry at or after a position"""
+        index = self._entries.bisect_left(position)
+        removed = bisect.bisect_left(self._removed, index)
+        return index - removed + self._added.bisect_left(position)
+
+    def slice(self, start: int, stop: int) -> List[tuple]:
+        """Return the entries from index start up to but not including stop"""
+        return self._read("slice", start, stop)
+
+    def records(self, start: int, stop: int) -> List[Record]:
+        """Return the records of the entries from index start to stop"""
+        return self._read("records", start, stop)
+
+    def _read(self, method: str, start: int, stop: int) -> list:
+        """Call a method reading from start to stop on each run in the range"""
+        start = max(start, 0)
+        stop = min(stop, self._length)
+        items = []
+        run = bisect.bisect_right(self._starts, start) - 1
+        while start < stop:
+            run_entries, run_start, run_stop = self._runs[run]
+            offset = run_start + start - self._starts[run]
+            read = getattr(run_entries, method)
+            items.extend(read(offset, min(run_stop, offset + stop - start)))
+            start = self._starts[run + 1]
+            run += 1
+        return items
+
+
+class _OverlayPostings:
+    """Posting lists of a hash indexed field by value, with some replaced"""
+
+    def __init__(self, by_value, replaced: Dict[object, _OverlayEntries]):
+        """Initialize the posting lists
+
+        Args:
+            by_value: posting lists by value, such as a _MappedPostings
+            replaced: posting lists replacing those of some values
+        """
+        self._by_value = by_value
+        self._replaced = replaced
+
+    def get(self, value, default=None):
+        """Return the (0, sequence number, record) entries of a value"""
+        entries = self._replaced.get(value)
+        if entries is None:
+            return self._by_value.get(value, default)
+        return entries if entries else default
+
+
+def _change_positions(
+    entries, removed: List[tuple], added: List[tuple]
+) -> Tuple[array, array]:
+    """Return where sorted entries are removed from and added to a sequence
+
+    Returns:
+        (index of each removed entry, index of the entry each added entry
+        goes before), see _OverlayEntries
+    """
+    return (
+        array("I", (entries.bisect_left(entry[:2]) for entry in removed)),
+        array("I", (entries.bisect_left(entry[:2]) for entry in added)),
+    )
+
+
+class SnapshotChanges(NamedTuple):
+    """Changes turning a snapshot into a later one, see RecordSnapshot.changes_since
+
+    Besides the records added, it holds where the records removed and added
+    are in each index of the earlier snapshot, so applying the changes never
+    searches its indexes.
+
+    Attributes:
+        next_sequence: next sequence number of the later snapshot
+        added: (sequence number, record) of each record added, in insertion
+            order
+        encoded: encoding of each record added, if they were passed on
+        records: (index of each removed record, index of the record each
+            added record goes before) in insertion order
+        indexes: the same indexes in the index of each sort order
+        postings: the same indexes in the posting list of each value that
+            changed, of each hash indexed field
+    """
+
+    next_sequence: int
+    added: List[Tuple[int, Record]]
+    encoded: List[bytes]
+    records: Tuple[array, array]
+    indexes: Dict[RecordSortOrder, Tuple[array, array]]
+    postings: Dict[str, Dict[object, Tuple[array, array]]]
+
+
+class _Encodings:
+    """Encodings of the records of the latest snapshot of a store, by record id
+
+    The snapshots of a store share it. Only records of the latest snapshot
+    are added, and records are dropped as soon as a snapshot removes them,
+    so every id belongs to a record the latest snapshot holds alive.
+    """
+
+    def __init__(self, version: Optional[int]):
+        """Initialize the encodings of the snapshot of a version, None for none"""
+        self.version = version
+        self.encoded: Dict[int, bytes] = {}
+        self.lock = threading.Lock()
+
+
+class RecordSnapshot:
+    """Immutable view of the records in a RecordStore at one version
+
+    Reading a snapshot never blocks and is never affected by later changes
+    to the store.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        records: _SortedEntries,
+        indexes: Dict[RecordSortOrder, _SortedEntries],
+        postings: Optional[Dict[str, Dict[object, _SortedEntries]]] = None,
+        next_sequence: Optional[int] = None,
+        encodings: Optional[_Encodings] = None,
+    ):
+        """Initialize a snapshot, see RecordStore for the layout
+
+        next_sequence defaults to one past the newest record, and is passed
+        on once records were removed, since their sequence numbers are
+        never used again.
+        """
+        self.version = version
+        self._records = records
+        if next_sequence is None:
+            next_sequence = next(reversed(records))[1] + 1 if records else 0
+        self._next_sequence = next_sequence
+        self._encodings = encodings or _Encodings(version)
+        self._indexes = indexes
+        if postings is None:
+            postings = _with_postings(
+                {field: {} for field in HASH_INDEXED_FIELDS}, records
+            )
+        self._postings = postings
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[Record]:
+        return (entry[2] for entry in self._records)
+
+    def next_sequence(self) -> int:
+        """Return the sequence number of the next record to be added"""
+        return self._next_sequence
+
+    def sequenced(self) -> Iterator[Tuple[int, Record]]:
+        """Lazily list (sequence number, record) of each record in insertion order"""
+        return (entry[1:] for entry in self._records)
+
+    def write_columns(
+        self, file: BinaryIO, encode: Optional[Callable[[Record], bytes]] = None
+    ) -> None:
+        """Write the records and indexes in the binary format of from_columns
+
+        The records are written as columns: the sequence number, gender code
+        and date of birth ordinal of each record, and a code for each of its
+        strings, numbering the distinct strings of a field in sorted order.
+        Each index is written as the insertion position of its entries, and
+        each hash index as the positions of the records with each code.
+
+        Args:
+            file: binary file to write the columns to
+            encode: function encoding a record, see encoded. The encoding of
+                each record is written along with it, and the snapshot
+                from_columns opens returns it rather than encoding again.
+        """
+        records = list(self)
+        file.write(_COLUMNS_HEADER.pack(len(records), self._next_sequence))
+        sequences = array("q", map(operator.itemgetter(1), self._records))
+        _write_array(file, sequences)
+        if not sequences or sequences[-1] == len(sequences) - 1:
+            # the sequence numbers have no gaps, so they are the positions
+            position_of = None
+        else:
+            position_of = dict(zip(sequences, itertools.count()))
+        for order in RecordSortOrder:
+            entries = map(abs, map(operator.itemgetter(1), self._indexes[order]))
+            if position_of is not None:
+                entries = map(position_of.__getitem__, entries)
+            _write_array(file, array("I", entries))
+
+        genders = map(_gender_value, map(operator.attrgetter("gender"), records))
+        codes = {"gender": bytearray(map(_GENDER_CODES_BY_VALUE.__getitem__, genders))}
+        file.write(codes["gender"])
+        dates = map(date.toordinal, map(operator.attrgetter("date_of_birth"), records))
+        _write_array(file, array("i", dates))
+        distinct = {"gender": len(_GENDERS)}
+        for name in _STRING_FIELDS:
+            column = list(map(operator.attrgetter(name), records))
+            values = sorted(set(column))
+            encoded = [value.encode() for value in values]
+            file.write(_UINT64.pack(len(values)))
+            _write_array(
+                file, array("Q", itertools.accumulate(map(len, encoded), initial=0))
+            )
+            file.write(b"".join(encoded))
+            code_of = dict(zip(values, itertools.count()))
+            codes[name] = array("I", map(code_of.__getitem__, column))
+            distinct[name] = len(values)
+            _write_array(file, codes[name])
+
+        for field in HASH_INDEXED_FIELDS:
+            counts = collections.Counter(codes[field])
+            starts = itertools.accumulate(
+                (counts[code] for code in range(distinct[field])), initial=0
+            )
+            _write_array(file, array("I", starts))
+            rows = sorted(range(len(records)), key=codes[field].__getitem__)
+            _write_array(file, array("I", rows))
+
+        if encode is None:
+            file.write(_UINT64.pack(0))
+            return
+        encodings = [self.encoded(record, encode) for record in records]
+        file.write(_UINT64.pack(len(encodings)))
+        _write_array(
+            file, array("Q", itertools.accumulate(map(len, encodings), initial=0))
+        )
+        file.write(b"".join(encodings))
+
+    @classmethod
+    def from_columns(
+        cls,
+        version: int,
+        buffer,
+        position: int = 0,
+        close: Optional[Callable[[], None]] = None,
+    ) -> Tuple["RecordSnapshot", int]:
+        """Open the snapshot written to a buffer by write_columns
+
+        Nothing is read from the buffer up front, the records a read returns
+        are built from their rows each time, so the buffer can be shared,
+        such as shared memory many processes read. The snapshot can't be
+        updated, and its records aren't kept long enough to be encoded once.
+
+        Args:
+            version: version of the snapshot
+            buffer: buffer holding the columns, which must outlive the snapshot
+            position: offset of the columns in the buffer
+            close: called once nothing reads from the buffer anymore,
+                including the snapshots with_changes makes from this one,
+                such as to close the shared memory holding it
+        Returns:
+            (snapshot, offset just past the columns)
+        Raises:
+            ValueError: if the buffer doesn't hold all of the columns
+        """
+        columns = _MappedColumns(buffer, position)
+        if close is not None:
+            weakref.finalize(columns, close)
+        indexes = {
+            order: _MappedEntries(columns, *_SORT_KEYS[order], columns.positions[order])
+            for order in RecordSortOrder
+        }
+        postings = {
+            field: _MappedPostings(columns, field) for field in HASH_INDEXED_FIELDS
+        }
+        snapshot = cls(
+            version,
+            _MappedEntries(columns, None, False),
+            indexes,
+            postings,
+            columns.next_sequence,
+            # records are built anew on every read, so their ids can't key
+            # their encodings
+            _Encodings(None),
+        )
+        return snapshot, columns.end
+
+    def changes_since(
+        self,
+        base: "RecordSnapshot",
+        limit: Optional[int] = None,
+        encode: Optional[Callable[[Record], bytes]] = None,
+    ) -> Optional[SnapshotChanges]:
+        """Return the changes turning an earlier snapshot of the store into this one
+
+        Snapshots share the parts of their indexes that didn't change, so
+        this costs about as much as the records removed and added since.
+
+        Args:
+            base: snapshot of an earlier version of the same RecordStore
+            limit: most records removed and added to return the changes of
+            encode: function encoding a record, to pass on the encodings of
+                the records added, see write_columns
+        Returns:
+            the changes, or None if more than limit records were removed and
+            added
+        """
+        if limit is not None and abs(len(self) - len(base)) > limit:
+            return None
+        removed = base._records.difference(self._records)
+        added = self._records.difference(base._records)
+        if limit is not None and len(removed) + len(added) > limit:
+            return None
+        indexes = {}
+        for order, index in base._indexes.items():
+            key, descending = _SORT_KEYS[order]
+            changes = [
+                sorted(
+                    (key(record), -sequence if descending else sequence, record)
+                    for _, sequence, record in entries
+                )
+                for entries in (removed, added)
+            ]
+            indexes[order] = _change_positions(index, *changes)
+
+        postings = {}
+        for field, by_value in base._postings.items():
+            value_of = operator.attrgetter(field)
+            grouped = collections.defaultdict(lambda: ([], []))
+            for side, entries in enumerate((removed, added)):
+                for entry in entries:
+                    grouped[value_of(entry[2])][side].append(entry)
+            postings[field] = {
+                value: _change_positions(by_value.get(value, _EMPTY_ENTRIES), *changes)
+                for value, changes in grouped.items()
+            }
+        encoded = []
+        if encode is not None:
+            encoded = [self.encoded(entry[2], encode) for entry in added]
+        return SnapshotChanges(
+            self._next_sequence,
+            [entry[1:] for entry in added],
+            encoded,
+            _change_positions(base._records, removed, added),
+            indexes,
+            postings,
+        )
+
+    def with_changes(self, version: int, changes: SnapshotChanges) -> "RecordSnapshot":
+        """Return a later snapshot from the changes since this one
+
+        Unlike updated, nothing is copied. The later snapshot reads through
+        to this one, skipping the records removed and interleaving the ones
+        added, which suits snapshots read in place, see from_columns.
+
+        Args:
+            version: version of the later snapshot
+            changes: changes since this snapshot, see changes_since
+        """
+        added = [(0, sequence, record) for sequence, record in changes.added]
+        indexes = {}
+        for order, index in self._indexes.items():
+            key, descending = _SORT_KEYS[order]
+            entries = sorted(
+                (key(record), -sequence if descending else sequence, record)
+                for sequence, record in changes.added
+            )
+            indexes[order] = _OverlayEntries(index, changes.indexes[order], entries)
+
+        postings = {}
+        for field, by_value in self._postings.items():
+            value_of = operator.attrgetter(field)
+            grouped = collections.defaultdict(list)
+            for entry in added:
+                grouped[value_of(entry[2])].append(entry)
+            replaced = {
+                value: _OverlayEntries(
+                    by_value.get(value, _EMPTY_ENTRIES), positions, grouped[value]
+                )
+                for value, positions in changes.postings[field].items()
+            }
+            postings[field] = _OverlayPostings(by_value, replaced)
+
+        # the records added are kept by the snapshot, unlike the ones read
+        # from columns, so their ids can key their encodings
+        encodings = _Encodings(None)
+        encodings.encoded = {
+            id(record): encoded
+            for (_, record), encoded in zip(changes.added, changes.encoded)
+        }
+        return RecordSnapshot(
+            version,
+            _OverlayEntries(self._records, changes.records, added),
+            indexes,
+            postings,
+            changes.next_sequence,
+            encodings,
+        )
+
+    def encoded(self, record: Record, encode: Callable[[Record], bytes]) -> bytes:
+        """Return the encoding of one of the records, such as its json
+
+        Records are encoded the first time they are read from the latest
+        snapshot and keep their encoding for as long as they are in the
+        store, so a store is only ever read with one encode function.
+        Records read from columns written with their encodings return them,
+        see write_columns.
+
+        Args:
+            record: record of the snapshot
+            encode: function encoding a record
+        """
+        encodings = self._encodings
+        encoded = encodings.encoded.get(id(record))
+        if encoded is None:
+            if type(record) is _EncodedRecord:
+                return record.encoding
+            encoded = encode(record)
+            with encodings.lock:
+                if encodings.version == self.version:
+                    encodings.encoded[id(record)] = encoded
+        return encoded
+
+    def inserted(self, records: List[Record]) -> "RecordSnapshot":
+        """Return the snapshot of the next version with records added
+
+        Args:
+            records: records to add, in insertion order
+        """
+        sequences = itertools.count(self.next_sequence())
+        return self.updated([], list(zip(sequences, records)))
+
+    def updated(
+        self,
+        removed: List[Tuple[int, Record]],
+        added: List[Tuple[int, Record]],
+    ) -> "RecordSnapshot":
+        """Return the snapshot of the next version with records removed and added
+
+        Args:
+            removed: (sequence number, record) of each record to remove
+            added: (sequence number, record) of each record to add, in
+                insertion order and numbered from next_sequence
+        Raises:
+            ValueError: if one of the removed records is not in the snapshot
+        """
+        indexes = {}
+        for order, index in self._indexes.items():
+            key, descending = _SORT_KEYS[order]
+            changes = []
+            for pairs in (removed, added):
+                entries = [
+                    (key(record), -sequence if descending else sequence, record)
+                    for sequence, record in pairs
+                ]
+                entries.sort()
+                changes.append(entries)
+            indexes[order] = index.removed(changes[0]).inserted(changes[1])
+
+        removed_entries = sorted((0, sequence, record) for sequence, record in removed)
+        entries = [(0, sequence, record) for sequence, record in added]
+        records = self._records.removed(removed_entries).inserted(entries)
+
+        # the next snapshot takes over the encodings, unless another snapshot
+        # of the next version already took them over
+        encodings = self._encodings
+        with encodings.lock:
+            if encodings.version == self.version:
+                for _, record in removed:
+                    encodings.encoded.pop(id(record), None)
+                encodings.version = self.version + 1
+            else:
+                encodings = None
+        return RecordSnapshot(
+            self.version + 1,
+            records,
+            indexes,
+            _with_postings(self._postings, entries, removed_entries),
+            added[-1][0] + 1 if added else self._next_sequence,
+            encodings,
+        )
+
+    def replayed(
+        self, batches: Iterable[Tuple[List[Record], List[Record]]]
+    ) -> "RecordSnapshot":
+        """Return the snapshot with logged batches of changes applied in order
+
+        Records are removed by value, the earliest added one first if the
+        snapshot holds equal records, so replaying doesn't depend on the
+        identity of the store that made the changes.
+
+        Args:
+            batches: (records removed, records added) of each batch
+        Raises:
+            ValueError: if a batch removes a record that isn't in the snapshot
+        """
+        sequences = itertools.count(self.next_sequence())
+        # sequence numbers of the current records with each value, which are
+        # only looked up once there is a record to remove
+        by_value = None
+        removed = []
+        added = {}
+        for removed_records, added_records in batches:
+            if removed_records and by_value is None:
+                by_value = collections.defaultdict(collections.deque)
+                for sequence, record in self.sequenced():
+                    by_value[record].append(sequence)
+                for sequence, record in added.items():
+                    by_value[record].append(sequence)
+            for record in removed_records:
+                if not by_value.get(record):
+                    raise ValueError(f"Can't remove {record}, it is not a record")
+                sequence = by_value[record].popleft()
+                if added.pop(sequence, None) is None:
+                    removed.append((sequence, record))
+            for record in added_records:
+                sequence = next(sequences)
+                added[sequence] = record
+                if by_value is not None:
+                    by_value[record].append(sequence)
+        if not removed and not added:
+            return self
+        return self.updated(removed, list(added.items()))
+
+    @classmethod
+    def restored(
+        cls,
+        version: int,
+        records: List[Record],
+        positions: Dict[RecordSortOrder, Iterable[int]],
+        sequences: Optional[Sequence[int]] = None,
+        next_sequence: Optional[int] = None,
+    ) -> "RecordSnapshot":
+        """Rebuild a snapshot from the output of positions without sorting
+
+        Args:
+            version: version of the snapshot
+            records: records in insertion order
+            positions: positions of the records in each sort order, as
+                returned by positions
+            sequences: increasing sequence number of each record, as listed
+                by sequenced, or None to number the records from 0
+            next_sequence: next_sequence of the snapshot, or None for one
+                past the last record
+        """
+        if sequences is None:
+            sequences = range(len(records))
+        indexes = {}
+        for order in RecordSortOrder:
+            key, descending = _SORT_KEYS[order]
+            keys = list(map(key, records))
+            sign = -1 if descending else 1
+            indexes[order] = _SortedEntries.from_sorted(
+                [
+                    (keys[position], sign * sequences[position], records[position])
+                    for position in positions[order]
+                ]
+            )
+        return cls(
+            version,
+            _SortedEntries.from_sorted(
+                list(zip(itertools.repeat(0), sequences, records))
+            ),
+            indexes,
+            next_sequence=next_sequence,
+        )
+
+    def positions(self, order: RecordSortOrder) -> array:
+        """Return the insertion position of each record in an index
+
+        The positions are in the order the index holds its entries, which is
+        the reverse of the sort order for descending orders.
+
+        Args:
+            order: order of the index
+        Raises:
+            ValueError: if the provided order is unknown
+        """
+        index = self._indexes.get(order)
+        if index is None:
+            raise ValueError(f"Unhandled sort order {order}")
+        position_of = {
+            entry[1]: position for position, entry in enumerate(self._records)
+        }
+        return array("I", (position_of[abs(entry[1])] for entry in index))
+
+    def sorted_by(self, order: RecordSortOrder) -> List[Record]:
+        """Return the records sorted by the given order
+
+        Args:
+            order: order to sort the records into
+        Returns:
+            sorted records
+        Raises:
+            ValueError: if the provided order is unknown
+        """
+        index = self._indexes.get(order)
+        if index is None:
+            raise ValueError(f"Unhandled sort order {order}")
+
+        records = index.records(0, len(index))
+        return records[::-1] if _SORT_KEYS[order][1] else records
+
+    def count(self, order: RecordSortOrder, low=None, high=None) -> int:
+        """Return the number of records in a range of an order in O(log n)
+
+        Args:
+            order: order whose range_field is compared with the bounds
+            low: smallest value to count, unbounded if None
+            high: value to count up to but not including, unbounded if None
+        Raises:
+            ValueError: if the provided order is unknown
+        """
+        index = self._indexes.get(order)
+        if index is None:
+            raise ValueError(f"Unhandled sort order {order}")
+        start, end = 0, len(index)
+        if low is not None:
+            start = index.bisect_left(_range_position(order, low))
+        if high is not None:
+            end = index.bisect_left(_range_position(order, high))
+        return max(end - start, 0)
+
+    def plan(self, query: "RecordQuery") -> Tuple[Optional[str], int]:
+        """Choose the index a query reads its candidate records from
+
+        Every index the query can use is sized up in O(log n) and the most
+        selective one, the one with the fewest records, is chosen.
+
+        Args:
+            query: query to plan
+        Returns:
+            (name of the field whose index is read, number of records read),
+            where the name is None if the query has no conditions and every
+            record is read
+        """
+        return min(
+            ((field, len(entries)) for field, entries in self._candidates(query)),
+            key=operator.itemgetter(1),
+            default=(None, len(self._records)),
+        )
+
+    def _candidates(self, query: "RecordQuery") -> Iterator[Tuple[str, Sequence]]:
+        """Lazily list the entries each usable index has for a query
+
+        The entries are a _SortedEntries or a lazy slice of one, so listing
+        them costs O(log n) until they are read.
+        """
+        for field in HASH_INDEXED_FIELDS:
+            value = getattr(query, field)
+            if value is not None:
+                yield field, self._postings[field].get(value, _EMPTY_ENTRIES)
+
+        if query.born_after is not None or query.born_before is not None:
+            index = self._indexes[RecordSortOrder.DATE_OF_BIRTH_ASCENDING]
+            start, end = 0, len(index)
+            # the index is keyed by day ordinal and both bounds are exclusive
+            if query.born_after is not None:
+                start = index.bisect_left((query.born_after.toordinal() + 1,))
+            if query.born_before is not None:
+                end = index.bisect_left((query.born_before.toordinal(),))
+            yield "date_of_birth", _EntrySlice(index, start, max(start, end))
+
+    def query(self, query: "RecordQuery") -> List[Record]:
+        """Return the records matching a query in insertion order
+
+        The candidates are read from the most selective index, see plan, and
+        intersected with the other conditions by checking each candidate, so
+        the cost is proportional to the smallest index rather than to the
+        number of records.
+
+        Args:
+            query: conditions the records must match
+        Returns:
+            matching records in the order they were added
+        """
+        field, _ = self.plan(query)
+        if field is None:
+            return list(self)
+        entries = dict(self._candidates(query))[field]
+        matches = [entry for entry in entries if query.matches(entry[2])]
+        if field == "date_of_birth":
+            # date index entries are in date order rather than insertion order
+            matches.sort(key=operator.itemgetter(1))
+        return [entry[2] for entry in matches]
+
+    def page(
+        self,
+        order: RecordSortOrder,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        cursor: Optional[Tuple] = None,
+        low=None,
+        high=None,
+    ) -> Tuple[List[Record], Optional[Tuple]]:
+        """Return a page of the records sorted by the given order
+
+        Finding where a page starts takes O(log n), so reading a page costs
+        about as much as the records on it.
+
+        Args:
+            order: order to sort the records into
+            limit: maximum number of records to return, all of them if None
+            offset: number of records to skip
+            cursor: cursor returned with a previous page to continue after it.
+                The offset is counted from the cursor.
+            low: only return records whose range_field is at least low
+            high: only return records whose range_field is less than high
+        Returns:
+            (records, cursor) where cursor continues after the last returned
+            record, or is None if there are no records after the page
+        Raises:
+            ValueError: if the provided order is unknown or the cursor is not
+                a cursor for this order
+        """
+        index = self._indexes.get(order)
+        if index is None:
+            raise ValueError(f"Unhandled sort order {order}")
+        descending = _SORT_KEYS[order][1]
+
+        # positions of the index that are left to read, which are read from
+        # the end when the order is descending
+        start, end = 0, len(index)
+        if low is not None:
+            start = index.bisect_left(_range_position(order, low))
+        if high is not None:
+            end = index.bisect_left(_range_position(order, high))
+        if cursor is not None:
+            try:
+                key, sequence = cursor
+                if descending:
+                    end = min(end, index.bisect_left((key, sequence)))
+                else:
+                    start = max(start, index.bisect_left((key, sequence + 1)))
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid cursor for sort order {order}") from None
+
+        # the cursor is the position of the entry read last
+        if descending:
+            end -= offset
+            page_start = end - limit if limit is not None else start
+            records = index.records(max(start, page_start), end)[::-1]
+            has_more = page_start > start
+            last = max(start, page_start)
+        else:
+            start += offset
+            page_end = start + limit if limit is not None else end
+            records = index.records(start, min(page_end, end))
+            has_more = page_end < end
+            last = min(page_end, end) - 1
+
+        next_cursor = None
+        if records and has_more:
+            next_cursor = index.slice(last, last + 1)[0][:2]
+        return records, next_cursor
+
+
+# functions returning the primitive sort key of a value of each field, for
+# fields whose key is not the value itself
+_FIELD_VALUE_SORT_KEYS = {
+    "gender": _GENDER_SORT_CODES.__getitem__,
+    "date_of_birth": date.toordinal,
+}
+
+
+def _range_position(order: RecordSortOrder, value) -> tuple:
+    """Return the index position before every entry with a range_field of value
+
+    The range field is the first field of each index key and is never
+    inverted, as no order mixes directions with a descending first field.
+    """
+    spec = SORT_SPECS[order]
+    key = _FIELD_VALUE_SORT_KEYS.get(spec[0].name, lambda value: value)(value)
+    # a key prefix sorts before every key that starts with it
+    return ((key,),) if len(spec) > 1 else (key,)
+
+
+# fields that identify a record by default when deduplicating records
+IDENTITY_FIELDS = ("last_name", "first_name", "date_of_birth")
+
+
+def identity_getter(fields: Sequence[str]) -> Callable[[Record], tuple]:
+    """Return a function returning the identity of a record
+
+    The identity of a record is the tuple of the values of some of its
+    fields, and records with the same identity are the same person.
+
+    Args:
+        fields: names of the fields making up the identity
+    Raises:
+        ValueError: if there are no fields or one is not a field of Record
+    """
+    if not fields:
+        raise ValueError("An identity needs at least one field")
+    for field in fields:
+        if field not in Record._fields:
+            raise ValueError(f"Unknown record field {field}")
+    if len(fields) == 1:
+        value_of = operator.attrgetter(fields[0])
+        return lambda record: (value_of(record),)
+    return operator.attrgetter(*fields)
+
+
+def deduplicated_rows(
+    records: Iterable[Record], identity: Sequence[str] = IDENTITY_FIELDS
+) -> List[int]:
+    """Return the positions of the records left after removing duplicates
+
+    Of the records that share an identity only the last one is kept, which
+    leaves the same records in the same order as adding them all to a
+    RecordStore with that identity.
+
+    Args:
+        records: records to deduplicate
+        identity: names of the fields identifying a record
+    Returns:
+        positions of the kept records in ascending order
+    Raises:
+        ValueError: if the identity has an unknown field
+    """
+    identity_of = identity_getter(identity)
+    latest = {}
+    for position, record in enumerate(records):
+        key = identity_of(record)
+        latest.pop(key, None)
+        latest[key] = position
+    return list(latest.values())
+
+
+class _Change(NamedTuple):
+    """Change to a RecordStore queued by a writer
+
+    Attributes:
+        records: records to add, or upsert if the store has an identity
+        deleted: identities of the records to delete
+        results: filled in when the change is applied with the record each
+            upserted record replaced and each deleted record, or None
+        errors: filled in with the exception applying the change raised, if
+            it failed, such as when the log couldn't be written
+    """
+
+    records: List[Record]
+    deleted: List[tuple]
+    results: List[Optional[Record]]
+    errors: List[BaseException]
+
+
+class RecordStore:
+    """Records in insertion order along with an index for each sort order
+
+    Adding a record bisects it into the index of every RecordSortOrder, so
+    sorted views of the records can be read without sorting them again.
+
+    Each index holds (sort key, sequence number, record) entries in ascending
+    order, so the key of a record is only computed once, when it is added.
+    Descending orders negate the sequence number and are read in reverse,
+    which keeps records with equal keys in insertion order just like
+    sorted(..., reverse=True) does. The records in insertion order are kept
+    the same way with a constant key.
+
+    The store is safe to use from many threads. Its contents are published
+    as immutable RecordSnapshots, so reads never wait for writes. Writers
+    queue their records and whichever writer holds the lock applies every
+    queued batch at once, copying only the parts of the indexes that change.
+
+    A store can have an identity, the fields that tell whether two records
+    are the same person, backed by a hash index from each identity to its
+    record. Adding a record then upserts it: a record with a new identity is
+    added, one equal to the current record with its identity changes
+    nothing, and any other replaces the current record, which moves it to
+    the end of the insertion order. Records can also be deleted by identity.
+
+    Changes can be made durable with a log, an object with an
+    append(records, snapshot, removed) method such as record_log.RecordLog.
+    It is called with the records each batch adds and removes and the
+    snapshot that includes it before the snapshot is published, so a batch
+    the log fails to write is never seen, and every writer with a change in
+    it gets the log's exception.
+    """
+
+    def __init__(
+        self,
+        records: Iterable[Record] = (),
+        log=None,
+        identity: Optional[Sequence[str]] = None,
+    ):
+        """Initialize a store holding the given records
+
+        Args:
+            records: records to start with, which are passed to the log
+            log: log to append every change to, if any
+            identity: names of the fields identifying a record, such as
+                IDENTITY_FIELDS, if records should be deduplicated
+        Raises:
+            ValueError: if the identity has an unknown field
+        """
+        self._snapshot = RecordSnapshot(
+            0,
+            _SortedEntries(),
+            {order: _SortedEntries() for order in RecordSortOrder},
+        )
+        self._log = log
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self.identity = tuple(identity) if identity else None
+        self._identity_of = identity_getter(identity) if identity else None
+        # (sequence number, record) of the current record with each identity
+        self._identities: Dict[tuple, Tuple[int, Record]] = {}
+        self.extend(records)
+
+    @classmethod
+    def from_snapshot(
+        cls,
+        snapshot: RecordSnapshot,
+        log=None,
+        identity: Optional[Sequence[str]] = None,
+    ) -> "RecordStore":
+        """Initialize a store holding the records of a snapshot
+
+        If the snapshot has records that share an identity, which it can only
+        have from before the store had one, all but the last added of them
+        are removed, and the removal is passed to the log.
+
+        Args:
+            snapshot: snapshot to start from, which is not passed to the log
+            log: log to append every later change to, if any
+            identity: names of the fields identifying a record, if any
+        Raises:
+            ValueError: if the identity has an unknown field
+        """
+        store = cls(log=log, identity=identity)
+        store._snapshot = snapshot
+        if store._identity_of is not None:
+            duplicates = []
+            for sequence, record in snapshot.sequenced():
+                key = store._identity_of(record)
+                if key in store._identities:
+                    duplicates.append(store._identities[key])
+                store._identities[key] = (sequence, record)
+            if duplicates:
+                with store._lock:
+                    store._publish(duplicates, [])
+        return store
+
+    def snapshot(self) -> RecordSnapshot:
+        """Return an immutable view of the current records"""
+        return self._snapshot
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __iter__(self) -> Iterator[Record]:
+        return iter(self._snapshot)
+
+    @property
+    def version(self) -> int:
+        """Number that changes every time the records in the store change"""
+        return self._snapshot.version
+
+    def add(self, record: Record) -> None:
+        """Add a single record to the store
+
+        Args:
+            record: record to add, which is upserted if the store has an
+                identity
+        """
+        self.extend((record,))
+
+    def extend(self, records: Iterable[Record]) -> None:
+        """Add records to the store
+
+        The records are visible to readers by the time this returns.
+
+        Args:
+            records: records to add, in insertion order. They are upserted
+                one after the other if the store has an identity.
+        """
+        records = list(records)
+        if records:
+            self._commit(_Change(records, [], [], []))
+
+    def put(self, record: Record) -> Optional[Record]:
+        """Upsert a record by its identity
+
+        Args:
+            record: record to add, or to replace the record with its identity
+        Returns:
+            the record it replaced, which is the same as record if nothing
+            changed, or None if it was added
+        Raises:
+            ValueError: if the store has no identity
+        """
+        return self.upsert((record,))[0]
+
+    def upsert(self, records: Iterable[Record]) -> List[Optional[Record]]:
+        """Upsert records by their identity one after the other, see put
+
+        Returns:
+            the record each record replaced, or None if it was added
+        Raises:
+            ValueError: if the store has no identity
+        """
+        self._check_identity()
+        change = _Change(list(records), [], [], [])
+        if change.records:
+            self._commit(change)
+        return change.results
+
+    def delete(self, identity: tuple) -> Optional[Record]:
+        """Delete the record with an identity
+
+        Args:
+            identity: values of the identity fields of the record
+        Returns:
+            the deleted record, or None if there is no record with the identity
+        Raises:
+            ValueError: if the store has no identity
+        """
+        self._check_identity()
+        change = _Change([], [tuple(identity)], [], [])
+        self._commit(change)
+        return change.results[0]
+
+    def get(self, identity: tuple) -> Optional[Record]:
+        """Return the record with an identity, or None if there isn't one
+
+        Raises:
+            ValueError: if the store has no identity
+        """
+        self._check_identity()
+        current = self._identities.get(tuple(identity))
+        return current[1] if current is not None else None
+
+    def _check_identity(self) -> None:
+        """Raise ValueError unless the store has an identity"""
+        if self._identity_of is None:
+            raise ValueError("Records can't be looked up without an identity")
+
+    def _commit(self, change: _Change) -> None:
+        """Queue a change and apply every queued change, see RecordStore
+
+        Raises:
+            Exception: whatever applying the batch the change was applied
+                with raised, such as OSError if the log couldn't be written,
+                in which case none of the batch is applied
+        """
+        self._pending.append(change)
+        with self._lock:
+            changes = []
+            while self._pending:
+                changes.append(self._pending.popleft())
+            # another writer may have already applied our change
+            if changes:
+                try:
+                    self._apply(changes)
+                except BaseException as error:
+                    for failed in changes:
+                        failed.errors.append(error)
+        if change.errors:
+            raise change.errors[0]
+
+    def _apply(self, changes: List[_Change]) -> None:
+        """Apply and publish a batch of changes, while holding the lock"""
+        if self._identity_of is None:
+            sequences = itertools.count(self._snapshot.next_sequence())
+            records = [record for change in changes for record in change.records]
+            self._publish([], list(zip(sequences, records)))
+            return
+
+        # (sequence number, record) of each identity the changes touch,
+        # or None once it is deleted, which is only written to the index
+        # once the changes are published
+        touched = {}
+        removed = []
+        added = {}
+
+        def remove(current: Tuple[int, Record]) -> None:
+            # a record added by the same batch is simply not added
+            if added.pop(current[0], None) is None:
+                removed.append(current)
+
+        sequences = itertools.count(self._snapshot.next_sequence())
+        for change in changes:
+            for record in change.records:
+                key = self._identity_of(record)
+                current = touched.get(key, self._identities.get(key))
+                change.results.append(current[1] if current else None)
+                if current is not None and current[1] == record:
+                    continue
+                if current is not None:
+                    remove(current)
+                touched[key] = (next(sequences), record)
+                added[touched[key][0]] = record
+            for key in change.deleted:
+                current = touched.get(key, self._identities.get(key))
+                change.results.append(current[1] if current else None)
+                if current is not None:
+                    remove(current)
+                    touched[key] = None
+
+        if removed or added:
+            self._publish(removed, list(added.items()))
+        for key, current in touched.items():
+            if current is None:
+                self._identities.pop(key, None)
+            else:
+                self._identities[key] = current
+
+    def _publish(
+        self, removed: List[Tuple[int, Record]], added: List[Tuple[int, Record]]
+    ) -> None:
+        """Log and publish the next snapshot, while holding the lock"""
+        snapshot = self._snapshot.updated(removed, added)
+        if self._log is not None:
+            self._log.append(
+                [record for _, record in added],
+                snapshot,
+                [record for _, record in removed],
+            )
+        self._snapshot = snapshot
+
+    def close(self) -> None:
+        """Close the log of the store, if it has one"""
+        if self._log is not None:
+            self._log.close()
+
+    def sorted_by(self, order: RecordSortOrder) -> List[Record]:
+        """Return the current records sorted by the given order
+
+        See RecordSnapshot.sorted_by
+        """
+        return self._snapshot.sorted_by(order)
+
+    def query(self, query: "RecordQuery") -> List[Record]:
+        """Return the current records matching a query
+
+        See RecordSnapshot.query
+        """
+        return self._snapshot.query(query)
+
+    def page(
+        self,
+        order: RecordSortOrder,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        cursor: Optional[Tuple] = None,
+        low=None,
+        high=None,
+    ) -> Tuple[List[Record], Optional[Tuple]]:
+        """Return a page of the current records sorted by the given order
+
+        See RecordSnapshot.page
+        """
+        return self._snapshot.page(order, limit, offset, cursor, low, high)
+
+
+# number of rows RecordTable.take reads at a time
+_TAKE_BATCH_ROWS = 4096
+
+# header of the binary format of a RecordTable: number of rows
+_TABLE_HEADER = struct.Struct("<Q")
+
+# header of a string column of a RecordTable: number of distinct strings and
+# the length of the concatenated, utf-8 encoded strings, which are followed
+# by the length of each string in characters
+_STRING_COLUMN_HEADER = struct.Struct("<QQ")
+
+
+class _StringColumn:
+    """Dictionary encoded column of strings
+
+    Each distinct string is stored once and every row holds the integer code
+    of its string.
+    """
+
+    def __init__(self):
+        """Initialize an empty column"""
+        self.values: List[str] = []
+        self.codes = array("I")
+        self._codes_by_value = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row: int) -> str:
+        return self.values[self.codes[row]]
+
+    def append(self, value: str) -> None:
+        """Add a row holding the given string"""
+        code = self._codes_by_value.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self._codes_by_value[value] = code
+        self.codes.append(code)
+
+    def extend(self, values: Sequence[str]) -> None:
+        """Add a row for each of the given strings
+
+        Only the distinct new strings are handled in python, the code of each
+        row is looked up in C.
+        """
+        codes_by_value = self._codes_by_value
+        new_values = [
+            value for value in dict.fromkeys(values) if value not in codes_by_value
+        ]
+        codes_by_value.update(zip(new_values, itertools.count(len(self.values))))
+        self.values.extend(new_values)
+        self.codes.extend(map(codes_by_value.__getitem__, values))
+
+    def take(self, get_rows: Callable[[Sequence], tuple]) -> tuple:
+        """Return the strings in some rows, see _items_getter"""
+        return _items_getter(get_rows(self.codes))(self.values)
+
+    def ranks(self) -> array:
+        """Return the position of each distinct string in sorted order, by code"""
+        ranks = array("I", bytes(4 * len(self.values)))
+        by_value = sorted(range(len(self.values)), key=self.values.__getitem__)
+        for rank, code in enumerate(by_value):
+            ranks[code] = rank
+        return ranks
+
+    def sort_keys(self) -> Tuple[Sequence[int], int]:
+        """Return the rank of the string in each row and the number of ranks
+
+        The keys are a numpy array when numpy is installed.
+        """
+        ranks = self.ranks()
+        if numpy is not None:
+            return numpy.asarray(ranks)[numpy.asarray(self.codes)], len(ranks)
+        return [ranks[code] for code in self.codes], len(ranks)
+
+    def write(self, file: BinaryIO) -> None:
+        """Write the column in the binary format read by _StringColumn.read"""
+        text = "".join(self.values).encode()
+        file.write(_STRING_COLUMN_HEADER.pack(len(self.values), len(text)))
+        file.write(text)
+        _write_array(file, array("I", map(len, self.values)))
+        _write_array(file, self.codes)
+
+    @classmethod
+    def read(cls, buffer, position: int, rows: int) -> Tuple["_StringColumn", int]:
+        """Read a column written with write from a buffer
+
+        Returns:
+            (column, offset just past the column)
+        """
+        count, length = _STRING_COLUMN_HEADER.unpack_from(buffer, position)
+        position += _STRING_COLUMN_HEADER.size
+        column = cls()
+        text = _decode(buffer, position, position + length, "utf-8")
+        lengths, position = _read_array(buffer, "I", position + length, count)
+        ends = list(itertools.accumulate(lengths))
+        if (ends[-1] if ends else 0) != len(text):
+            raise ValueError(f"Truncated string column at offset {position}")
+        starts = itertools.chain((0,), ends)
+        column.values = list(map(text.__getitem__, map(slice, starts, ends)))
+        column._codes_by_value = dict(zip(column.values, range(count)))
+        column.codes, position = _read_array(buffer, "I", position, rows)
+        return column, position
+
+
+class RecordTable:
+    """Columnar storage for a large number of records
+
+    Rather than a Record object per row, the table keeps one compact column
+    per field: dates of birth as day ordinals in an int array, genders as a
+    bytearray of codes and the strings dictionary encoded. Records are built
+    from the columns only when they are read, and sorting works on integer
+    keys derived from the columns instead of comparing records.
+    """
+
+    def __init__(self, records: Iterable[Record] = ()):
+        """Initialize a table holding the given records"""
+        self._last_names = _StringColumn()
+        self._first_names = _StringColumn()
+        self._genders = bytearray()
+        self._favorite_colors = _StringColumn()
+        self._dates_of_birth = array("i")
+        self.extend(records)
+
+    def __len__(self):
+        return len(self._genders)
+
+    def __getitem__(self, row: int) -> Record:
+        return Record(
+            self._last_names[row],
+            self._first_names[row],
+            _GENDERS[self._genders[row]],
+            self._favorite_colors[row],
+            date.fromordinal(self._dates_of_birth[row]),
+        )
+
+    def __iter__(self) -> Iterator[Record]:
+        return (self[row] for row in range(len(self)))
+
+    def distinct(self, name: str) -> list:
+        """Return the distinct values of a field in the table, in no order
+
+        Raises:
+            ValueError: if the field is unknown
+        """
+        if name == "gender":
+            return [_GENDERS[code] for code in set(self._genders)]
+        if name == "date_of_birth":
+            return list(map(date.fromordinal, set(self._dates_of_birth)))
+        return list(self._string_column(name).values)
+
+    def append(self, record: Record) -> None:
+        """Add a record to the end of the table
+
+        Args:
+            record: record to add
+        """
+        self._last_names.append(record.last_name)
+        self._first_names.append(record.first_name)
+        self._genders.append(_GENDER_CODES[record.gender])
+        self._favorite_colors.append(record.favorite_color)
+        self._dates_of_birth.append(record.date_of_birth.toordinal())
+
+    def extend(self, records: Iterable[Record]) -> None:
+        """Add records to the end of the table
+
+        The records are split into columns a batch at a time and every column
+        of the batch is added at once.
+
+        Args:
+            records: records to add
+        """
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, _EXTEND_BATCH_ROWS))
+            if not batch:
+                return
+            last_names, first_names, genders, favorite_colors, dates = zip(*batch)
+            self._extend_columns(
+                last_names,
+                first_names,
+                map(_GENDER_CODES_BY_VALUE.__getitem__, map(_gender_value, genders)),
+                favorite_colors,
+                array("i", map(date.toordinal, dates)),
+            )
+
+    def _extend_columns(
+        self,
+        last_names: Sequence[str],
+        first_names: Sequence[str],
+        gender_codes: Iterable[int],
+        favorite_colors: Sequence[str],
+        date_ordinals: array,
+    ) -> None:
+        """Add rows to the end of the table from the values of each column"""
+        self._last_names.extend(last_names)
+        self._first_names.extend(first_names)
+        self._genders.extend(gender_codes)
+        self._favorite_colors.extend(favorite_colors)
+        self._dates_of_birth.extend(date_ordinals)
+
+    def argsort(self, order: RecordSortOrder) -> array:
+        """Return the rows of the table sorted by the given order
+
+        Rows with equal keys stay in table order, so the result matches
+        sorting the records with records_sorted_by_order.
+
+        Args:
+            order: order to sort the rows into
+        Returns:
+            row numbers in sorted order
+        Raises:
+            ValueError: if the provided order is unknown
+        """
+        spec = SORT_SPECS.get(order)
+        if spec is None:
+            raise ValueError(f"Unhandled sort order {order}")
+        return self.argsort_by_spec(spec)
+
+    def argsort_by_spec(self, spec: SortSpec) -> array:
+        """Return the rows of the table sorted by the fields of a sort spec
+
+        See _argsort_columns
+
+        Args:
+            spec: fields to sort by, most significant first
+        Returns:
+            row numbers in sorted order
+        Raises:
+            ValueError: if the spec is empty or has an unknown field
+        """
+        if not spec:
+            raise ValueError("Sort spec has no fields")
+        columns = [(*self._sort_column(field.name), field.descending) for field in spec]
+        return _argsort_columns(columns, len(self))
+
+    def _sort_column(self, name: str) -> Tuple[Sequence[int], int]:
+        """Return the integer sort keys of a field and an upper bound on them
+
+        The keys are a numpy array when numpy is installed.
+        """
+        if name == "gender":
+            return _gender_sort_keys(self._genders)
+        if name == "date_of_birth":
+            return _date_sort_keys(self._dates_of_birth)
+
+        return self._string_column(name).sort_keys()
+
+    def _string_column(self, name: str) -> _StringColumn:
+        """Return the column of a string field
+
+        Raises:
+            ValueError: if the field is unknown
+        """
+        columns = {
+            "last_name": self._last_names,
+            "first_name": self._first_names,
+            "favorite_color": self._favorite_colors,
+        }
+        if name not in columns:
+            raise ValueError(f"Unknown field {name}")
+        return columns[name]
+
+    def sorted_by(self, order: RecordSortOrder) -> Iterator[Record]:
+        """Lazily read the records of the table in the given order
+
+        Args:
+            order: order to read the records in
+        Yields:
+            records in sorted order
+        Raises:
+            ValueError: if the provided order is unknown
+        """
+        return self.take(self.argsort(order))
+
+    def take(self, rows: Sequence[int]) -> Iterator[Record]:
+        """Lazily read the records in the given rows of the table
+
+        The rows are read a batch at a time. Each field is gathered from its
+        column for the whole batch at once and the records are zipped
+        together from the fields, so unlike reading each row with table[row]
+        no python code runs per record.
+
+        Args:
+            rows: row numbers to read, in the order to read them in
+        Yields:
+            the records in those rows
+        """
+        for start in range(0, len(rows), _TAKE_BATCH_ROWS):
+            get_rows = _items_getter(rows[start : start + _TAKE_BATCH_ROWS])
+            fields = zip(
+                self._last_names.take(get_rows),
+                self._first_names.take(get_rows),
+                _items_getter(get_rows(self._genders))(_GENDERS),
+                self._favorite_colors.take(get_rows),
+                map(date.fromordinal, get_rows(self._dates_of_birth)),
+            )
+            yield from map(tuple.__new__, itertools.repeat(Record), fields)
+
+    def write(self, file: BinaryIO) -> None:
+        """Write the columns of the table in a compact binary format
+
+        Every column is written as is, so RecordTable.read loads the table
+        by copying the columns out of a buffer rather than building records.
+
+        Args:
+            file: binary file to write the table to
+        """
+        file.write(_TABLE_HEADER.pack(len(self)))
+        self._last_names.write(file)
+        self._first_names.write(file)
+        file.write(self._genders)
+        self._favorite_colors.write(file)
+        _write_array(file, self._dates_of_birth)
+
+    @classmethod
+    def read(cls, buffer, position: int = 0) -> Tuple["RecordTable", int]:
+        """Read a table written with write from a buffer, such as an mmap
+
+        Args:
+            buffer: buffer holding the table
+            position: offset of the table in the buffer
+        Returns:
+            (table, offset just past the table)
+        Raises:
+            ValueError: if the buffer doesn't hold a whole table
+        """
+        try:
+            (rows,) = _TABLE_HEADER.unpack_from(buffer, position)
+            position += _TABLE_HEADER.size
+            table = cls()
+            table._last_names, position = _StringColumn.read(buffer, position, rows)
+            table._first_names, position = _StringColumn.read(buffer, position, rows)
+            table._genders = bytearray(buffer[position : position + rows])
+            position += rows
+            table._favorite_colors, position = _StringColumn.read(
+                buffer, position, rows
+            )
+            table._dates_of_birth, position = _read_array(buffer, "i", position, rows)
+        except struct.error:
+            raise ValueError(f"Truncated record table at offset {position}") from None
+        if len(table._genders) != rows:
+            raise ValueError(f"Truncated record table at offset {position}")
+        if max(table._genders, default=0) >= len(_GENDERS):
+            raise ValueError("Invalid gender code in record table")
+        return table, position
+
+
+# number of records RecordTable.extend splits into columns at a time
+_EXTEND_BATCH_ROWS = 1 << 16
+
+
+def _gender_sort_keys(codes: bytearray) -> Tuple[Sequence[int], int]:
+    """Return the sort keys of gender codes and an upper bound on them"""
+    keys = codes.translate(_GENDER_SORT_CODES_BY_CODE)
+    return (numpy.asarray(keys) if numpy is not None else keys), len(_GENDERS)
+
+
+def _date_sort_keys(ordinals: array) -> Tuple[Sequence[int], int]:
+    """Return the sort keys of date ordinals and an upper bound on them"""
+    keys = numpy.asarray(ordinals) if numpy is not None else ordinals
+    return keys, date.max.toordinal() + 1
+
+
+def _argsort_columns(
+    columns: List[Tuple[Sequence[int], int, bool]], count: int
+) -> array:
+    """Return rows sorted by columns of integer keys
+
+    Rows with equal keys stay in order. Keys of descending columns are
+    flipped so every column sorts ascending. With numpy the columns are
+    sorted with a single numpy.lexsort. Without it they are combined into
+    one integer per row so the sort only ever compares ints.
+
+    Args:
+        columns: (non-negative keys of each row, upper bound on the keys,
+            whether the column sorts descending), most significant first
+        count: number of rows
+    Returns:
+        row numbers in sorted order
+    """
+    if not count:
+        return array("I")
+    if numpy is not None:
+        keys = [
+            size - 1 - keys if descending else keys
+            for keys, size, descending in columns
+        ]
+        # lexsort sorts by its last key first
+        rows = numpy.lexsort(keys[::-1])
+        return array("I", rows.astype(numpy.uintc).tobytes())
+
+    combined = None
+    for keys, size, descending in columns:
+        if descending:
+            keys = [size - 1 - value for value in keys]
+        if combined is None:
+            combined = keys
+        else:
+            combined = [key * size + value for key, value in zip(combined, keys)]
+    return array("I", sorted(range(count), key=combined.__getitem__))
+
+
+def _records_sort_column(records: List[Record], name: str) -> Tuple[Sequence[int], int]:
+    """Return the integer sort keys of a field of records, see RecordTable
+
+    Raises:
+        ValueError: if the field is unknown
+    """
+    if name not in Record._fields:
+        raise ValueError(f"Unknown sort field {name}")
+    values = list(map(operator.itemgetter(Record._fields.index(name)), records))
+    if name == "gender":
+        codes = map(_GENDER_CODES_BY_VALUE.__getitem__, map(_gender_value, values))
+        return _gender_sort_keys(bytearray(codes))
+    if name == "date_of_birth":
+        return _date_sort_keys(array("i", map(date.toordinal, values)))
+    column = _StringColumn()
+    column.extend(values)
+    return column.sort_keys()
+
+
+def _items_getter(indexes: Sequence[int]) -> Callable[[Sequence], tuple]:
+    """Return a function gathering the items at indexes of a sequence
+
+    Like operator.itemgetter, but it returns a tuple for a single index too.
+    """
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda values: (values[index],)
+    return operator.itemgetter(*indexes)
+
+
+def _write_array(file: BinaryIO, values: array) -> None:
+    """Write an array of numbers to a file in little endian byte order"""
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    file.write(values.tobytes())
+
+
+def _read_array(buffer, typecode: str, position: int, count: int) -> Tuple[array, int]:
+    """Read an array of numbers written with _write_array from a buffer
+
+    Returns:
+        (array, offset just past the array)
+    Raises:
+        ValueError: if the buffer ends before the array does
+    """
+    values = array(typecode)
+    end = position + values.itemsize * count
+    if end > len(buffer):
+        raise ValueError(f"Truncated array at offset {position}")
+    with memoryview(buffer) as view, view[position:end] as data:
+        values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values, end
+
+
+def records_sorted_by_spec(records: Iterable[Record], spec: SortSpec) -> List[Record]:
+    """Return a list of records sorted by the fields of a sort spec
+
+    Args:
+        records: records to sort
+        spec: fields to sort by, most significant first
+    Returns:
+        sorted records
+    Raises:
+        ValueError: if the spec is empty or has an unknown field
+    """
+    key, reverse = sort_key(spec)
+    if _sorts_with_numpy(records, spec):
+        return _records_sorted_by_columns(records, spec)
+    return sorted(records, key=key, reverse=reverse)
+
+
+def records_sorted_by_gender_and_last_name(records: List[Record]) -> List[Record]:
+    """Return a list of records sorted by gender and last name
+
+    Args:
+        records: list of records to sort
+    Returns:
+        records sorted by gender and last name
+    """
+    return records_sorted_by_order(
+        records, RecordSortOrder.GENDER_AND_LAST_NAME_ASCENDING
+    )
+
+
+def records_sorted_by_date_of_birth(records: List[Record]) -> List[Record]:
+    """Return a list of records sorted by date of birth
+
+    Args:
+        records: list of records to sort
+    Returns:
+        records sorted by date of birth
+    """
+    return records_sorted_by_order(records, RecordSortOrder.DATE_OF_BIRTH_ASCENDING)
+
+
+def records_sorted_by_last_name_descending(records: List[Record]) -> List[Record]:
+    """Return a list of records sorted by last name descending
+
+    Args:
+        records: list of records to sort
+    Returns:
+        records sorted by last name descending
+    """
+    return records_sorted_by_order(records, RecordSortOrder.LAST_NAME_DESCENDING)
+
+
+# time taken by records_sorted_by_order, recorded while record_metrics is
+# enabled
+_SORT_SECONDS = Histogram(
+    "record_lib_sort_seconds", "Time taken to sort records", ("order",)
+)
+
+
+@record_metrics.timed(_SORT_SECONDS, lambda records, order: (str(order),))
+def records_sorted_by_order(records: List[Record], order: RecordSortOrder):
+    """Return records sorted by the given order
+    
+    Args:
+        records: records to sort
+        order: order to sort the records into
+    Returns:
+        sorted records
+    Raises:
+        ValueError: if the provided order is unknown
+    """
+    key, reverse = _sort_key_for_order(order)
+    if _sorts_with_numpy(records, SORT_SPECS[order]):
+        return _records_sorted_by_columns(records, SORT_SPECS[order])
+    return sorted(records, key=key, reverse=reverse)
+
+
+# smallest list of records sorted with numpy when it is installed, below it
+# converting the records to columns costs more than the sort saves
+NUMPY_SORT_MIN_RECORDS = 1000
+
+
+def _sorts_with_numpy(records: Iterable[Record], spec: SortSpec) -> bool:
+    """Return whether records are sorted with _records_sorted_by_columns
+
+    Only sorts by several fields are, sorted is as fast as numpy with the
+    key of a single field.
+    """
+    return (
+        numpy is not None
+        and len(spec) > 1
+        and isinstance(records, list)
+        and len(records) >= NUMPY_SORT_MIN_RECORDS
+    )
+
+
+def _records_sorted_by_columns(records: List[Record], spec: SortSpec) -> List[Record]:
+    """Sort records with numpy by integer keys of the fields of a sort spec
+
+    Gives the same order as sorting with sort_key, see _argsort_columns.
+    """
+    columns = [
+        (*_records_sort_column(records, field.name), field.descending) for field in spec
+    ]
+    return list(map(records.__getitem__, _argsort_columns(columns, len(records))))
+
+
+def _sort_key_for_order(order: RecordSortOrder):
+    """Return the cached key function and reverse flag of a sort order
+
+    Raises:
+        ValueError: if the provided order is unknown
+    """
+    try:
+        return _SORT_KEYS[order]
+    except (KeyError, TypeError):
+        raise ValueError(f"Unhandled sort order {order}") from None
+
+
+def records_top_k(
+    records: Iterable[Record], order: RecordSortOrder, k: int
+) -> List[Record]:
+    """Return the first k records of an order without sorting all of them
+
+    A heap of k records is kept, so this takes O(n log k) rather than
+    O(n log n) and gives the same records as sorting and slicing.
+
+    Args:
+        records: records to choose from
+        order: order to take the first records of
+        k: number of records to return
+    Returns:
+        up to k sorted records
+    Raises:
+        ValueError: if the provided order is unknown
+    """
+    key, reverse = _sort_key_for_order(order)
+    if reverse:
+        return heapq.nlargest(k, records, key=key)
+    return heapq.nsmallest(k, records, key=key)
+
+
+# functions parsing the text of a field value, strings are used as they are
+_FIELD_PARSERS = {"gender": Gender, "date_of_birth": parse_date}
+
+
+def parse_field_value(name: str, text: str):
+    """Parse text into a value of a record field, such as a range bound
+
+    Args:
+        name: name of the field
+        text: text to parse, in the same format as the field of a record line
+    Returns:
+        the parsed value
+    Raises:
+        ValueError: if the text is not a valid value of the field
+    """
+    return _FIELD_PARSERS.get(name, str)(text)
+
+
+def range_field(order: RecordSortOrder) -> str:
+    """Return the name of the field range queries over an order filter on
+
+    This is the most significant field of the order.
+
+    Raises:
+        ValueError: if the provided order is unknown
+    """
+    _sort_key_for_order(order)
+    return SORT_SPECS[order][0].name
+
+
+def filter_records_in_range(
+    records: Iterable[Record], order: RecordSortOrder, low=None, high=None
+) -> Iterator[Record]:
+    """Lazily select the records in a range of the range field of an order
+
+    Args:
+        records: records to select from
+        order: order whose range_field is compared with the bounds
+        low: smallest value to select, unbounded if None
+        high: value to select up to but not including, unbounded if None
+    Yields:
+        the selected records in their original order
+    Raises:
+        ValueError: if the provided order is unknown
+    """
+    value = operator.attrgetter(range_field(order))
+    for record in records:
+        if (low is None or value(record) >= low) and (
+            high is None or value(record) < high
+        ):
+            yield record
+
+
+class RecordQuery(NamedTuple):
+    """Conditions a record must match, every condition that isn't None
+
+    Dates of birth must be strictly after born_after and strictly before
+    born_before.
+    """
+
+    gender: Optional[Gender] = None
+    favorite_color: Optional[str] = None
+    born_after: Optional[date] = None
+    born_before: Optional[date] = None
+
+    def matches(self, record: Record) -> bool:
+        """Return whether a record matches every condition of the query"""
+        return (
+            (self.gender is None or record.gender is self.gender)
+            and (
+                self.favorite_color is None
+                or record.favorite_color == self.favorite_color
+            )
+            and (self.born_after is None or record.date_of_birth > self.born_after)
+            and (self.born_before is None or record.date_of_birth < self.born_before)
+        )
+
+
+def filter_records(records: Iterable[Record], query: RecordQuery) -> Iterator[Record]:
+    """Lazily select the records matching a query by checking every record
+
+    This is for records that are only read once, a RecordStore answers
+    queries from its indexes instead.
+
+    Args:
+        records: records to select from
+        query: conditions the records must match
+    Yields:
+        the matching records in their original order
+    """
+    return filter(query.matches, records)
+
+
+def records_in_range(
+    records: Iterable[Record],
+    order: RecordSortOrder,
+    low=None,
+    high=None,
+    k: Optional[int] = None,
+) -> List[Record]:
+    """Return the records in a range of an order, sorted by the order
+
+    The range is over the range_field of the order, so for example
+    LAST_NAME_DESCENDING with low "M" and high "P" returns the last names
+    starting with M, N and O from the last to the first. Only the selected
+    records are sorted.
+
+    Args:
+        records: records to select from
+        order: order to sort the selected records into
+        low: smallest value to select, unbounded if None
+        high: value to select up to but not including, unbounded if None
+        k: only return the first k selected records, see records_top_k
+    Returns:
+        sorted records in the range
+    Raises:
+        ValueError: if the provided order is unknown
+    """
+    selected = filter_records_in_range(records, order, low, high)
+    if k is not None:
+        return records_top_k(selected, order, k)
+    return records_sorted_by_order(selected, order)
+
+
+# header of an encoded record: date of birth ordinal, gender code and the
+# encoded lengths of the last name, first name and favorite color
+_RECORD_HEADER = struct.Struct("<iBIII")
+
+
+def encode_record(record: Record) -> bytes:
+    """Encode a record in a compact binary format
+
+    Args:
+        record: record to encode
+    Returns:
+        the encoded record
+    """
+    last_name = record.last_name.encode()
+    first_name = record.first_name.encode()
+    favorite_color = record.favorite_color.encode()
+    return (
+        _RECORD_HEADER.pack(
+            record.date_of_birth.toordinal(),
+            _GENDER_CODES[record.gender],
+            len(last_name),
+            len(first_name),
+            len(favorite_color),
+        )
+        + last_name
+        + first_name
+        + favorite_color
+    )
+
+
+def read_encoded_records(file: BinaryIO) -> Iterator[Record]:
+    """Decode the records written to a file with encode_record
+
+    Args:
+        file: binary file positioned at the first encoded record
+    Yields:
+        the decoded records in file order
+    """
+    while True:
+        header = file.read(_RECORD_HEADER.size)
+        if not header:
+            return
+        ordinal, gender, *lengths = _RECORD_HEADER.unpack(header)
+        last_name, first_name, favorite_color = (
+            file.read(length).decode() for length in lengths
+        )
+        yield Record(
+            last_name,
+            first_name,
+            _GENDERS[gender],
+            favorite_color,
+            date.fromordinal(ordinal),
+        )
+
+
+def decode_records(buffer, start: int = 0, end: Optional[int] = None) -> List[Record]:
+    """Decode records encoded with encode_record from a bytes-like object
+
+    Unlike read_encoded_records this works on any buffer, such as an mmap,
+    without reading it through a file.
+
+    Args:
+        buffer: buffer holding consecutive encoded records
+        start: offset of the first encoded record
+        end: offset just past the last encoded record, the end of the buffer
+            by default
+    Returns:
+        the decoded records in buffer order
+    Raises:
+        ValueError: if the records don't end exactly at end
+    """
+    if end is None:
+        end = len(buffer)
+    records = []
+    position = start
+    while position < end:
+        if position + _RECORD_HEADER.size > end:
+            raise ValueError(f"Truncated record at offset {position}")
+        ordinal, gender, *lengths = _RECORD_HEADER.unpack_from(buffer, position)
+        position += _RECORD_HEADER.size
+        fields = []
+        for length in lengths:
+            fields.append(str(buffer[position : position + length], "utf-8"))
+            position += length
+        if position > end:
+            raise ValueError(f"Truncated record at offset {position}")
+        last_name, first_name, favorite_color = fields
+        records.append(
+            Record(
+                last_name,
+                first_name,
+                _GENDERS[gender],
+                favorite_color,
+                date.fromordinal(ordinal),
+            )
+        )
+    return records
+
+
+# rough number of bytes of memory a parsed record uses on top of the
+# characters in its strings, used to decide when to spill records to disk
+_RECORD_MEMORY_OVERHEAD = 400
+
+
+def external_sort(
+    records: Iterable[Record],
+    order: RecordSortOrder,
+    memory_limit: int,
+    temp_dir: Optional[str] = None,
+) -> Iterator[Record]:
+    """Sort records that may not fit in memory
+
+    Records are collected until they take up about memory_limit bytes, then
+    sorted and spilled to a temporary file as a run of encoded records. The
+    runs are merged lazily with heapq.merge, so the output is streamed and
+    matches sorting all the records in memory.
+
+    Args:
+        records: records to sort
+        order: order to sort the records into
+        memory_limit: approximate number of bytes of records to keep in memory
+        temp_dir: directory for the temporary files, defaults to the system
+            temporary directory
+    Yields:
+        the sorted records
+    Raises:
+        ValueError: if the provided order is unknown
+    """
+    key, descending = _sort_key_for_order(order)
+
+    runs = []
+    try:
+        run = []
+        run_size = 0
+        for record in records:
+            run.append(record)
+            run_size += _RECORD_MEMORY_OVERHEAD + len(record.last_name)
+            run_size += len(record.first_name) + len(record.favorite_color)
+            if run_size >= memory_limit:
+                run.sort(key=key, reverse=descending)
+                runs.append(_write_run(run, temp_dir))
+                run = []
+                run_size = 0
+
+        run.sort(key=key, reverse=descending)
+        if not runs:
+            yield from run
+            return
+        runs.append(_write_run(run, temp_dir))
+        del run
+
+        yield from heapq.merge(
+            *(read_encoded_records(file) for file in runs),
+            key=key,
+            reverse=descending,
+        )
+    finally:
+        for file in runs:
+            file.close()
+
+
+def _write_run(records: List[Record], temp_dir: Optional[str]) -> BinaryIO:
+    """Write sorted records to a temporary file to be merged later"""
+    file = tempfile.TemporaryFile(dir=temp_dir)
+    file.writelines(encode_record(record) for record in records)
+    file.seek(0)
+    return file
@@ -0,0 +1,418 @@
+import itertools
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from typing import List, Optional, Sequence, Tuple
+
+from record_lib import (
+    Record,
+    RecordSnapshot,
+    RecordSortOrder,
+    RecordStore,
+    decode_records,
+    encode_record,
+    gc_paused,
+)
+
+# how hard append tries to make records durable before returning
+#   always: fsync every batch, batches from concurrent writers share an fsync
+#   interval: fsync from a background thread every sync_interval seconds
+#   never: leave flushing to the operating system
+DURABILITY_MODES = ("always", "interval", "never")
+
+# number of logged records after which a snapshot of the store is written
+DEFAULT_SNAPSHOT_RECORDS = 100_000
+
+SNAPSHOT_FILE_NAME = "records.snapshot"
+_LOG_FILE_NAME = re.compile(r"records\.(\d+)\.log")
+
+# header of each batch in a log: length and crc32 of the encoded records
+_BATCH_HEADER = struct.Struct("<II")
+
+# start of a batch that removes records: a date of birth ordinal no encoded
+# record can have, then the number of removed records. The removed records
+# come before the added ones. Batches that only add records are written
+# without it, the same way as before records could be removed.
+_REMOVAL_HEADER = struct.Struct("<iI")
+_REMOVAL_MARKER = -1
+
+# header of a snapshot: magic, generation of the last log it includes,
+# store version, number of records and the next sequence number of the
+# store, which snapshots written before it was kept don't have
+_SNAPSHOT_MAGIC = b"RECSNAP2"
+_SNAPSHOT_HEADER = struct.Struct("<8sQQQQ")
+_SNAPSHOT_MAGIC_V1 = b"RECSNAP1"
+_SNAPSHOT_HEADER_V1 = struct.Struct("<8sQQQ")
+
+
+class RecordLog:
+    """Append-only log of the batches added to a RecordStore
+
+    The log is a series of numbered files in a directory. Every batch is
+    written to the newest file as the length and crc32 of the batch followed
+    by its records encoded with encode_record, so a batch cut short by a
+    crash is detected and dropped when the log is read back. Batches that
+    remove records, such as an upsert, also list the removed records, so the
+    removal and addition are written and replayed together.
+
+    After snapshot_records records have been logged, the log switches to a
+    new file and a background thread writes a snapshot of the store that
+    includes everything in the older files, then deletes them. Restarting
+    then only needs to load the snapshot and replay the newer files.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        generation: int,
+        durability: str = "always",
+        sync_interval: float = 1.0,
+        snapshot_records: int = DEFAULT_SNAPSHOT_RECORDS,
+    ):
+        """Open the log file of a generation for appending
+
+        Args:
+            directory: directory holding the log files and snapshot
+            generation: number of the log file to append to
+            durability: one of DURABILITY_MODES
+            sync_interval: seconds between fsyncs with interval durability
+            snapshot_records: number of records to log between snapshots
+        Raises:
+            ValueError: if the durability mode is unknown
+        """
+        if durability not in DURABILITY_MODES:
+            raise ValueError(
+                f"Durability {durability} is not one of {', '.join(DURABILITY_MODES)}"
+            )
+        self.directory = directory
+        self.durability = durability
+        self.snapshot_records = snapshot_records
+        self._generation = generation
+        self._file = self._open(generation)
+        self._records_since_snapshot = 0
+        self._snapshot_thread: Optional[threading.Thread] = None
+
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._closed = threading.Event()
+        self._sync_thread = None
+        if durability == "interval":
+            self._sync_thread = threading.Thread(
+                target=self._sync_periodically, args=(sync_interval,), daemon=True
+            )
+            self._sync_thread.start()
+
+    def _open(self, generation: int) -> int:
+        """Open the log file of a generation for appending"""
+        return os.open(
+            log_path(self.directory, generation),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644,
+        )
+
+    def append(
+        self,
+        records: List[Record],
+        snapshot: RecordSnapshot,
+        removed: Sequence[Record] = (),
+    ) -> None:
+        """Write a batch of records to the log
+
+        RecordStore calls this while holding its lock, so batches are
+        written in the order they are applied to the store.
+
+        Args:
+            records: batch of records added to the store
+            snapshot: snapshot of the store including the batch
+            removed: records the batch removed from the store
+        """
+        payload = b"".join(map(encode_record, itertools.chain(removed, records)))
+        if removed:
+            payload = _REMOVAL_HEADER.pack(_REMOVAL_MARKER, len(removed)) + payload
+        batch = _BATCH_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            _write_all(self._file, batch)
+            if self.durability == "always":
+                os.fsync(self._file)
+            else:
+                self._dirty = True
+
+            self._records_since_snapshot += len(records) + len(removed)
+            if (
+                self._records_since_snapshot >= self.snapshot_records
+                and not self.snapshotting
+            ):
+                self._start_snapshot(snapshot)
+
+    @property
+    def snapshotting(self) -> bool:
+        """Whether a snapshot is being written in the background"""
+        return self._snapshot_thread is not None and self._snapshot_thread.is_alive()
+
+    def _start_snapshot(self, snapshot: RecordSnapshot) -> None:
+        """Switch to a new log file and snapshot everything before it"""
+        # the old file must be durable before the snapshot can replace it
+        os.fsync(self._file)
+        os.close(self._file)
+        covered = self._generation
+        self._generation += 1
+        self._file = self._open(self._generation)
+        self._records_since_snapshot = 0
+        self._snapshot_thread = threading.Thread(
+            target=self._write_snapshot, args=(snapshot, covered)
+        )
+        self._snapshot_thread.start()
+
+    def _write_snapshot(self, snapshot: RecordSnapshot, generation: int) -> None:
+        """Write a snapshot including a generation and delete its log files"""
+        write_snapshot(self.directory, snapshot, generation)
+        for old_generation in log_generations(self.directory):
+            if old_generation <= generation:
+                os.remove(log_path(self.directory, old_generation))
+
+    def sync(self) -> None:
+        """Flush everything written so far to disk"""
+        with self._lock:
+            os.fsync(self._file)
+            self._dirty = False
+
+    def _sync_periodically(self, interval: float) -> None:
+        """fsync the log every interval seconds while there are new writes"""
+        while not self._closed.wait(interval):
+            with self._lock:
+                if self._dirty and not self._closed.is_set():
+                    os.fsync(self._file)
+                    self._dirty = False
+
+    def close(self) -> None:
+        """Flush the log and wait for any snapshot being written"""
+        self._closed.set()
+        if self._sync_thread is not None:
+            self._sync_thread.join()
+        with self._lock:
+            os.fsync(self._file)
+            os.close(self._file)
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+
+
+def open_store(
+    directory: str,
+    durability: str = "always",
+    sync_interval: float = 1.0,
+    snapshot_records: int = DEFAULT_SNAPSHOT_RECORDS,
+    identity: Optional[Sequence[str]] = None,
+) -> RecordStore:
+    """Open a durable RecordStore kept in a directory
+
+    The store is restored from the latest snapshot in the directory plus the
+    log files written after it, and every later change is logged there.
+
+    Args:
+        directory: directory for the log files and snapshot, created if
+            it doesn't exist
+        durability: one of DURABILITY_MODES
+        sync_interval: seconds between fsyncs with interval durability
+        snapshot_records: number of records to log between snapshots
+        identity: names of the fields identifying a record, if records
+            should be deduplicated, see RecordStore
+    Returns:
+        the restored store
+    Raises:
+        ValueError: if the durability mode or an identity field is unknown,
+            the snapshot is not a record snapshot or the log removes a
+            record that isn't there
+    """
+    os.makedirs(directory, exist_ok=True)
+    # loading allocates millions of objects that all outlive the load
+    with gc_paused():
+        snapshot, generation = load_snapshot(directory)
+
+        batches = []
+        # appending to a log the snapshot includes would lose the appended
+        # records, so a new generation is started unless a newer log exists
+        last_generation = generation + 1
+        for log_generation in log_generations(directory):
+            if log_generation <= generation:
+                # left behind by a crash right after the snapshot was written
+                os.remove(log_path(directory, log_generation))
+            else:
+                batches.extend(replay_log(log_path(directory, log_generation)))
+                last_generation = log_generation
+        snapshot = snapshot.replayed(batches)
+
+    log = RecordLog(
+        directory, last_generation, durability, sync_interval, snapshot_records
+    )
+    return RecordStore.from_snapshot(snapshot, log, identity)
+
+
+def log_path(directory: str, generation: int) -> str:
+    """Return the path of the log file of a generation"""
+    return os.path.join(directory, f"records.{generation}.log")
+
+
+def log_generations(directory: str) -> List[int]:
+    """Return the generations of the log files in a directory in order"""
+    generations = []
+    for name in os.listdir(directory):
+        match = _LOG_FILE_NAME.fullmatch(name)
+        if match:
+            generations.append(int(match.group(1)))
+    return sorted(generations)
+
+
+def replay_log(path: str) -> List[Tuple[List[Record], List[Record]]]:
+    """Read every complete batch in a log file
+
+    A batch that was cut short or corrupted, which can only be the last one
+    written before a crash, is truncated from the file along with anything
+    after it so later batches are appended right after the valid ones.
+
+    Args:
+        path: path of the log file
+    Returns:
+        (records removed, records added) of each batch in the order they
+        were applied
+    """
+    batches = []
+    with open(path, "r+b") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return batches
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            position = 0
+            while position + _BATCH_HEADER.size <= size:
+                length, checksum = _BATCH_HEADER.unpack_from(buffer, position)
+                start = position + _BATCH_HEADER.size
+                end = start + length
+                if end > size or zlib.crc32(buffer[start:end]) != checksum:
+                    break
+                batches.append(_decode_batch(buffer, start, end))
+                position = end
+        if position < size:
+            file.truncate(position)
+            os.fsync(file.fileno())
+    return batches
+
+
+def _decode_batch(buffer, start: int, end: int) -> Tuple[List[Record], List[Record]]:
+    """Decode the payload of a batch into (records removed, records added)"""
+    removed_count = 0
+    if end - start >= _REMOVAL_HEADER.size:
+        marker, count = _REMOVAL_HEADER.unpack_from(buffer, start)
+        if marker == _REMOVAL_MARKER:
+            removed_count = count
+            start += _REMOVAL_HEADER.size
+    records = decode_records(buffer, start, end)
+    return records[:removed_count], records[removed_count:]
+
+
+def write_snapshot(directory: str, snapshot: RecordSnapshot, generation: int) -> None:
+    """Atomically replace the snapshot in a directory
+
+    The snapshot holds the position of every record in each sort index
+    followed by the records encoded in insertion order, so loading it
+    rebuilds the indexes without sorting.
+
+    Args:
+        directory: directory to write the snapshot to
+        snapshot: snapshot of the store to write
+        generation: generation of the last log file the snapshot includes
+    """
+    path = os.path.join(directory, SNAPSHOT_FILE_NAME)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(
+            _SNAPSHOT_HEADER.pack(
+                _SNAPSHOT_MAGIC,
+                generation,
+                snapshot.version,
+                len(snapshot),
+                snapshot.next_sequence(),
+            )
+        )
+        for order in RecordSortOrder:
+            positions = snapshot.positions(order)
+            if sys.byteorder == "big":
+                positions.byteswap()
+            file.write(positions.tobytes())
+        for record in snapshot:
+            file.write(encode_record(record))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    _fsync_directory(directory)
+
+
+def load_snapshot(directory: str) -> Tuple[RecordSnapshot, int]:
+    """Load the snapshot in a directory
+
+    Args:
+        directory: directory holding the snapshot
+    Returns:
+        (snapshot, generation of the last log file it includes), which is an
+        empty snapshot and -1 if there is no snapshot
+    Raises:
+        ValueError: if the file is not a record snapshot
+    """
+    path = os.path.join(directory, SNAPSHOT_FILE_NAME)
+    if not os.path.exists(path):
+        return RecordStore().snapshot(), -1
+
+    with open(path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buffer:
+        magic = buffer[: len(_SNAPSHOT_MAGIC)]
+        if magic == _SNAPSHOT_MAGIC and len(buffer) >= _SNAPSHOT_HEADER.size:
+            header = _SNAPSHOT_HEADER.unpack_from(buffer)
+            _, generation, version, count, next_sequence = header
+            position = _SNAPSHOT_HEADER.size
+        elif magic == _SNAPSHOT_MAGIC_V1 and len(buffer) >= _SNAPSHOT_HEADER_V1.size:
+            _, generation, version, count = _SNAPSHOT_HEADER_V1.unpack_from(buffer)
+            next_sequence = None
+            position = _SNAPSHOT_HEADER_V1.size
+        else:
+            raise ValueError(f"{path} is not a record snapshot")
+
+        positions = {}
+        for order in RecordSortOrder:
+            positions[order] = array("I")
+            positions[order].frombytes(buffer[position : position + 4 * count])
+            if sys.byteorder == "big":
+                positions[order].byteswap()
+            position += 4 * count
+        records = decode_records(buffer, position)
+
+    if len(records) != count:
+        raise ValueError(f"{path} has {len(records)} records rather than {count}")
+    snapshot = RecordSnapshot.restored(
+        version, records, positions, next_sequence=next_sequence
+    )
+    return snapshot, generation
+
+
+def _write_all(file: int, data: bytes) -> None:
+    """Write all of data to a file descriptor"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(file, view) :]
+
+
+def _fsync_directory(directory: str) -> None:
+    """Make a rename in a directory durable, where the platform allows it"""
+    try:
+        file = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(file)
+    except OSError:
+        pass
+    finally:
+        os.close(file)
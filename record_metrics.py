@@ -0,0 +1,337 @@
+import bisect
+import collections
+import contextlib
+import functools
+import itertools
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+# whether the metrics in this module record anything. While they are
+# disabled, which is the default outside of record_server, instrumented code
+# only checks this flag, so the instrumentation costs next to nothing
+enabled = False
+
+# upper bounds of the default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# number of items Profile.iterate produces at a time
+PROFILE_BATCH_SIZE = 1000
+
+
+class Registry:
+    """Metrics that are rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        """Initialize an empty registry"""
+        self._metrics: List["_Metric"] = []
+
+    def register(self, metric: "_Metric") -> None:
+        """Add a metric to the registry
+
+        Raises:
+            ValueError: if a metric with the same name is already registered
+        """
+        if any(existing.name == metric.name for existing in self._metrics):
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+default_registry = Registry()
+
+
+class _Metric:
+    """Metric with a value for each combination of label values"""
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Tuple[str, ...] = (),
+        registry: Optional[Registry] = default_registry,
+    ):
+        """Initialize a metric and add it to a registry
+
+        Args:
+            name: name of the metric
+            description: help text of the metric
+            labels: names of the labels the metric is broken down by
+            registry: registry to add the metric to, if any
+        """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _label_text(self, values: Tuple[str, ...], extra: str = "") -> str:
+        """Return the label part of a sample, such as {order="x",le="1"}"""
+        pairs = [
+            f'{name}="{_escape(str(value))}"'
+            for name, value in zip(self.labels, values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterator[str]:
+        """Return the sample lines of the metric"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Count that only goes up, such as a number of parsed records"""
+
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = collections.defaultdict(float)
+        if not self.labels:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, labels: Tuple[str, ...] = ()) -> None:
+        """Add to the count of the given label values if metrics are enabled"""
+        if enabled:
+            with self._lock:
+                self._values[labels] += amount
+
+    def value(self, labels: Tuple[str, ...] = ()) -> float:
+        """Return the count of the given label values"""
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{self._label_text(labels)} {_number(value)}"
+
+
+class Gauge(_Metric):
+    """Value that is read when the metrics are rendered, such as a store size"""
+
+    type = "gauge"
+
+    def __init__(self, *args, function: Callable[[], float], **kwargs):
+        """Initialize a gauge, see _Metric for the other arguments
+
+        Args:
+            function: returns the current value
+        """
+        super().__init__(*args, **kwargs)
+        self.function = function
+
+    def samples(self) -> Iterator[str]:
+        yield f"{self.name} {_number(self.function())}"
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, such as request latencies"""
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        """Initialize a histogram, see _Metric for the other arguments
+
+        Args:
+            buckets: sorted upper bounds of the buckets values are counted in
+        """
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # per label values: count in each bucket and above the last, and sum
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = collections.defaultdict(float)
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()) -> None:
+        """Count a value for the given label values if metrics are enabled"""
+        if not enabled:
+            return
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            counts[bucket] += 1
+            self._sums[labels] += value
+
+    def time(self, labels: Tuple[str, ...] = ()) -> "_Timer":
+        """Return a context manager observing the seconds its block takes"""
+        return _Timer(self, labels)
+
+    def count(self, labels: Tuple[str, ...] = ()) -> int:
+        """Return the number of values observed for the given label values"""
+        with self._lock:
+            return sum(self._counts.get(labels, ()))
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(
+                (labels, list(counts), self._sums[labels])
+                for labels, counts in self._counts.items()
+            )
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                label_text = self._label_text(labels, le)
+                yield f"{self.name}_bucket{label_text} {cumulative}"
+            yield f"{self.name}_sum{self._label_text(labels)} {_number(total)}"
+            yield f"{self.name}_count{self._label_text(labels)} {cumulative}"
+
+
+def timed(histogram: Histogram, labels: Optional[Callable[..., Tuple]] = None):
+    """Decorate a function to observe the seconds each call takes
+
+    While metrics are disabled the function is called straight away.
+
+    Args:
+        histogram: histogram to observe the seconds in
+        labels: returns the label values of a call from its arguments
+    """
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            call_labels = labels(*args, **kwargs) if labels is not None else ()
+            with _Timer(histogram, call_labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class _Timer:
+    """Context manager observing how long its block takes in a histogram
+
+    Nothing is timed if metrics are disabled when the block starts.
+    """
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class Profile:
+    """Wall time spent in each stage of a pipeline, for record_cli --profile
+
+    Stages can be nested, like a sort that pulls records from a parser, and
+    the time of each stage excludes the time of the stages nested in it.
+    """
+
+    def __init__(self):
+        """Initialize an empty profile"""
+        self.seconds: Dict[str, float] = collections.Counter()
+        self.items: Dict[str, int] = collections.Counter()
+        self._stack: List[str] = []
+        self._since = time.perf_counter()
+
+    def _enter(self, stage: str) -> None:
+        now = time.perf_counter()
+        if self._stack:
+            self.seconds[self._stack[-1]] += now - self._since
+        self._stack.append(stage)
+        self._since = now
+
+    def _exit(self) -> None:
+        now = time.perf_counter()
+        self.seconds[self._stack.pop()] += now - self._since
+        self._since = now
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        """Count the time of a block towards a stage"""
+        self._enter(stage)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def iterate(self, stage: str, iterable: Iterable) -> Iterator:
+        """Count the time of producing the items of an iterable towards a stage
+
+        Items are produced PROFILE_BATCH_SIZE at a time, so the cost of
+        timing them is spread over many items.
+        """
+        # stages are listed in the order they are set up, which is the order
+        # of the pipeline
+        self.seconds.setdefault(stage, 0.0)
+        return self._iterate(stage, iter(iterable))
+
+    def _iterate(self, stage: str, iterator: Iterator) -> Iterator:
+        while True:
+            with self.stage(stage):
+                items = list(itertools.islice(iterator, PROFILE_BATCH_SIZE))
+            if not items:
+                return
+            self.items[stage] += len(items)
+            yield from items
+
+    def write(self, file: TextIO = sys.stderr) -> None:
+        """Write a table of the time and items of each stage"""
+        total = sum(self.seconds.values())
+        file.write(
+            f"{'stage':10} {'seconds':>9} {'share':>6} {'items':>10} {'items/s':>10}\n"
+        )
+        for stage, seconds in self.seconds.items():
+            items = self.items.get(stage)
+            rate = f"{items / seconds:10.0f}" if items and seconds else f"{'':>10}"
+            file.write(
+                f"{stage:10} {seconds:9.3f} {seconds / (total or 1):6.1%} "
+                f"{items if items is not None else '':>10} {rate}\n"
+            )
+        file.write(f"{'total':10} {total:9.3f}\n")
+
+
+class _NoProfile:
+    """Profile that records nothing, so unprofiled runs pay nothing for it"""
+
+    def stage(self, stage: str):
+        return contextlib.nullcontext()
+
+    def iterate(self, stage: str, iterable: Iterable) -> Iterable:
+        return iterable
+
+
+NO_PROFILE = _NoProfile()
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the Prometheus text format"""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    """Format a sample value, without a trailing .0 for whole numbers"""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
@@ -1,17 +1,206 @@
-from flask import Flask, Response, jsonify, request
+import base64
+import binascii
+import codecs
+import functools
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from flask import Flask, Response, g, jsonify, request
+from werkzeug.wrappers import Request
 
 from record_lib import (
-    records_sorted_by_date_of_birth,
-    records_sorted_by_gender_and_last_name,
-    records_sorted_by_last_name_descending,
-    update_records,
+    Gender,
+    Record,
+    RecordQuery,
+    RecordSnapshot,
+    RecordSortOrder,
+    RecordStore,
+    parse_date,
+    parse_field_value,
+    parse_record,
+    range_field,
+    records_sorted_by_order,
 )
+from record_log import DEFAULT_SNAPSHOT_RECORDS, open_store
+import record_metrics
+from record_metrics import PROMETHEUS_CONTENT_TYPE, Counter, Gauge, Histogram
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
+# number of records parsed from a bulk upload before they are added to the
+# store together
+BULK_BATCH_SIZE = 10000
+
+# number of bytes read from a request body at a time when streaming it
+STREAM_CHUNK_SIZE = 1 << 16
+
+# number of records serialized into each chunk of a streamed response
+RESPONSE_CHUNK_RECORDS = 1000
+
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# fields identifying a record, from the comma separated
+# RECORD_SERVER_IDENTITY such as last_name,first_name,date_of_birth. When it
+# is set, added records are upserted by identity rather than duplicated, and
+# records can be replaced with PUT and deleted with DELETE.
+IDENTITY = (
+    tuple(
+        field.strip()
+        for field in os.environ.get("RECORD_SERVER_IDENTITY", "").split(",")
+        if field.strip()
+    )
+    or None
+)
+IDENTITY_MISSING_MESSAGE = (
+    "Records have no identity to look them up by, set RECORD_SERVER_IDENTITY"
+)
+
 # global variable to store current records. In a real
-# application this would be replaced by a database of some kind
-current_records = []
+# application this would be replaced by a database of some kind.
+#
+# The records only live in memory unless RECORD_SERVER_DATA_DIR is set, in
+# which case they are logged to that directory and restored from it on
+# startup. The durability of the log is configured with
+#   RECORD_SERVER_DURABILITY: always, interval or never, see record_log
+#   RECORD_SERVER_SYNC_INTERVAL: seconds between fsyncs with interval
+#   RECORD_SERVER_SNAPSHOT_RECORDS: number of records logged between snapshots
+if os.environ.get("RECORD_SERVER_DATA_DIR"):
+    current_records = open_store(
+        os.environ["RECORD_SERVER_DATA_DIR"],
+        os.environ.get("RECORD_SERVER_DURABILITY", "always"),
+        float(os.environ.get("RECORD_SERVER_SYNC_INTERVAL", 1.0)),
+        int(os.environ.get("RECORD_SERVER_SNAPSHOT_RECORDS", DEFAULT_SNAPSHOT_RECORDS)),
+        IDENTITY,
+    )
+else:
+    current_records = RecordStore(identity=IDENTITY)
+
+# metrics served from /metrics in the Prometheus text format, along with the
+# record_lib ones. They are recorded unless RECORD_SERVER_METRICS is 0.
+record_metrics.enabled = os.environ.get("RECORD_SERVER_METRICS", "1") != "0"
+request_seconds = Histogram(
+    "record_server_request_seconds",
+    "Time taken to handle a request, including streaming its response",
+    ("route", "method", "status"),
+)
+serialize_seconds = Histogram(
+    "record_server_serialize_seconds",
+    "Time spent encoding the records of a response",
+)
+records_added = Counter(
+    "record_server_records_added_total", "Records added through the server"
+)
+records_deleted = Counter(
+    "record_server_records_deleted_total",
+    "Records deleted or replaced through the server",
+)
+parse_errors = Counter(
+    "record_server_parse_errors_total", "Records rejected because they didn't parse"
+)
+Gauge(
+    "record_server_store_records",
+    "Records in the store",
+    function=lambda: len(current_records),
+)
+Gauge(
+    "record_server_store_version",
+    "Number of changes made to the store",
+    function=lambda: current_records.version,
+)
+
+
+class ResponseCache:
+    """Encoded bodies of full sorted record responses
+
+    Bodies are kept for a single store version per order and format, so a
+    change to the store invalidates them and the next request replaces them.
+    """
+
+    def __init__(self):
+        """Initialize an empty cache"""
+        self._bodies: Dict[Tuple[RecordSortOrder, str], Tuple[int, bytes]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(
+        self, order: RecordSortOrder, mimetype: str, version: int
+    ) -> Optional[bytes]:
+        """Return the cached body for a store version, counting the hit or miss"""
+        with self._lock:
+            cached = self._bodies.get((order, mimetype))
+            if cached is not None and cached[0] == version:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            return None
+
+    def caching(
+        self,
+        order: RecordSortOrder,
+        mimetype: str,
+        version: int,
+        chunks: Iterable[bytes],
+    ) -> Iterator[bytes]:
+        """Pass chunks of a body through and cache it once it is complete"""
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        body = b"".join(parts)
+        with self._lock:
+            cached = self._bodies.get((order, mimetype))
+            if cached is None or cached[0] < version:
+                self._bodies[(order, mimetype)] = (version, body)
+
+    def count_not_modified(self) -> None:
+        """Count a request answered with 304 because its etag was current"""
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Return the hit and miss counters"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def record_json(record: Record) -> bytes:
+    """Encode a record as json exactly the way jsonify encodes its to_dict
+
+    orjson is used when it is installed. It writes characters outside
+    printable ascii as they are where jsonify escapes them, so records
+    with any of those fall back to the json module.
+    """
+    if orjson is not None:
+        fragment = orjson.dumps(record.to_dict(), option=orjson.OPT_SORT_KEYS)
+        if fragment.isascii() and b"\x7f" not in fragment:
+            return fragment
+    return app.json.dumps(record.to_dict(), separators=(",", ":")).encode()
+
+
+# distinguishes the etags of this process from ones handed out by an earlier
+# process, whose store versions counted up from the same starting point
+ETAG_EPOCH = uuid.uuid4().hex[:12]
 
 
 class InvalidUsage(Exception):
@@ -42,6 +231,26 @@ def handle_invalid_usage(error):
     return response
 
 
+@app.before_request
+def start_request_timer():
+    """Note when a request started, for the request_seconds metric"""
+    if record_metrics.enabled:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response: Response) -> Response:
+    """Observe the time of a request once its response has been sent"""
+    start = g.get("request_start")
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "other"
+        labels = (route, request.method, str(response.status_code))
+        response.call_on_close(
+            lambda: request_seconds.observe(time.perf_counter() - start, labels)
+        )
+    return response
+
+
 @app.route("/records", methods=["POST"])
 def add_record():
     """Add a new person to the set of records
@@ -51,47 +260,688 @@ def add_record():
             'separator': ',',
             'record': 'LastName, FirstName, Gender, FavoriteColor, DateOfBirth'
         }
+
+    The response has every current record unless the return=record query
+    parameter is passed, in which case it only has the new record.
+
+    When records have an identity, see IDENTITY, the record replaces any
+    record with the same identity and the status is 200 rather than 201 if
+    there was one.
+    """
+    new_record, created = create_record(request.json)
+
+    status = 201 if created else 200
+    if request.args.get("return") == "record":
+        return jsonify(new_record.to_dict()), status
+    snapshot = current_records.snapshot()
+    return Response(
+        serialize_records(snapshot, JSON_MIMETYPE, snapshot),
+        status=status,
+        mimetype=JSON_MIMETYPE,
+    )
+
+
+@app.route("/records", methods=["PUT"])
+def put_record():
+    """Add a person or replace the record with the same identity
+
+    This method expects the same json as a POST to /records and returns the
+    record, with status 201 if it was added or 200 if it replaced a record.
+    Records must have an identity, see IDENTITY.
+    """
+    if current_records.identity is None:
+        raise InvalidUsage(IDENTITY_MISSING_MESSAGE, status_code=400)
+    new_record, created = create_record(request.json)
+    return jsonify(new_record.to_dict()), 201 if created else 200
+
+
+@app.route("/records", methods=["DELETE"])
+def delete_record():
+    """Delete the record with an identity
+
+    See delete_record_response
+    """
+    return delete_record_response(request)
+
+
+def delete_record_response(req: Request) -> Response:
+    """Build the response to deleting the record with an identity
+
+    Every field of the identity is passed as a query parameter, written the
+    same way as in a record, for example
+    /records?last_name=Trate&first_name=Josh&date_of_birth=08/14/1995. The
+    response has the deleted record, or is a 404 error if there is no record
+    with the identity.
     """
-    content = request.json
-    if content is None:
+    if current_records.identity is None:
+        raise InvalidUsage(IDENTITY_MISSING_MESSAGE, status_code=400)
+    identity = []
+    for field in current_records.identity:
+        try:
+            value = query_value(
+                req.args, field, functools.partial(parse_field_value, field)
+            )
+        except ValueError as e:
+            raise InvalidUsage(str(e), status_code=400)
+        if value is None:
+            raise InvalidUsage(f"{field} is missing", status_code=400)
+        identity.append(value)
+
+    deleted = current_records.delete(tuple(identity))
+    if deleted is None:
+        raise InvalidUsage("No record has this identity", status_code=404)
+    records_deleted.inc()
+    return jsonify(deleted.to_dict())
+
+
+def create_record(content: Optional[dict]) -> Tuple[Record, bool]:
+    """Parse the json payload of a POST to /records and add its record
+
+    When records have an identity the record is upserted, see IDENTITY.
+
+    Args:
+        content: decoded json payload
+    Returns:
+        (the record, whether it was added rather than replacing a record or
+        matching one that was already there)
+    Raises:
+        InvalidUsage if the payload is invalid
+    """
+    if not isinstance(content, dict):
         raise InvalidUsage("Invalid json palyload", status_code=400)
 
     separator = content.get("separator")
     record = content.get("record")
 
-    if separator is None or separator not in ",| ":
-        raise InvalidUsage(
-            "Separator is missing or not one of comma, pipe, or space", status_code=400
-        )
+    validate_separator(separator)
 
     if record is None:
         raise InvalidUsage("Record is missing", status_code=400)
 
     try:
-        global current_records
-        current_records = update_records(current_records, [record], separator)
+        new_record = parse_record(record, separator)
     except ValueError as e:
+        parse_errors.inc()
         raise InvalidUsage(str(e), status_code=400)
+    if current_records.identity is None:
+        current_records.add(new_record)
+        records_added.inc()
+        return new_record, True
+
+    previous = current_records.put(new_record)
+    if previous != new_record:
+        records_added.inc()
+        if previous is not None:
+            records_deleted.inc()
+    return new_record, previous is None
+
+
+@app.route("/records/bulk", methods=["POST"])
+def add_records_in_bulk():
+    """Add many records from a single streamed request
+
+    The separator of the records is passed as a query parameter, for example
+    /records/bulk?separator=, and the body is one of
+        - a json array of record strings, with content type application/json
+        - one json record string per line, with content type
+          application/x-ndjson
+        - one record per line, with any other content type
 
-    return jsonify([record.to_dict() for record in current_records]), 201
+    The body is parsed as it is read. Records that can't be parsed are
+    skipped, and the response summarizes what happened rather than
+    returning the records
+        {
+            'accepted': 2,
+            'errors': [{'line': 3, 'message': 'record ... does not have 5 fields'}]
+        }
+    where line is the line of the record in the body, or its position in
+    the array for json.
+    """
+    upload = BulkUpload(request.mimetype, request.args.get("separator"))
+    while True:
+        chunk = request.stream.read(STREAM_CHUNK_SIZE)
+        upload.feed(chunk, final=not chunk)
+        if not chunk:
+            break
+
+    return jsonify(upload.result()), 201
+
+
+class BulkUpload:
+    """Parses and adds the records of a bulk upload as its body arrives
+
+    The body is fed in one chunk at a time, so it never has to be held in
+    memory or read by a blocking stream. Records are added to the store in
+    batches of BULK_BATCH_SIZE.
+    """
+
+    def __init__(self, mimetype: str, separator: Optional[str]):
+        """Start an upload
+
+        Args:
+            mimetype: content type of the body
+            separator: separator of the records
+        Raises:
+            InvalidUsage if the separator is invalid
+        """
+        validate_separator(separator)
+        self.separator = separator
+        # items of a json array are decoded as the array is read, lines are
+        # decoded one at a time so a bad line doesn't stop the upload
+        if mimetype == JSON_MIMETYPE:
+            self._items, self._decode_item = JsonArrayDecoder(), None
+        elif mimetype == NDJSON_MIMETYPE:
+            self._items, self._decode_item = LineSplitter(), json.loads
+        else:
+            self._items, self._decode_item = LineSplitter(), bytes.decode
+        self.accepted = 0
+        self.errors: List[Dict] = []
+        self._batch: List[Record] = []
+
+    def feed(self, chunk: bytes, final: bool = False) -> None:
+        """Parse the records in the next chunk of the body
+
+        Args:
+            chunk: next chunk of the body
+            final: whether this is the end of the body
+        Raises:
+            InvalidUsage if the body itself is malformed, after adding the
+            records before the point it can't be read past
+        """
+        try:
+            for number, item in self._items.feed(chunk, final):
+                try:
+                    if self._decode_item is not None:
+                        item = self._decode_item(item)
+                    if not isinstance(item, str):
+                        raise ValueError(f"record {item!r} is not a string")
+                    self._batch.append(parse_record(item, self.separator))
+                except ValueError as e:
+                    parse_errors.inc()
+                    self.errors.append({"line": number, "message": str(e)})
+                if len(self._batch) >= BULK_BATCH_SIZE:
+                    self._flush()
+        except ValueError as e:
+            self._flush()
+            raise InvalidUsage(str(e), status_code=400, payload=self.result())
+        if final:
+            self._flush()
+
+    def _flush(self) -> None:
+        """Add the parsed records that haven't been added yet
+
+        When records have an identity they are upserted, see IDENTITY.
+        """
+        if current_records.identity is None:
+            current_records.extend(self._batch)
+            records_added.inc(len(self._batch))
+        else:
+            previous = current_records.upsert(self._batch)
+            replaced = [
+                old
+                for old, new in zip(previous, self._batch)
+                if old is not None and old != new
+            ]
+            records_deleted.inc(len(replaced))
+            records_added.inc(
+                sum(old != new for old, new in zip(previous, self._batch))
+            )
+        self.accepted += len(self._batch)
+        self._batch = []
+
+    def result(self) -> Dict:
+        """Return the summary of the upload sent back to the client"""
+        return {"accepted": self.accepted, "errors": self.errors}
 
 
 @app.route("/records/gender", methods=["GET"])
 def list_records_by_gender():
     """Get a json list of current records sorted by gender"""
-    sorted_records = records_sorted_by_gender_and_last_name(current_records)
-    return jsonify([record.to_dict() for record in sorted_records])
+    return sorted_records_response(
+        RecordSortOrder.GENDER_AND_LAST_NAME_ASCENDING, request
+    )
 
 
 @app.route("/records/birthdate", methods=["GET"])
 def list_records_by_birthdate():
     """Get a json list of current records sorted by birth date"""
-    sorted_records = records_sorted_by_date_of_birth(current_records)
-    return jsonify([record.to_dict() for record in sorted_records])
+    return sorted_records_response(RecordSortOrder.DATE_OF_BIRTH_ASCENDING, request)
 
 
 @app.route("/records/name", methods=["GET"])
 def list_records_by_last_name():
     """Get a json list of current records sorted by last name"""
-    sorted_records = records_sorted_by_last_name_descending(current_records)
-    return jsonify([record.to_dict() for record in sorted_records])
+    return sorted_records_response(RecordSortOrder.LAST_NAME_DESCENDING, request)
+
+
+def sorted_records_response(order: RecordSortOrder, req: Request) -> Response:
+    """Build the response listing the current records in the given order
+
+    The records can be paged through with the optional query parameters
+        - limit: maximum number of records to return
+        - offset: number of records to skip
+        - cursor: the X-Next-Cursor header of the previous page, to continue
+          right after it. The offset is counted from the cursor.
+        - top: the same as limit, to ask for the first records of the order
+        - from and to: only list records whose first sort field, such as the
+          last name for /records/name, is at least from and less than to.
+          Genders and dates are written the same way as in a record.
+    The X-Total-Count header has the total number of records in the range and
+    the X-Next-Cursor header is set when there are more records after the page.
+
+    The records are streamed as a json list, or as one json record per line
+    when the Accept header prefers application/x-ndjson.
+
+    Full responses are cached until the store changes. Every response has an
+    etag for the store version and the page parameters, and a request whose
+    If-None-Match has the current etag gets an empty 304 response.
+    """
+    limit = query_int(req.args, "limit")
+    top = query_int(req.args, "top")
+    if top is not None:
+        if limit is not None:
+            raise InvalidUsage("Pass either limit or top", status_code=400)
+        limit = top
+    offset = query_int(req.args, "offset") or 0
+    cursor = req.args.get("cursor")
+    if cursor is not None:
+        cursor = decode_cursor(order, cursor)
+    low = query_field_value(req.args, "from", order)
+    high = query_field_value(req.args, "to", order)
+    paged = (
+        limit is not None
+        or offset
+        or cursor is not None
+        or low is not None
+        or high is not None
+    )
+
+    mimetype = req.accept_mimetypes.best_match(
+        (JSON_MIMETYPE, NDJSON_MIMETYPE), default=JSON_MIMETYPE
+    )
+    snapshot = current_records.snapshot()
+    version = snapshot.version
+    subtype = mimetype.rsplit("/", 1)[1]
+    if paged:
+        # pages of the same version differ by the records they select
+        page = page_hash(limit, offset, cursor, low, high)
+        etag = f"{ETAG_EPOCH}-{order}-{subtype}-{page}-{version}"
+    else:
+        etag = f"{ETAG_EPOCH}-{order}-{subtype}-{version}"
+    if req.if_none_match.contains(etag):
+        response_cache.count_not_modified()
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.vary.add("Accept")
+        return response
+
+    body = None if paged else response_cache.get(order, mimetype, version)
+    next_cursor = None
+    if body is None:
+        try:
+            sorted_records, next_cursor = snapshot.page(
+                order, limit, offset, cursor, low, high
+            )
+        except ValueError as e:
+            raise InvalidUsage(str(e), status_code=400)
+        body = serialize_records(sorted_records, mimetype, snapshot)
+        if not paged:
+            body = response_cache.caching(order, mimetype, version, body)
+
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add("Accept")
+    response.headers["X-Total-Count"] = str(snapshot.count(order, low, high))
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = encode_cursor(order, next_cursor)
+    return response
+
+
+@app.route("/records/query", methods=["GET"])
+def query_records():
+    """Get a json list of the current records matching query parameters
+
+    See query_records_response
+    """
+    return query_records_response(request)
+
+
+def query_records_response(req: Request) -> Response:
+    """Build the response listing the current records that match a query
+
+    The records are selected with the optional query parameters
+        - gender: Female or Male
+        - color: favorite color
+        - born_after and born_before: dates of birth in MM/DD/YYYY format,
+          both exclusive
+        - order: one of the sort orders the records are listed in, such as
+          date_of_birth_ascending, insertion order by default
+    and streamed the same way as sorted_records_response. The X-Total-Count
+    header has the number of matching records and the X-Query-Index header
+    names the index the records were read from.
+    """
+    try:
+        query = RecordQuery(
+            gender=query_value(req.args, "gender", Gender),
+            favorite_color=req.args.get("color"),
+            born_after=query_value(req.args, "born_after", parse_date),
+            born_before=query_value(req.args, "born_before", parse_date),
+        )
+        order = query_value(req.args, "order", RecordSortOrder)
+    except ValueError as e:
+        raise InvalidUsage(str(e), status_code=400)
+
+    mimetype = req.accept_mimetypes.best_match(
+        (JSON_MIMETYPE, NDJSON_MIMETYPE), default=JSON_MIMETYPE
+    )
+    snapshot = current_records.snapshot()
+    index, _ = snapshot.plan(query)
+    records = snapshot.query(query)
+    if order is not None:
+        records = records_sorted_by_order(records, order)
+
+    response = Response(
+        serialize_records(records, mimetype, snapshot), mimetype=mimetype
+    )
+    response.vary.add("Accept")
+    response.headers["X-Total-Count"] = str(len(records))
+    response.headers["X-Query-Index"] = index or "none"
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Get the server and record_lib metrics in the Prometheus text format"""
+    return metrics_response()
+
+
+def metrics_response() -> Response:
+    """Build the response with every metric, see get_metrics"""
+    return Response(
+        record_metrics.default_registry.render(),
+        content_type=PROMETHEUS_CONTENT_TYPE,
+    )
+
+
+@app.route("/cache/stats", methods=["GET"])
+def get_cache_stats():
+    """Get the hit and miss counters of the sorted record response cache"""
+    return jsonify(response_cache.stats())
+
+
+def serialize_records(
+    records: Iterable[Record],
+    mimetype: str,
+    snapshot: Optional[RecordSnapshot] = None,
+) -> Iterator[bytes]:
+    """Lazily serialize records a chunk at a time
+
+    The json list is encoded the same way jsonify encodes it, just without
+    building the whole list of dicts and the whole string up front. Records
+    of a snapshot are encoded with record_json once for as long as they are
+    in the store, see RecordSnapshot.encoded, so a chunk is mostly a join of
+    encodings that were already rendered.
+
+    Args:
+        records: records to serialize
+        mimetype: JSON_MIMETYPE for a json list or NDJSON_MIMETYPE for one
+            json record per line
+        snapshot: snapshot the records were read from, if any
+    Yields:
+        consecutive chunks of the serialized records
+    """
+    records = iter(records)
+    timed = record_metrics.enabled
+    seconds = 0.0
+    if snapshot is None:
+        fragment = record_json
+    else:
+        encoded = snapshot.encoded
+
+        def fragment(record: Record) -> bytes:
+            return encoded(record, record_json)
+
+    ndjson = mimetype == NDJSON_MIMETYPE
+    separator = b"\n" if ndjson else b","
+    if not ndjson:
+        yield b"["
+
+    first_chunk = True
+    while True:
+        start = time.perf_counter() if timed else 0.0
+        chunk = separator.join(
+            map(fragment, itertools.islice(records, RESPONSE_CHUNK_RECORDS))
+        )
+        if timed:
+            seconds += time.perf_counter() - start
+        if not chunk:
+            break
+        if ndjson:
+            yield chunk + b"\n"
+        else:
+            yield chunk if first_chunk else b"," + chunk
+        first_chunk = False
+
+    if not ndjson:
+        yield b"]\n"
+    serialize_seconds.observe(seconds)
+
+
+def validate_separator(separator: str) -> None:
+    """Raise InvalidUsage unless the separator is one records can use"""
+    if separator is None or separator not in ",| ":
+        raise InvalidUsage(
+            "Separator is missing or not one of comma, pipe, or space", status_code=400
+        )
+
+
+class LineSplitter:
+    """Splits a body fed a chunk at a time into its non blank lines"""
+
+    def __init__(self):
+        """Start before the first line"""
+        self._partial = b""
+        self._number = 0
+
+    def feed(self, chunk: bytes, final: bool = False) -> Iterator[Tuple[int, bytes]]:
+        """Lazily split the lines completed by the next chunk
+
+        Args:
+            chunk: next chunk of the body
+            final: whether this is the end of the body
+        Yields:
+            (line number, line) of each non blank line
+        """
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = b"" if final else lines.pop()
+        for line in lines:
+            self._number += 1
+            if line.strip():
+                yield self._number, line
+
+
+class JsonArrayDecoder:
+    """Decodes the items of a json array fed a chunk at a time
+
+    Only one item at a time, plus whatever is left of the current chunk, is
+    held in memory.
+    """
+
+    def __init__(self):
+        """Start before the opening bracket of the array"""
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._position = 0
+        # what comes next: "[" to open the array, the first item or "]" for
+        # an empty array, "," or "]" after an item, an item after a "," or
+        # only whitespace once the array is closed
+        self._expecting = "["
+        self._number = 0
+
+    def feed(self, chunk: bytes, final: bool = False) -> Iterator[Tuple[int, object]]:
+        """Lazily decode the items completed by the next chunk
+
+        Args:
+            chunk: next chunk of the body
+            final: whether this is the end of the body
+        Yields:
+            (position in the array starting from 1, decoded item) of each item
+        Raises:
+            ValueError if the body is not a json array
+        """
+        self._buffer = self._buffer[self._position :] + self._text_decoder.decode(
+            chunk, final=final
+        )
+        self._position = 0
+        buffer = self._buffer
+
+        while True:
+            position = self._position
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            self._position = position
+            if position == len(buffer):
+                if final and self._expecting != "done":
+                    raise ValueError("Unexpected end of json array")
+                return
+
+            character = buffer[position]
+            if self._expecting == "done":
+                raise ValueError("Unexpected data after json array")
+            elif self._expecting == "[":
+                if character != "[":
+                    raise ValueError("Body is not a json array")
+                self._position += 1
+                self._expecting = "first item"
+            elif self._expecting in ("first item", "separator") and character == "]":
+                self._position += 1
+                self._expecting = "done"
+            elif self._expecting == "separator":
+                if character != ",":
+                    raise ValueError(f"Expected ',' or ']' after item {self._number}")
+                self._position += 1
+                self._expecting = "item"
+            else:
+                try:
+                    item, end = self._decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError as e:
+                    if final or not _cut_off(e):
+                        raise ValueError(f"Invalid json for item {self._number + 1}")
+                    # the rest of the item is in the next chunk
+                    return
+                if not final and _may_continue(item, buffer[end:]):
+                    # a number may continue in the next chunk
+                    return
+                self._number += 1
+                self._position = end
+                self._expecting = "separator"
+                yield self._number, item
+
+
+# values json spells out in letters, which may be cut off part way
+_JSON_LITERALS = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+
+
+def _cut_off(error: json.JSONDecodeError) -> bool:
+    """Return whether decoding failed only because the document ends too soon
+
+    Decoding stops at the first character that can't be part of the value,
+    which is the end of the document when the value is just cut off, except
+    for strings and escapes, which are reported from where they start, and
+    literals, which are reported from their first letter.
+    """
+    rest = error.doc[error.pos :]
+    if not rest or error.msg.startswith("Unterminated string"):
+        return True
+    if error.msg.startswith("Invalid \\uXXXX escape"):
+        # the position is the u of an escape the document ends in, or that the
+        # document ends right after when the string is cut off there
+        return len(rest) <= 5
+    return error.msg == "Expecting value" and any(
+        literal.startswith(rest) for literal in _JSON_LITERALS
+    )
+
+
+def _may_continue(item: object, rest: str) -> bool:
+    """Return whether a decoded item may continue in the rest of the document
+
+    Only numbers do, when nothing but the start of their fraction or exponent
+    follows them, as in 1. or 1e-.
+    """
+    if isinstance(item, bool) or not isinstance(item, (int, float)):
+        return False
+    return all(character in ".eE+-0123456789" for character in rest)
+
+
+def query_int(args: Mapping[str, str], name: str) -> Optional[int]:
+    """Return a non negative integer query parameter, if it was passed"""
+    value = args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise InvalidUsage(f"{name} must be a non negative integer", status_code=400)
+    return int(value)
+
+
+def query_value(args: Mapping[str, str], name: str, parse: Callable):
+    """Return a query parameter parsed with parse, if it was passed
+
+    Raises:
+        ValueError if the parameter can't be parsed
+    """
+    text = args.get(name)
+    if text is None:
+        return None
+    try:
+        return parse(text)
+    except ValueError as e:
+        raise ValueError(f"Invalid {name}: {e}") from None
+
+
+def query_field_value(args: Mapping[str, str], name: str, order: RecordSortOrder):
+    """Return a query parameter parsed as a value of the range field of an order"""
+    try:
+        return query_value(
+            args, name, functools.partial(parse_field_value, range_field(order))
+        )
+    except ValueError as e:
+        raise InvalidUsage(str(e), status_code=400)
+
+
+def page_hash(limit, offset, cursor, low, high) -> str:
+    """Return a short hash of the parsed parameters selecting a page
+
+    Parameters that select the same records hash the same, such as top and
+    limit, or an offset of 0 and no offset.
+    """
+    text = repr((limit, offset, cursor, low, high))
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+def encode_cursor(order: RecordSortOrder, cursor: Tuple) -> str:
+    """Encode a cursor from the record store as an opaque string"""
+    text = json.dumps([order.value, cursor], separators=(",", ":"))
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def decode_cursor(order: RecordSortOrder, cursor: str) -> Tuple:
+    """Decode a cursor made by encode_cursor for the given order
+
+    Raises:
+        InvalidUsage if the cursor is malformed or belongs to another order
+    """
+    try:
+        cursor_order, position = json.loads(base64.urlsafe_b64decode(cursor))
+    except (binascii.Error, ValueError, TypeError):
+        raise InvalidUsage("Invalid cursor", status_code=400)
+    if cursor_order != order.value:
+        raise InvalidUsage(f"Cursor is not for sort order {order}", status_code=400)
+    return _lists_to_tuples(position)
+
+
+def _lists_to_tuples(value):
+    """Turn lists back into the tuples they were before being encoded as json"""
+    if isinstance(value, list):
+        return tuple(_lists_to_tuples(item) for item in value)
+    return value
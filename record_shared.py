@@ -0,0 +1,507 @@
+import argparse
+import gc
+import io
+import multiprocessing
+import pickle
+import signal
+import socket
+import struct
+import sys
+import threading
+import uuid
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from werkzeug.serving import make_server
+
+import record_server
+from record_lib import Record, RecordSnapshot, RecordStore, SnapshotChanges
+
+# Runs record_server in several worker processes that share one store, for
+# example with `python record_shared.py --workers 4 --port 5000`, so reads
+# are served by every core while every worker sees the same records.
+#
+# The process that launches the workers is the single writer. It holds the
+# RecordStore, along with its log when RECORD_SERVER_DATA_DIR is set, and
+# publishes every version of it to shared memory. Every so often a version is
+# written in full as a base segment, holding the records in columns along with
+# every index and the json of every record, see RecordSnapshot.write_columns,
+# so workers don't encode them again. Each version is written to a segment of
+# its own holding its changes since the base, and a small control segment
+# holds the latest version. Workers serve reads straight from the base
+# segment, building only the records a request returns, with the changes since
+# laid over it, see RecordSnapshot.with_changes. They send their changes to
+# the writer, which applies them and publishes the next version before
+# replying.
+#
+# Publishing a version costs about as much as the changes since the base,
+# about a millisecond for a single change. Once they reach a share of the
+# records a new base is written instead, which takes time proportional to
+# the number of records, about 0.5s for 200,000 of them, and changes that
+# arrive while one is written wait for it. The first base also encodes every
+# record, about 2s more for 200,000, while later ones only encode the records
+# added since.
+
+# header of a base segment: magic and store version, followed by the columns
+# of the snapshot
+_BASE_MAGIC = b"RECSHB04"
+_BASE_HEADER = struct.Struct("<8sQ")
+
+# header of the segment of a version: magic, version and version of its base
+# segment, followed by the pickled changes since the base unless the version
+# is the base
+_SEGMENT_MAGIC = b"RECSHV04"
+_SEGMENT_HEADER = struct.Struct("<8sQQ")
+
+# a new base is written once the records removed and added since the last
+# one reach this share of it, with at least _MIN_CHANGES of them, so that
+# workers lay few changes over the base on each version
+_REBASE_FRACTION = 1 / 32
+_MIN_CHANGES = 1024
+
+# the control segment: version of the latest published segment
+_CONTROL = struct.Struct("<Q")
+
+# store methods workers can call through the writer
+WRITE_METHODS = ("extend", "upsert", "delete")
+
+
+def segment_name(name: str, version: int) -> str:
+    """Return the name of the shared memory segment of a published version"""
+    return f"{name}.{version}"
+
+
+def base_segment_name(name: str, version: int) -> str:
+    """Return the name of the base segment of a version, see RecordPublisher"""
+    return f"{name}.{version}.base"
+
+
+class RecordPublisher:
+    """Publishes the snapshots of a RecordStore to shared memory
+
+    Some versions are written in full to a base segment, and each version is
+    written to a segment holding its changes since the latest base. Its
+    version is written to the control segment once its segments are
+    complete, so readers never see a partly written version. The segments of
+    the previous version are unlinked right away, and readers that already
+    attached to them keep reading them.
+    """
+
+    def __init__(self, name: str, encode: Optional[Callable[[Record], bytes]] = None):
+        """Create the control segment of a shared store
+
+        Args:
+            name: name of the shared store
+            encode: function encoding a record, such as its json, to publish
+                the encoding of each record along with it, see
+                RecordSnapshot.write_columns
+        Raises:
+            FileExistsError: if a shared store with the name already exists
+        """
+        self.name = name
+        self._encode = encode
+        self._control = shared_memory.SharedMemory(
+            name, create=True, size=_CONTROL.size
+        )
+        self._segment: Optional[shared_memory.SharedMemory] = None
+        self._base: Optional[RecordSnapshot] = None
+        self._base_segment: Optional[shared_memory.SharedMemory] = None
+        self.version: Optional[int] = None
+
+    def publish(self, snapshot: RecordSnapshot) -> None:
+        """Publish a snapshot, unless its version is the one already published"""
+        if snapshot.version == self.version:
+            return
+        changes = None
+        if self._base is not None:
+            limit = max(_MIN_CHANGES, int(len(self._base) * _REBASE_FRACTION))
+            changes = snapshot.changes_since(self._base, limit, self._encode)
+        replaced = [self._segment]
+        if changes is None:
+            file = io.BytesIO()
+            write_base_segment(file, snapshot, self._encode)
+            replaced.append(self._base_segment)
+            self._base_segment = self._create(
+                base_segment_name(self.name, snapshot.version), file.getvalue()
+            )
+            self._base = snapshot
+
+        file = io.BytesIO()
+        write_segment(file, snapshot.version, self._base.version, changes)
+        self._segment = self._create(
+            segment_name(self.name, snapshot.version), file.getvalue()
+        )
+        _CONTROL.pack_into(self._control.buf, 0, snapshot.version)
+        self.version = snapshot.version
+        for segment in replaced:
+            if segment is not None:
+                segment.unlink()
+
+    @staticmethod
+    def _create(name: str, data: bytes) -> shared_memory.SharedMemory:
+        """Create a segment holding data, which is closed but not unlinked"""
+        segment = shared_memory.SharedMemory(name, create=True, size=len(data))
+        segment.buf[: len(data)] = data
+        segment.close()
+        return segment
+
+    def close(self) -> None:
+        """Unlink the shared store, readers can't attach to it afterwards"""
+        for segment in (self._segment, self._base_segment):
+            if segment is not None:
+                segment.unlink()
+        self._segment = self._base_segment = None
+        self._base = None
+        self._control.close()
+        self._control.unlink()
+
+
+def write_base_segment(
+    file: io.BufferedIOBase,
+    snapshot: RecordSnapshot,
+    encode: Optional[Callable[[Record], bytes]] = None,
+) -> None:
+    """Write a snapshot in the format of a base segment
+
+    Args:
+        file: binary file to write the segment to
+        snapshot: snapshot to write
+        encode: function encoding a record, see RecordSnapshot.write_columns
+    """
+    file.write(_BASE_HEADER.pack(_BASE_MAGIC, snapshot.version))
+    snapshot.write_columns(file, encode)
+
+
+def read_base_segment(
+    buffer, version: int, close: Optional[Callable[[], None]] = None
+) -> RecordSnapshot:
+    """Open the snapshot written to a buffer by write_base_segment
+
+    The snapshot reads its records from the buffer whenever they are read,
+    see RecordSnapshot.from_columns, so the buffer must outlive it.
+
+    Args:
+        buffer: buffer holding the segment
+        version: version the segment was written as
+        close: called once nothing reads from the buffer anymore
+    Raises:
+        ValueError: if the buffer doesn't hold the whole base segment of version
+    """
+    magic, segment_version = _BASE_HEADER.unpack_from(buffer)
+    if magic != _BASE_MAGIC or segment_version != version:
+        raise ValueError(f"Not the base segment of version {version}")
+    snapshot, _ = RecordSnapshot.from_columns(version, buffer, _BASE_HEADER.size, close)
+    return snapshot
+
+
+def write_segment(
+    file: io.BufferedIOBase,
+    version: int,
+    base_version: int,
+    changes: Optional[SnapshotChanges],
+) -> None:
+    """Write the segment of a version
+
+    Args:
+        file: binary file to write the segment to
+        version: version of the segment
+        base_version: version of the base segment the changes apply to
+        changes: changes since the base, None if the version is the base
+    """
+    file.write(_SEGMENT_HEADER.pack(_SEGMENT_MAGIC, version, base_version))
+    if changes is not None:
+        pickle.dump(changes, file, pickle.HIGHEST_PROTOCOL)
+
+
+def read_segment(buffer, version: int) -> Tuple[int, Optional[SnapshotChanges]]:
+    """Read the segment written to a buffer by write_segment
+
+    Returns:
+        (version of the base segment, changes since the base or None if the
+        version is the base)
+    Raises:
+        ValueError: if the buffer doesn't hold the segment of version
+    """
+    magic, segment_version, base_version = _SEGMENT_HEADER.unpack_from(buffer)
+    if magic != _SEGMENT_MAGIC or segment_version != version:
+        raise ValueError(f"Not the published segment of version {version}")
+    if base_version == version:
+        return base_version, None
+    with memoryview(buffer) as view, view[_SEGMENT_HEADER.size :] as data:
+        return base_version, pickle.loads(data)
+
+
+class SharedRecordStore:
+    """Store of a worker process, backed by the versions a writer publishes
+
+    It has the methods of RecordStore that record_server uses. Snapshots read
+    the base segment of the latest published version from shared memory,
+    without copying it, with the changes since laid over it, and a base
+    segment is detached once no snapshot reading it is left. Changes
+    are sent to the writer, which publishes a version including them before
+    replying, so once a change returns every worker reads it.
+
+    The store is safe to use from many threads.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        connection: Connection,
+        identity: Optional[Sequence[str]] = None,
+    ):
+        """Attach to a shared store
+
+        Args:
+            name: name of the shared store
+            connection: connection to the writer, see apply_changes
+            identity: identity of the writer's store
+        Raises:
+            FileNotFoundError: if there is no shared store with the name
+        """
+        self.name = name
+        self.identity = tuple(identity) if identity else None
+        self._connection = connection
+        self._control = shared_memory.SharedMemory(name)
+        self._snapshot: Optional[RecordSnapshot] = None
+        self._base: Optional[RecordSnapshot] = None
+        self._load_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def snapshot(self) -> RecordSnapshot:
+        """Return an immutable view of the latest published records"""
+        version = self._published_version()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._load_lock:
+            if self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = self._load()
+            return self._snapshot
+
+    def _published_version(self) -> int:
+        """Return the version in the control segment"""
+        return _CONTROL.unpack_from(self._control.buf)[0]
+
+    def _load(self) -> RecordSnapshot:
+        """Attach to the latest published version
+
+        The writer unlinks the segments of a version as soon as it publishes
+        the next one, so a segment that is gone is retried with the version
+        that replaced it.
+        """
+        while True:
+            version = self._published_version()
+            try:
+                base_version, changes = self._read(version)
+                base = self._base
+                if base is None or base.version != base_version:
+                    base = self._attach_base(base_version)
+            except FileNotFoundError:
+                if self._published_version() == version:
+                    raise
+                continue
+            self._base = base
+            if changes is None:
+                return base
+            return base.with_changes(version, changes)
+
+    def _read(self, version: int) -> Tuple[int, Optional[SnapshotChanges]]:
+        """Read the segment of a version, see read_segment"""
+        segment = shared_memory.SharedMemory(segment_name(self.name, version))
+        try:
+            return read_segment(segment.buf, version)
+        finally:
+            segment.close()
+
+    def _attach_base(self, version: int) -> RecordSnapshot:
+        """Attach to a base segment, which is closed with its last snapshot"""
+        segment = shared_memory.SharedMemory(base_segment_name(self.name, version))
+        try:
+            return read_base_segment(segment.buf, version, segment.close)
+        except ValueError:
+            segment.close()
+            raise
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    def __iter__(self) -> Iterator[Record]:
+        return iter(self.snapshot())
+
+    @property
+    def version(self) -> int:
+        """Version of the latest published records"""
+        return self.snapshot().version
+
+    def add(self, record: Record) -> None:
+        """Add a single record, see RecordStore.add"""
+        self.extend((record,))
+
+    def extend(self, records: Sequence[Record]) -> None:
+        """Add records, see RecordStore.extend"""
+        self._call("extend", list(records))
+
+    def put(self, record: Record) -> Optional[Record]:
+        """Upsert a record by its identity, see RecordStore.put"""
+        return self.upsert((record,))[0]
+
+    def upsert(self, records: Sequence[Record]) -> List[Optional[Record]]:
+        """Upsert records by their identity, see RecordStore.upsert"""
+        return self._call("upsert", list(records))
+
+    def delete(self, identity: tuple) -> Optional[Record]:
+        """Delete the record with an identity, see RecordStore.delete"""
+        return self._call("delete", tuple(identity))
+
+    def _call(self, method: str, argument):
+        """Call a method of the writer's store and return its result
+
+        Raises:
+            whatever the method raised in the writer, such as ValueError
+        """
+        with self._write_lock:
+            self._connection.send((method, argument))
+            result, error = self._connection.recv()
+        if error is not None:
+            raise error
+        return result
+
+    def close(self) -> None:
+        """Detach from the shared store and the writer"""
+        self._connection.close()
+        self._control.close()
+
+
+def apply_changes(
+    store: RecordStore, publisher: RecordPublisher, connections: List[Connection]
+) -> None:
+    """Apply the changes sent by workers until they have all disconnected
+
+    Every change that is waiting is applied before the resulting version is
+    published once, so a burst of changes from many workers shares the cost
+    of publishing. Each worker gets its reply after the publication, with
+    the exception the change raised if it failed.
+
+    Args:
+        store: store to apply the changes to
+        publisher: publisher of the store's versions
+        connections: connection to each worker, see SharedRecordStore
+    """
+    connections = list(connections)
+    while connections:
+        replies: List[Tuple[Connection, tuple]] = []
+        for connection in wait(connections):
+            try:
+                method, argument = connection.recv()
+            except EOFError:
+                connections.remove(connection)
+                continue
+            try:
+                if method not in WRITE_METHODS:
+                    raise ValueError(f"Unknown store method {method}")
+                replies.append((connection, (getattr(store, method)(argument), None)))
+            except Exception as e:
+                replies.append((connection, (None, e)))
+
+        publisher.publish(store.snapshot())
+        for connection, reply in replies:
+            try:
+                connection.send(reply)
+            except OSError:
+                connections.remove(connection)
+
+
+def serve(host: str, port: int, workers: int) -> None:
+    """Serve record_server from worker processes sharing its store
+
+    This process becomes the writer of record_server.current_records and
+    forks the workers, which all accept connections on the same socket.
+    It returns once every worker has exited, or when it is interrupted or
+    terminated, in which case it stops the workers first.
+
+    Args:
+        host: address to listen on
+        port: port to listen on, any free port if 0
+        workers: number of worker processes
+    """
+    store = record_server.current_records
+    context = multiprocessing.get_context("fork")
+    publisher = RecordPublisher(
+        f"records-{uuid.uuid4().hex[:12]}", record_server.record_json
+    )
+    processes = []
+    # terminating the writer stops the workers and unlinks the shared store
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        publisher.publish(store.snapshot())
+        with socket.create_server((host, port)) as listener:
+            connections = []
+            for _ in range(workers):
+                writer_end, worker_end = context.Pipe()
+                process = context.Process(
+                    target=_serve_worker,
+                    args=(listener, publisher.name, worker_end, store.identity),
+                    daemon=True,
+                )
+                process.start()
+                worker_end.close()
+                processes.append(process)
+                connections.append(writer_end)
+            host, port = listener.getsockname()[:2]
+            print(f" * Running on http://{host}:{port} with {workers} workers")
+            sys.stdout.flush()
+        apply_changes(store, publisher, connections)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        store.close()
+        publisher.close()
+
+
+def _serve_worker(
+    listener: socket.socket,
+    name: str,
+    connection: Connection,
+    identity: Optional[Sequence[str]],
+) -> None:
+    """Serve record_server from the shared store in a worker process"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # the records forked along with the writer are never read here, so the
+    # collector can leave them be
+    gc.freeze()
+    record_server.current_records = SharedRecordStore(name, connection, identity)
+    host, port = listener.getsockname()[:2]
+    server = make_server(
+        host, port, record_server.app, threaded=True, fd=listener.fileno()
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve record_server from worker processes sharing one store."
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument(
+        "--port", type=int, default=5000, help="port to listen on, any free one if 0"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of worker processes (default: number of cpus)",
+    )
+    args = parser.parse_args()
+    if args.workers <= 0:
+        parser.error(f"argument --workers: {args.workers} is not a positive integer")
+    serve(args.host, args.port, args.workers)
@@ -9,14 +9,26 @@ fi
 
 CLI_COMMAND="python ${PROJECT_ROOT}/record_cli.py"
 
+CACHE_DIR=$(mktemp -d)
+trap 'rm -rf "$CACHE_DIR"' EXIT
+
 for test_directory in test_cases/*/; do
     echo "----$test_directory----"
 
-    $CLI_COMMAND "$test_directory/comma_separated.txt" \
-    "$test_directory/pipe_separated.txt" \
-    "$test_directory/space_separated.txt" \
-    $(cat $test_directory/order.txt) | \
-    diff "$test_directory/expected_output.txt" -
+    extra_args=""
+    if [[ -f "$test_directory/args.txt" ]]; then
+        extra_args=$(cat "$test_directory/args.txt")
+    fi
+
+    # the first run parses the files and caches their records, the second
+    # reads them from the cache
+    for run in 1 2; do
+        $CLI_COMMAND "$test_directory/comma_separated.txt" \
+        "$test_directory/pipe_separated.txt" \
+        "$test_directory/space_separated.txt" \
+        $(cat $test_directory/order.txt) --cache-dir "$CACHE_DIR" $extra_args | \
+        diff "$test_directory/expected_output.txt" -
+    done
 
 done
 
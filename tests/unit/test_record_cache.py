@@ -0,0 +1,114 @@
+import datetime
+import os
+import tempfile
+from unittest import TestCase
+
+from record_cache import cache_key, cache_path, load_cache, write_cache
+from record_lib import (
+    Gender,
+    Record,
+    RecordSortOrder,
+    RecordTable,
+    records_sorted_by_order,
+)
+
+
+class TestRecordCache(TestCase):
+    records = [
+        Record("Trate", "Josh", Gender.MALE, "green", datetime.date(1995, 8, 14)),
+        Record("Smith", "Josh", Gender.MALE, "blue", datetime.date(1997, 9, 1)),
+        Record("Zwicki", "Allison", Gender.FEMALE, "brown", datetime.date(2001, 6, 5)),
+        Record("Smith", "David", Gender.MALE, "red", datetime.date(1995, 8, 14)),
+        Record("Ångström", "Zoë", Gender.FEMALE, "grün", datetime.date(1, 1, 1)),
+    ]
+    widths = [8, 7, 6, 5, 10]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dir = os.path.join(directory.name, "cache")
+        self.record_files = []
+        for name, delimiter in (("comma.txt", ","), ("pipe.txt", "|")):
+            path = os.path.join(directory.name, name)
+            with open(path, "w") as file:
+                file.write(f"Trate {delimiter} Josh {delimiter} Male\n")
+            self.record_files.append((path, delimiter))
+
+    def write(self):
+        key = cache_key(self.record_files)
+        table = RecordTable(self.records)
+        rows = {order: table.argsort(order) for order in RecordSortOrder}
+        write_cache(self.cache_dir, key, table, rows, self.widths)
+
+    def test_load_cache__sorted_records(self):
+        self.write()
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                cached = load_cache(self.cache_dir, cache_key(self.record_files), order)
+                self.assertListEqual(list(cached.table), self.records)
+                self.assertListEqual(
+                    [cached.table[row] for row in cached.rows],
+                    records_sorted_by_order(self.records, order),
+                )
+                self.assertListEqual(cached.widths, self.widths)
+
+    def test_load_cache__missing(self):
+        key = cache_key(self.record_files)
+        self.assertIsNone(
+            load_cache(self.cache_dir, key, RecordSortOrder.LAST_NAME_DESCENDING)
+        )
+
+    def test_load_cache__changed_files(self):
+        self.write()
+        path, _ = self.record_files[1]
+        with open(path, "a") as file:
+            file.write("Smith | Josh | Male\n")
+        key = cache_key(self.record_files)
+        self.assertIsNone(
+            load_cache(self.cache_dir, key, RecordSortOrder.LAST_NAME_DESCENDING)
+        )
+
+    def test_load_cache__other_delimiter(self):
+        self.write()
+        self.record_files[1] = (self.record_files[1][0], " ")
+        key = cache_key(self.record_files)
+        self.assertIsNone(
+            load_cache(self.cache_dir, key, RecordSortOrder.LAST_NAME_DESCENDING)
+        )
+
+    def test_load_cache__corrupt(self):
+        self.write()
+        key = cache_key(self.record_files)
+        path = cache_path(self.cache_dir, key)
+        with open(path, "rb") as file:
+            data = file.read()
+        for corrupt in (b"", data[:10], data[:-1], b"X" + data[1:]):
+            with self.subTest(size=len(corrupt)):
+                with open(path, "wb") as file:
+                    file.write(corrupt)
+                self.assertIsNone(
+                    load_cache(
+                        self.cache_dir, key, RecordSortOrder.LAST_NAME_DESCENDING
+                    )
+                )
+
+    def test_write_cache__replaces_stale_cache(self):
+        self.write()
+        path, _ = self.record_files[0]
+        os.utime(path, ns=(0, 0))
+        self.write()
+        self.assertEqual(
+            os.listdir(self.cache_dir),
+            [
+                os.path.basename(
+                    cache_path(self.cache_dir, cache_key(self.record_files))
+                )
+            ],
+        )
+        self.assertIsNotNone(
+            load_cache(
+                self.cache_dir,
+                cache_key(self.record_files),
+                RecordSortOrder.DATE_OF_BIRTH_ASCENDING,
+            )
+        )
@@ -0,0 +1,143 @@
+import datetime
+import os
+import tempfile
+from unittest import TestCase
+
+from record_lib import Gender, Record, RecordSortOrder, records_sorted_by_order
+from record_log import (
+    RecordLog,
+    SNAPSHOT_FILE_NAME,
+    log_generations,
+    log_path,
+    open_store,
+)
+
+
+class TestRecordLog(TestCase):
+    records = [
+        Record("Trate", "Josh", Gender.MALE, "green", datetime.date(1995, 8, 14)),
+        Record("Smith", "Josh", Gender.MALE, "blue", datetime.date(1997, 9, 1)),
+        Record("Zwicki", "Allison", Gender.FEMALE, "brown", datetime.date(2001, 6, 5)),
+        Record("Smith", "David", Gender.MALE, "red", datetime.date(1995, 8, 14)),
+        Record("Ångström", "Zoë", Gender.FEMALE, "grün", datetime.date(1, 1, 1)),
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def assert_store_matches(self, store, records):
+        self.assertListEqual(list(store), records)
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                self.assertListEqual(
+                    store.sorted_by(order), records_sorted_by_order(records, order)
+                )
+
+    def test_open_store__replays_log(self):
+        store = open_store(self.directory.name)
+        store.extend(self.records[:2])
+        for record in self.records[2:]:
+            store.add(record)
+        store.close()
+
+        restored = open_store(self.directory.name)
+        self.assert_store_matches(restored, self.records)
+        restored.close()
+
+    def test_open_store__loads_snapshot_and_replays_tail(self):
+        store = open_store(self.directory.name, snapshot_records=4)
+        for record in self.records * 3:
+            store.add(record)
+        store.close()
+        self.assertTrue(
+            os.path.exists(os.path.join(self.directory.name, SNAPSHOT_FILE_NAME))
+        )
+        # the snapshot replaced every log but the one written after it
+        self.assertEqual(len(log_generations(self.directory.name)), 1)
+
+        restored = open_store(self.directory.name)
+        self.assert_store_matches(restored, self.records * 3)
+        restored.add(self.records[0])
+        restored.close()
+
+        restored = open_store(self.directory.name, durability="never")
+        self.assert_store_matches(restored, self.records * 3 + self.records[:1])
+        restored.close()
+
+    def test_open_store__drops_torn_batch(self):
+        store = open_store(self.directory.name, durability="interval")
+        store.extend(self.records[:3])
+        store.extend(self.records[3:])
+        store.close()
+        (generation,) = log_generations(self.directory.name)
+        path = log_path(self.directory.name, generation)
+        os.truncate(path, os.path.getsize(path) - 1)
+
+        restored = open_store(self.directory.name)
+        self.assert_store_matches(restored, self.records[:3])
+        restored.add(self.records[4])
+        restored.close()
+
+        restored = open_store(self.directory.name)
+        self.assert_store_matches(restored, self.records[:3] + self.records[4:])
+        restored.close()
+
+    def test_open_store__replays_removals(self):
+        identity = ("last_name", "first_name")
+        replacement = self.records[1]._replace(favorite_color="teal")
+        store = open_store(self.directory.name, snapshot_records=4, identity=identity)
+        store.extend(self.records)
+        store.put(replacement)
+        store.delete(("Zwicki", "Allison"))
+        store.close()
+        expected = [self.records[0], *self.records[3:], replacement]
+
+        restored = open_store(self.directory.name, identity=identity)
+        self.assert_store_matches(restored, expected)
+        self.assertEqual(restored.get(("Smith", "Josh")), replacement)
+        restored.delete(("Trate", "Josh"))
+        restored.close()
+
+        # the log replays the same records whatever the identity
+        restored = open_store(self.directory.name)
+        self.assert_store_matches(restored, expected[1:])
+        restored.close()
+
+    def test_open_store__sequence_numbers_not_reused(self):
+        identity = ("last_name", "first_name")
+        store = open_store(self.directory.name, identity=identity)
+        store.extend(self.records[:3])
+        store.delete(("Zwicki", "Allison"))
+        store.add(self.records[3])
+        store.close()
+        expected = list(store.snapshot().sequenced())
+        # the deleted record's sequence number is not given to the next one
+        self.assertListEqual([sequence for sequence, _ in expected], [0, 1, 3])
+
+        restored = open_store(self.directory.name, identity=identity)
+        self.assertListEqual(list(restored.snapshot().sequenced()), expected)
+        restored.close()
+
+    def test_open_store__snapshot_keeps_next_sequence(self):
+        identity = ("last_name", "first_name")
+        store = open_store(self.directory.name, snapshot_records=6, identity=identity)
+        store.extend(self.records)
+        # the deletion fills the log, so the snapshot is taken right after it
+        store.delete(("Ångström", "Zoë"))
+        store.close()
+        self.assertEqual(log_generations(self.directory.name), [1])
+
+        restored = open_store(self.directory.name, identity=identity)
+        self.assertEqual(restored.snapshot().next_sequence(), 5)
+        restored.close()
+
+    def test_record_log__unknown_durability(self):
+        with self.assertRaises(ValueError):
+            RecordLog(self.directory.name, 0, durability="sometimes")
+
+    def test_open_store__not_a_snapshot(self):
+        with open(os.path.join(self.directory.name, SNAPSHOT_FILE_NAME), "wb") as f:
+            f.write(b"not a snapshot at all, not even close to one")
+        with self.assertRaises(ValueError):
+            open_store(self.directory.name)
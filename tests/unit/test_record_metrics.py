@@ -0,0 +1,114 @@
+import io
+import time
+from unittest import TestCase
+
+import record_metrics
+from record_lib import (
+    RecordSortOrder,
+    parse_date,
+    records_sorted_by_order,
+    update_records,
+)
+from record_metrics import Counter, Gauge, Histogram, Profile, Registry
+
+
+class TestRecordMetrics(TestCase):
+    def setUp(self):
+        enabled = record_metrics.enabled
+        self.addCleanup(setattr, record_metrics, "enabled", enabled)
+        record_metrics.enabled = True
+        self.registry = Registry()
+
+    def test_render__prometheus_text_format(self):
+        counter = Counter("parsed_total", "Parsed", ("order",), self.registry)
+        Gauge("size", "Size", registry=self.registry, function=lambda: 3)
+        histogram = Histogram(
+            "seconds", "Seconds", registry=self.registry, buckets=(0.1, 1)
+        )
+        counter.inc(2, ('a"b',))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEqual(
+            self.registry.render(),
+            "# HELP parsed_total Parsed\n"
+            "# TYPE parsed_total counter\n"
+            'parsed_total{order="a\\"b"} 2\n'
+            "# HELP size Size\n"
+            "# TYPE size gauge\n"
+            "size 3\n"
+            "# HELP seconds Seconds\n"
+            "# TYPE seconds histogram\n"
+            'seconds_bucket{le="0.1"} 1\n'
+            'seconds_bucket{le="1"} 2\n'
+            'seconds_bucket{le="+Inf"} 3\n'
+            "seconds_sum 5.55\n"
+            "seconds_count 3\n",
+        )
+
+    def test_register__duplicate_name(self):
+        Counter("parsed_total", "Parsed", registry=self.registry)
+        with self.assertRaises(ValueError):
+            Counter("parsed_total", "Parsed", registry=self.registry)
+
+    def test_disabled__records_nothing(self):
+        counter = Counter("parsed_total", "Parsed", registry=self.registry)
+        histogram = Histogram("seconds", "Seconds", registry=self.registry)
+        record_metrics.enabled = False
+
+        counter.inc()
+        histogram.observe(1)
+        with histogram.time():
+            pass
+
+        self.assertEqual(counter.value(), 0)
+        self.assertEqual(histogram.count(), 0)
+
+    def test_record_lib__parse_and_sort_metrics(self):
+        def samples():
+            text = record_metrics.default_registry.render()
+            return dict(
+                line.rsplit(" ", 1) for line in text.splitlines() if line[0] != "#"
+            )
+
+        before = samples()
+        records = update_records([], ["Trate, Josh, Male, green, 08/14/1995"], ",")
+        with self.assertRaises(ValueError):
+            update_records([], ["Trate, Josh"], ",")
+        records_sorted_by_order(records, RecordSortOrder.LAST_NAME_DESCENDING)
+        after = samples()
+
+        for name, change in (
+            ("record_lib_records_parsed_total", 1),
+            ("record_lib_parse_errors_total", 1),
+            ("record_lib_parse_seconds_count", 2),
+            ('record_lib_sort_seconds_count{order="last_name_descending"}', 1),
+        ):
+            with self.subTest(name=name):
+                self.assertEqual(
+                    float(after[name]) - float(before.get(name, 0)), change
+                )
+
+    def test_profile__nested_stages_exclude_each_other(self):
+        profile = Profile()
+
+        def slow_records():
+            for _ in range(3):
+                time.sleep(0.01)
+                yield parse_date("08/14/1995")
+
+        with profile.stage("sort"):
+            records = sorted(profile.iterate("parse", slow_records()))
+            time.sleep(0.01)
+
+        self.assertEqual(len(records), 3)
+        self.assertEqual(profile.items["parse"], 3)
+        self.assertGreaterEqual(profile.seconds["parse"], 0.03)
+        self.assertGreaterEqual(profile.seconds["sort"], 0.01)
+        self.assertLess(profile.seconds["sort"], 0.03)
+        self.assertEqual(list(profile.seconds), ["parse", "sort"])
+
+        output = io.StringIO()
+        profile.write(output)
+        self.assertRegex(output.getvalue(), r"(?m)^parse .* 3 ")
+        self.assertRegex(output.getvalue(), r"(?m)^total ")
@@ -0,0 +1,215 @@
+import datetime
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import tracemalloc
+import urllib.request
+import uuid
+from multiprocessing import shared_memory
+from unittest import TestCase, skipUnless
+
+from record_lib import Gender, Record, RecordQuery, RecordSortOrder, RecordStore
+from record_shared import (
+    RecordPublisher,
+    SharedRecordStore,
+    apply_changes,
+    base_segment_name,
+    segment_name,
+)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+class TestRecordShared(TestCase):
+    records = [
+        Record("Trate", "Josh", Gender.MALE, "green", datetime.date(1995, 8, 14)),
+        Record("Smith", "Josh", Gender.MALE, "blue", datetime.date(1997, 9, 1)),
+        Record("Zwicki", "Allison", Gender.FEMALE, "brown", datetime.date(2001, 6, 5)),
+        Record("Smith", "David", Gender.MALE, "red", datetime.date(1995, 8, 14)),
+        Record("Ång\nström", "Zoë", Gender.FEMALE, "grün", datetime.date(1, 1, 1)),
+    ]
+
+    def setUp(self):
+        self.publisher = RecordPublisher(f"records-test-{uuid.uuid4().hex[:12]}")
+        self.addCleanup(self.publisher.close)
+
+    def start_writer(self, store: RecordStore) -> SharedRecordStore:
+        """Apply the changes of a shared store to store on a thread"""
+        self.publisher.publish(store.snapshot())
+        writer_end, worker_end = multiprocessing.Pipe()
+        writer = threading.Thread(
+            target=apply_changes, args=(store, self.publisher, [writer_end])
+        )
+        writer.start()
+        shared = SharedRecordStore(self.publisher.name, worker_end, store.identity)
+        self.addCleanup(writer.join)
+        self.addCleanup(shared.close)
+        return shared
+
+    def test_snapshot__matches_published_snapshot(self):
+        store = RecordStore(self.records, identity=("last_name", "first_name"))
+        # replacing a record leaves a gap in the sequence numbers
+        store.put(self.records[0]._replace(favorite_color="red"))
+        # and deleting the newest one leaves a gap after the last record
+        store.delete(("Ång\nström", "Zoë"))
+        shared = self.start_writer(store)
+
+        expected, snapshot = store.snapshot(), shared.snapshot()
+        self.assertEqual(snapshot.version, expected.version)
+        self.assertListEqual(list(snapshot.sequenced()), list(expected.sequenced()))
+        self.assertEqual(snapshot.next_sequence(), expected.next_sequence())
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                self.assertListEqual(
+                    snapshot.sorted_by(order), expected.sorted_by(order)
+                )
+                self.assertEqual(snapshot.page(order, 2), expected.page(order, 2))
+                self.assertEqual(snapshot.count(order), expected.count(order))
+        for query in (
+            RecordQuery(gender=Gender.MALE),
+            RecordQuery(favorite_color="red", born_before=datetime.date(2000, 1, 1)),
+            RecordQuery(favorite_color="teal"),
+        ):
+            with self.subTest(query=query):
+                self.assertEqual(snapshot.plan(query), expected.plan(query))
+                self.assertListEqual(snapshot.query(query), expected.query(query))
+        self.assertIs(shared.snapshot(), snapshot)
+
+    def test_snapshot__reads_only_returned_records(self):
+        records = [
+            record._replace(first_name=f"{record.first_name}{number}")
+            for number in range(4000)
+            for record in self.records
+        ]
+        shared = self.start_writer(RecordStore(records))
+
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        snapshot = shared.snapshot()
+        page, _ = snapshot.page(RecordSortOrder.DATE_OF_BIRTH_ASCENDING, 10, 10_000)
+        memory, _ = tracemalloc.get_traced_memory()
+
+        self.assertEqual(len(page), 10)
+        self.assertEqual(len(snapshot), len(records))
+        # nowhere near a copy of the records, which takes megabytes
+        self.assertLess(memory, 100_000)
+
+    def test_snapshot__reads_latest_version(self):
+        store = RecordStore(self.records[:2])
+        shared = self.start_writer(store)
+        self.assertEqual(len(shared), 2)
+        first_version = shared.version
+
+        store.extend(self.records[2:])
+        self.publisher.publish(store.snapshot())
+
+        self.assertListEqual(list(shared), self.records)
+        # the segment of the replaced version is gone
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(segment_name(self.publisher.name, first_version))
+
+    def test_publish__writes_changes_since_base(self):
+        store = RecordStore(self.records[:3], identity=("last_name", "first_name"))
+        shared = self.start_writer(store)
+        base_version = shared.version
+
+        shared.put(self.records[0]._replace(favorite_color="red"))
+        shared.delete(("Smith", "Josh"))
+        shared.extend(self.records[3:])
+
+        # the changes are laid over the base, which is not written again
+        self.assertEqual(self.publisher.version, store.version)
+        for version in range(base_version + 1, store.version + 1):
+            with self.assertRaises(FileNotFoundError):
+                shared_memory.SharedMemory(
+                    base_segment_name(self.publisher.name, version)
+                )
+        self.assertListEqual(list(shared), list(store))
+        expected = store.snapshot()
+        for order in RecordSortOrder:
+            self.assertListEqual(
+                shared.snapshot().sorted_by(order), expected.sorted_by(order)
+            )
+
+        # until there are enough changes to write a new base
+        shared.extend(
+            record._replace(first_name=f"{record.first_name}{number}")
+            for number in range(300)
+            for record in self.records
+        )
+        segment = shared_memory.SharedMemory(
+            base_segment_name(self.publisher.name, store.version)
+        )
+        segment.close()
+        self.assertListEqual(list(shared), list(store))
+
+    def test_changes__applied_by_writer(self):
+        store = RecordStore(identity=("last_name", "first_name"))
+        shared = self.start_writer(store)
+
+        shared.extend(self.records[:2])
+        shared.add(self.records[2])
+        replacement = self.records[0]._replace(favorite_color="red")
+        self.assertEqual(shared.put(replacement), self.records[0])
+        self.assertEqual(shared.upsert(self.records[3:]), [None, None])
+        self.assertEqual(shared.delete(("Smith", "Josh")), self.records[1])
+        self.assertIsNone(shared.delete(("Smith", "Josh")))
+
+        # every change is published by the time it returns
+        expected = [self.records[2], replacement, *self.records[3:]]
+        self.assertListEqual(list(shared), expected)
+        self.assertListEqual(list(store), expected)
+        self.assertEqual(shared.version, store.version)
+
+    def test_changes__writer_errors_are_raised(self):
+        shared = self.start_writer(RecordStore())
+        with self.assertRaises(ValueError):
+            shared.delete(("Trate", "Josh"))
+        shared.add(self.records[0])
+        self.assertListEqual(list(shared), self.records[:1])
+
+
+@skipUnless(hasattr(os, "fork"), "workers are forked")
+class TestServe(TestCase):
+    def test_serve__workers_share_records(self):
+        env = dict(os.environ, RECORD_SERVER_METRICS="0")
+        env.pop("RECORD_SERVER_DATA_DIR", None)
+        process = subprocess.Popen(
+            [sys.executable, "record_shared.py", "--workers", "2", "--port", "0"],
+            cwd=PROJECT_ROOT,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        self.addCleanup(process.wait, 10)
+        self.addCleanup(process.terminate)
+        self.addCleanup(process.stdout.close)
+        url = process.stdout.readline().split()[3]
+
+        for number in range(4):
+            request = urllib.request.Request(
+                f"{url}/records?return=record",
+                json.dumps(
+                    {
+                        "separator": ",",
+                        "record": f"Trate{number}, Josh, Male, red, 1/1/1999",
+                    }
+                ).encode(),
+                {"Content-Type": "application/json"},
+            )
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(response.status, 201)
+            # whichever worker answers has every record added so far
+            for _ in range(4):
+                with urllib.request.urlopen(f"{url}/records/name") as response:
+                    records = json.load(response)
+                    etag = response.headers["ETag"]
+                self.assertEqual(len(records), number + 1)
+                self.assertTrue(etag.endswith(f'-{number + 1}"'), etag)
+
+        process.terminate()
+        self.assertEqual(process.wait(10), 0)
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+import record_server
+from record_asgi import app
+from record_lib import RecordStore
+from record_server import app as flask_app
+
+
+def call(method, path, body=b"", headers=(), body_chunk_size=None):
+    """Send a request to the asgi app and return (status, headers, body)
+
+    The body is sent in chunks of body_chunk_size bytes, all at once by
+    default.
+    """
+    path, _, query_string = path.partition("?")
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "path": path,
+        "query_string": query_string.encode(),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers],
+    }
+    size = body_chunk_size or max(len(body), 1)
+    messages = [
+        {
+            "type": "http.request",
+            "body": body[start : start + size],
+            "more_body": start + size < len(body),
+        }
+        for start in range(0, max(len(body), 1), size)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start, *bodies = sent
+    headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    return start["status"], headers, b"".join(message["body"] for message in bodies)
+
+
+def post_json(path, value):
+    return call(
+        "POST",
+        path,
+        json.dumps(value).encode(),
+        headers=[("Content-Type", "application/json")],
+    )
+
+
+class TestRecordAsgi(unittest.TestCase):
+    def test_add_record__valid_payload(self):
+        status, _, body = post_json(
+            "/records?return=record",
+            {"separator": ",", "record": "Trate, Josh, Male, green, 08/14/1995"},
+        )
+
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(body)["last_name"], "Trate")
+
+    def test_add_record__invalid_json(self):
+        status, _, body = call(
+            "POST", "/records", b"hi", headers=[("Content-Type", "application/json")]
+        )
+
+        self.assertEqual(status, 400)
+        self.assertIn("message", json.loads(body))
+
+    def test_add_record__not_json_matches_flask(self):
+        line = b"Trate, Josh, Male, green, 08/14/1995"
+        status, headers, body = call(
+            "POST", "/records", line, headers=[("Content-Type", "text/plain")]
+        )
+        expected = flask_app.test_client().post(
+            "/records", data=line, content_type="text/plain"
+        )
+
+        self.assertEqual(status, 415)
+        self.assertEqual(status, expected.status_code)
+        self.assertEqual(headers["content-type"], expected.headers["Content-Type"])
+        self.assertEqual(body, expected.get_data())
+
+    def test_put_record__reads_the_current_store(self):
+        store = RecordStore(identity=("last_name", "first_name"))
+        record = {"separator": ",", "record": "Trate, Josh, Male, green, 08/14/1995"}
+        with mock.patch.object(record_server, "current_records", store):
+            status, _, _ = call(
+                "PUT",
+                "/records",
+                json.dumps(record).encode(),
+                headers=[("Content-Type", "application/json")],
+            )
+
+        self.assertEqual(status, 201)
+        self.assertEqual(len(store), 1)
+
+    def test_add_record__missing_separator(self):
+        status, _, _ = post_json(
+            "/records", {"record": "Trate, Josh, Male, green, 08/14/1995"}
+        )
+
+        self.assertEqual(status, 400)
+
+    def test_add_records_in_bulk__body_in_many_chunks(self):
+        status, _, body = call(
+            "POST",
+            "/records/bulk?separator=,",
+            json.dumps(
+                [
+                    "Trate, Josh, Male, green, 08/14/1995",
+                    "Trate, Josh, Male",
+                    "Smith, Anna, Female, gold, 01/02/1980",
+                ]
+            ).encode(),
+            headers=[("Content-Type", "application/json")],
+            body_chunk_size=3,
+        )
+
+        self.assertEqual(status, 201)
+        self.assertEqual(json.loads(body)["accepted"], 2)
+        self.assertEqual(json.loads(body)["errors"][0]["line"], 2)
+
+    def test_get_records__matches_flask(self):
+        post_json(
+            "/records",
+            {
+                "separator": "|",
+                "record": "Zwicki | Allison | Female | brown | 06/05/2001",
+            },
+        )
+        client = flask_app.test_client()
+        for path in ("/records/gender", "/records/birthdate", "/records/name?limit=1"):
+            with self.subTest(path=path):
+                status, headers, body = call("GET", path)
+                expected = client.get(path)
+                self.assertEqual(status, 200)
+                self.assertEqual(body, expected.get_data())
+                self.assertEqual(
+                    headers["x-total-count"], expected.headers["X-Total-Count"]
+                )
+
+    def test_get_records__not_modified(self):
+        _, headers, _ = call(
+            "GET", "/records/birthdate", headers=[("Accept", "application/x-ndjson")]
+        )
+
+        status, _, body = call(
+            "GET",
+            "/records/birthdate",
+            headers=[
+                ("Accept", "application/x-ndjson"),
+                ("If-None-Match", headers["etag"]),
+            ],
+        )
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+
+    def test_metrics(self):
+        call("GET", "/records/gender")
+
+        status, headers, body = call("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["content-type"].startswith("text/plain"))
+        self.assertIn(
+            b'record_server_request_seconds_count{route="/records/gender",'
+            b'method="GET",status="200"}',
+            body,
+        )
+
+    def test_delete_record__without_identity(self):
+        status, _, body = call("DELETE", "/records?last_name=Trate&first_name=Josh")
+
+        self.assertEqual(status, 400)
+        self.assertIn("message", json.loads(body))
+
+    def test_unknown_route(self):
+        self.assertEqual(call("GET", "/nothing")[0], 404)
+        self.assertEqual(call("DELETE", "/records/name")[0], 405)
@@ -1,6 +1,16 @@
 import datetime
-from unittest import TestCase
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from unittest import TestCase, mock
 
+import record_lib
 from record_lib import (
     Record,
     Gender,
@@ -9,7 +19,30 @@ from record_lib import (
     records_sorted_by_date_of_birth,
     records_sorted_by_last_name_descending,
     records_sorted_by_order,
+    RecordQuery,
+    RecordSnapshot,
     RecordSortOrder,
+    RecordStore,
+    RecordTable,
+    SortField,
+    decode_records,
+    deduplicated_rows,
+    encode_record,
+    external_sort,
+    file_ranges,
+    filter_records,
+    identity_getter,
+    iter_records,
+    iter_records_mapped,
+    iter_records_parallel,
+    parse_date,
+    parse_table,
+    read_table_mapped,
+    read_encoded_records,
+    range_field,
+    records_in_range,
+    records_sorted_by_spec,
+    records_top_k,
 )
 
 
@@ -81,12 +114,165 @@ class TestUpdateRecords(TestCase):
             update_records([], new_records, " "),
         )
 
+    def test_update_records__invalid_gender(self):
+        new_records = ["Trate Josh Other green 08/14/1995"]
+        with self.assertRaisesRegex(ValueError, "'Other' is not a valid Gender"):
+            update_records([], new_records, " ")
+
     def test_update_records__missing_fields(self):
         new_records = ["Trate Josh Male green"]
         with self.assertRaises(ValueError):
             update_records([], new_records, " ")
 
 
+class TestParseDate(TestCase):
+    def test_parse_date__fixed_format(self):
+        self.assertEqual(datetime.date(1995, 8, 14), parse_date("08/14/1995"))
+
+    def test_parse_date__unpadded(self):
+        self.assertEqual(datetime.date(1995, 8, 4), parse_date("8/4/1995"))
+
+    def test_parse_date__invalid_dates_match_strptime_errors(self):
+        for text in ("13/01/2000", "02/30/2000", "ab/cd/efgh", "08/14/95"):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError) as expected:
+                    datetime.datetime.strptime(text, "%m/%d/%Y")
+                with self.assertRaisesRegex(
+                    ValueError, re.escape(str(expected.exception))
+                ):
+                    parse_date(text)
+
+
+class TestIterRecords(TestCase):
+    def test_iter_records__small_chunks(self):
+        file = io.StringIO(
+            "Trate | Josh | Male | green | 08/14/1995\n"
+            "Zwicki | Allison | Female | brown | 06/05/2001\n"
+        )
+        self.assertListEqual(
+            [
+                Record(
+                    "Trate", "Josh", Gender.MALE, "green", datetime.date(1995, 8, 14)
+                ),
+                Record(
+                    "Zwicki",
+                    "Allison",
+                    Gender.FEMALE,
+                    "brown",
+                    datetime.date(2001, 6, 5),
+                ),
+            ],
+            list(iter_records(file, "|", chunk_size=1)),
+        )
+
+    def test_iter_records__empty_file(self):
+        self.assertListEqual([], list(iter_records(io.StringIO(""), ",")))
+
+    def test_iter_records__invalid_record_reports_line(self):
+        file = io.StringIO("Trate Josh Male green 08/14/1995\nTrate Josh Male\n")
+        with self.assertRaisesRegex(ValueError, "^line 2: "):
+            list(iter_records(file, " "))
+
+
+class TestIterRecordsMapped(TestCase):
+    def write(self, text):
+        file = tempfile.NamedTemporaryFile("wb", suffix=".txt", delete=False)
+        self.addCleanup(os.remove, file.name)
+        with file:
+            file.write(text.encode())
+        return file.name
+
+    def test_iter_records_mapped__same_as_iter_records(self):
+        texts = {
+            "lf": "Trate | Josh | Male | green | 08/14/1995\n" * 3,
+            "crlf and cr": "Trate|Josh|Male|green|08/14/1995\r\n"
+            "Smith|Anna|Female|blue|01/02/1980\r"
+            "Zwicki|Allison|Female|brown|06/05/2001",
+            "whitespace": "\tM\u00fcller\u00a0| Zo\u00eb |Female|  red\t| 1/2/1980 \n",
+        }
+        for name, text in texts.items():
+            file_name = self.write(text)
+            for chunk_size in (1, 40, 1 << 20):
+                with self.subTest(name=name, chunk_size=chunk_size):
+                    with open(file_name) as file:
+                        expected = list(iter_records(file, "|"))
+                    self.assertListEqual(
+                        expected, list(iter_records_mapped(file_name, "|", chunk_size))
+                    )
+                    self.assertListEqual(
+                        expected, list(read_table_mapped(file_name, "|", chunk_size))
+                    )
+
+    def test_iter_records_mapped__empty_file(self):
+        self.assertListEqual([], list(iter_records_mapped(self.write(""), ",")))
+
+    def test_iter_records_mapped__invalid_record_reports_line(self):
+        valid = "Trate Josh Male green 08/14/1995\n" * 2
+        for invalid in (
+            "\n",
+            "Trate Josh Other green 08/14/1995",
+            "a b c d 08/44/1995",
+        ):
+            file_name = self.write(valid + invalid)
+            for chunk_size in (1, 1 << 20):
+                with self.subTest(invalid=invalid, chunk_size=chunk_size):
+                    records = []
+                    with self.assertRaisesRegex(ValueError, "^line 3: "):
+                        for record in iter_records_mapped(file_name, " ", chunk_size):
+                            records.append(record)
+                    self.assertEqual(len(records), 2)
+                    with self.assertRaisesRegex(ValueError, "^line 3: "):
+                        read_table_mapped(file_name, " ", chunk_size)
+
+    def test_read_table_mapped__adds_to_table(self):
+        table = RecordTable()
+        for text in ("", "Trate Josh Male green 08/14/1995\n" * 2):
+            self.assertIs(table, read_table_mapped(self.write(text), " ", table=table))
+        self.assertEqual(len(table), 2)
+
+
+class TestIterRecordsParallel(TestCase):
+    lines = [
+        "Trate | Josh | Male | green | 08/14/1995\n",
+        "Zwicki | Allison | Female | brown | 06/05/2001\n",
+        "Smith | David | Male | red | 12/31/1999\n",
+    ] * 10
+
+    def setUp(self):
+        file = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+        self.addCleanup(os.remove, file.name)
+        self.file_name = file.name
+        with file:
+            file.writelines(self.lines)
+
+    def test_file_ranges__aligned_on_lines(self):
+        with open(self.file_name, "rb") as file:
+            data = file.read()
+        ranges = list(file_ranges(self.file_name, 50))
+        self.assertGreater(len(ranges), 1)
+        self.assertEqual(0, ranges[0][0])
+        self.assertEqual(len(data), ranges[-1][1])
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(b"\n"[0], data[end - 1])
+
+    def test_iter_records_parallel__same_as_iter_records(self):
+        with open(self.file_name) as file:
+            expected = list(iter_records(file, "|"))
+        with ProcessPoolExecutor(2) as executor:
+            records = list(
+                iter_records_parallel(self.file_name, "|", executor, chunk_size=50)
+            )
+        self.assertListEqual(expected, records)
+
+    def test_iter_records_parallel__invalid_record_reports_line(self):
+        with open(self.file_name, "a") as file:
+            file.write("Trate | Josh | Male\n")
+        with ProcessPoolExecutor(2) as executor:
+            with self.assertRaisesRegex(ValueError, f"^line {len(self.lines) + 1}: "):
+                list(iter_records_parallel(self.file_name, "|", executor, 50))
+
+
 class TestRecordsSorted(TestCase):
     def test_records_sorted_by_gender_and_last_name__multiple_records_unsorted(self):
         unsorted_records = [
@@ -216,3 +402,774 @@ class TestRecordsSorted(TestCase):
     def test_records_sorted_by_order__unknown_order(self):
         with self.assertRaises(ValueError):
             records_sorted_by_order([], "unknown")
+
+
+class TestRecordsSortedBySpec(TestCase):
+    records = [
+        Record("Smith", "Josh", Gender.MALE, "blue", datetime.date(1997, 9, 1)),
+        Record("Smithson", "Anna", Gender.FEMALE, "gold", datetime.date(1980, 1, 2)),
+        Record("Smith", "David", Gender.MALE, "red", datetime.date(1995, 8, 14)),
+        Record("Trate", "Josh", Gender.MALE, "green", datetime.date(1995, 8, 14)),
+        Record("Smith", "Anna", Gender.FEMALE, "gold", datetime.date(1980, 1, 2)),
+    ]
+
+    def test_records_sorted_by_spec__mixed_directions(self):
+        spec = (SortField("last_name", descending=True), SortField("first_name"))
+        self.assertListEqual(
+            [
+                self.records[3],
+                self.records[1],
+                self.records[4],
+                self.records[2],
+                self.records[0],
+            ],
+            records_sorted_by_spec(self.records, spec),
+        )
+
+    def test_records_sorted_by_spec__matches_multiple_stable_sorts(self):
+        spec = (
+            SortField("gender", descending=True),
+            SortField("date_of_birth"),
+            SortField("favorite_color", descending=True),
+        )
+        expected = sorted(
+            self.records, key=lambda record: record.favorite_color, reverse=True
+        )
+        expected.sort(key=lambda record: record.date_of_birth)
+        expected.sort(key=lambda record: record.gender, reverse=True)
+        self.assertListEqual(expected, records_sorted_by_spec(self.records, spec))
+
+        table = RecordTable(self.records)
+        self.assertListEqual(
+            expected, [table[row] for row in table.argsort_by_spec(spec)]
+        )
+
+    def test_records_sorted_by_spec__all_descending(self):
+        spec = (SortField("gender", descending=True), SortField("last_name", True))
+        self.assertListEqual(
+            [
+                self.records[3],
+                self.records[0],
+                self.records[2],
+                self.records[1],
+                self.records[4],
+            ],
+            records_sorted_by_spec(self.records, spec),
+        )
+
+    def test_records_sorted_by_spec__unknown_field(self):
+        with self.assertRaises(ValueError):
+            records_sorted_by_spec(self.records, (SortField("age"),))
+
+    def test_records_sorted_by_spec__empty_spec(self):
+        with self.assertRaises(ValueError):
+            records_sorted_by_spec(self.records, ())
+
+
+class TestRecordStore(TestCase):
+    records = [
+        Record("Trate", "Josh", Gender.MALE, "green", datetime.date(1995, 8, 14)),
+        Record("Smith", "Josh", Gender.MALE, "blue", datetime.date(1997, 9, 1)),
+        Record("Zwicki", "Allison", Gender.FEMALE, "brown", datetime.date(2001, 6, 5)),
+        Record("Smith", "David", Gender.MALE, "red", datetime.date(1995, 8, 14)),
+        Record("Smith", "Anna", Gender.FEMALE, "gold", datetime.date(1980, 1, 2)),
+    ]
+
+    def test_record_store__insertion_order(self):
+        store = RecordStore()
+        for record in self.records:
+            store.add(record)
+        self.assertEqual(len(store), len(self.records))
+        self.assertListEqual(list(store), self.records)
+
+    def test_record_store__sorted_by_matches_sorted_records(self):
+        store = RecordStore()
+        for record in self.records:
+            store.add(record)
+        for order in RecordSortOrder:
+            self.assertListEqual(
+                store.sorted_by(order), records_sorted_by_order(self.records, order)
+            )
+
+    def test_record_store__extend_large_batch(self):
+        records = self.records * 20
+        store = RecordStore(records[:3])
+        store.extend(records[3:])
+        for order in RecordSortOrder:
+            self.assertListEqual(
+                store.sorted_by(order), records_sorted_by_order(records, order)
+            )
+
+    def test_record_store__page_with_cursor(self):
+        store = RecordStore(self.records * 2)
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                records, cursor = store.page(order, limit=3)
+                pages = [records]
+                while cursor is not None:
+                    records, cursor = store.page(order, limit=3, cursor=cursor)
+                    pages.append(records)
+                self.assertListEqual([3, 3, 3, 1], [len(page) for page in pages])
+                self.assertListEqual(
+                    store.sorted_by(order), [r for page in pages for r in page]
+                )
+
+    def test_record_store__page_with_offset(self):
+        store = RecordStore(self.records)
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                records, cursor = store.page(order, limit=2, offset=2)
+                self.assertListEqual(store.sorted_by(order)[2:4], records)
+                self.assertListEqual(
+                    store.sorted_by(order)[4:], store.page(order, cursor=cursor)[0]
+                )
+
+    def test_record_store__page_past_end(self):
+        store = RecordStore(self.records)
+        self.assertEqual(
+            ([], None),
+            store.page(RecordSortOrder.LAST_NAME_DESCENDING, limit=2, offset=10),
+        )
+
+    def test_record_store__page_invalid_cursor(self):
+        store = RecordStore(self.records)
+        with self.assertRaises(ValueError):
+            store.page(RecordSortOrder.DATE_OF_BIRTH_ASCENDING, cursor=("a", 1))
+
+    def test_record_store__version_changes_with_records(self):
+        store = RecordStore()
+        version = store.version
+        store.extend([])
+        self.assertEqual(version, store.version)
+        store.add(self.records[0])
+        self.assertNotEqual(version, store.version)
+
+    def test_record_store__concurrent_writers_and_readers(self):
+        store = RecordStore()
+        writers = 8
+        batches = [
+            [
+                record._replace(first_name=f"{writer}-{number}")
+                for record in self.records
+            ]
+            for writer in range(writers)
+            for number in range(40)
+        ]
+        done = threading.Event()
+        problems = []
+
+        def write(writer):
+            for batch in batches[writer::writers]:
+                if len(batch) % 2:
+                    store.extend(batch)
+                else:
+                    for record in batch:
+                        store.add(record)
+
+        def read():
+            seen = 0
+            while not done.is_set():
+                snapshot = store.snapshot()
+                if len(snapshot) < seen:
+                    problems.append("snapshot shrank")
+                seen = len(snapshot)
+                for order in RecordSortOrder:
+                    records = snapshot.sorted_by(order)
+                    if records != records_sorted_by_order(list(snapshot), order):
+                        problems.append(f"{order} is out of order")
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(writers)]
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads + readers:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+
+        self.assertListEqual([], problems)
+        expected = Counter(record for batch in batches for record in batch)
+        self.assertEqual(expected, Counter(store))
+        for order in RecordSortOrder:
+            self.assertEqual(len(store), len(store.sorted_by(order)))
+
+    def test_record_store__empty(self):
+        self.assertListEqual(
+            RecordStore().sorted_by(RecordSortOrder.LAST_NAME_DESCENDING), []
+        )
+
+    def test_record_store__unknown_order(self):
+        with self.assertRaises(ValueError):
+            RecordStore().sorted_by("unknown")
+
+
+class TestRecordIdentity(TestCase):
+    records = TestRecordStore.records
+    identity = ("last_name", "first_name")
+
+    def assert_store_matches(self, store, records):
+        self.assertListEqual(list(store), records)
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                self.assertListEqual(
+                    store.sorted_by(order), records_sorted_by_order(records, order)
+                )
+        query = RecordQuery(gender=Gender.MALE, favorite_color="blue")
+        self.assertListEqual(store.query(query), list(filter_records(records, query)))
+
+    def test_deduplicated_rows__last_occurrence_wins(self):
+        moved = self.records[1]._replace(favorite_color="teal")
+        records = self.records + [moved, self.records[0]]
+        self.assertListEqual(deduplicated_rows(records, self.identity), [2, 3, 4, 5, 6])
+        self.assertListEqual(deduplicated_rows(records), list(range(len(records)))[2:])
+
+    def test_identity_getter__invalid_fields(self):
+        for fields in ((), ("last_name", "age")):
+            with self.subTest(fields=fields):
+                with self.assertRaises(ValueError):
+                    identity_getter(fields)
+
+    def test_record_store__put_get_and_delete(self):
+        store = RecordStore(identity=self.identity)
+        for record in self.records:
+            self.assertIsNone(store.put(record))
+        replacement = self.records[1]._replace(favorite_color="teal")
+
+        self.assertEqual(store.put(self.records[0]), self.records[0])
+        self.assertEqual(store.put(replacement), self.records[1])
+        self.assertEqual(store.get(("Smith", "Josh")), replacement)
+        self.assertEqual(store.delete(("Zwicki", "Allison")), self.records[2])
+        self.assertIsNone(store.delete(("Zwicki", "Allison")))
+        self.assertIsNone(store.get(("Zwicki", "Allison")))
+
+        # a replaced record moves to the end of the insertion order
+        self.assert_store_matches(
+            store, [self.records[0], *self.records[3:], replacement]
+        )
+
+    def test_record_store__extend_deduplicates(self):
+        replacement = self.records[0]._replace(favorite_color="teal")
+        store = RecordStore(self.records * 2, identity=self.identity)
+        store.extend([replacement, self.records[0], self.records[1]])
+        # Trate was replaced and replaced back so it moved to the end, the
+        # second Smith Josh was already there
+        self.assert_store_matches(store, self.records[1:] + self.records[:1])
+        self.assertEqual(
+            store.upsert([replacement, replacement]), [self.records[0], replacement]
+        )
+
+    def test_record_store__unchanged_version(self):
+        store = RecordStore(self.records, identity=self.identity)
+        version = store.version
+        store.put(self.records[0])
+        store.extend(self.records)
+        self.assertIsNone(store.delete(("Young", "Brigham")))
+        self.assertEqual(version, store.version)
+        store.delete(("Trate", "Josh"))
+        self.assertNotEqual(version, store.version)
+
+    def test_record_store__log_error_reaches_every_writer(self):
+        appending = threading.Event()
+
+        class FailingLog:
+            calls = 0
+
+            def append(self, records, snapshot, removed):
+                self.calls += 1
+                if self.calls > 1:
+                    raise OSError("No space left on device")
+                # holds the lock until both other writers are queued, so one
+                # of them applies the batch of both
+                appending.set()
+                while len(store._pending) < 2:
+                    time.sleep(0.001)
+
+        store = RecordStore(log=FailingLog(), identity=self.identity)
+        errors = {}
+
+        def write(name, call):
+            try:
+                call()
+            except OSError as error:
+                errors[name] = error
+
+        first = threading.Thread(
+            target=write, args=("first", lambda: store.add(self.records[0]))
+        )
+        first.start()
+        appending.wait()
+        threads = [
+            threading.Thread(
+                target=write, args=("extend", lambda: store.extend(self.records[1:]))
+            ),
+            threading.Thread(
+                target=write, args=("delete", lambda: store.delete(("Trate", "Josh")))
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in [first] + threads:
+            thread.join()
+
+        self.assertListEqual(sorted(errors), ["delete", "extend"])
+        self.assertEqual(str(errors["delete"]), "No space left on device")
+        self.assert_store_matches(store, self.records[:1])
+
+    def test_record_store__without_identity(self):
+        store = RecordStore(self.records)
+        for call in (
+            lambda: store.put(self.records[0]),
+            lambda: store.delete(("Trate", "Josh")),
+            lambda: store.get(("Trate", "Josh")),
+        ):
+            with self.assertRaises(ValueError):
+                call()
+
+    def assert_snapshot_matches(self, snapshot, expected):
+        self.assertEqual(len(snapshot), len(expected))
+        self.assertListEqual(list(snapshot.sequenced()), list(expected.sequenced()))
+        self.assertEqual(snapshot.next_sequence(), expected.next_sequence())
+        records = list(expected)
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                self.assertListEqual(
+                    snapshot.sorted_by(order), expected.sorted_by(order)
+                )
+                middle = getattr(records[len(records) // 2], range_field(order))
+                page, cursor = expected.page(order, 70, 3, None, middle)
+                self.assertEqual(
+                    snapshot.page(order, 70, 3, None, middle), (page, cursor)
+                )
+                self.assertEqual(
+                    snapshot.page(order, 5, 0, cursor),
+                    expected.page(order, 5, 0, cursor),
+                )
+                self.assertEqual(
+                    snapshot.count(order, middle), expected.count(order, middle)
+                )
+        for query in (
+            RecordQuery(gender=Gender.FEMALE),
+            RecordQuery(favorite_color="blue", born_after=datetime.date(1990, 1, 1)),
+            RecordQuery(favorite_color="teal"),
+            RecordQuery(favorite_color="mauve"),
+        ):
+            with self.subTest(query=query):
+                self.assertEqual(snapshot.plan(query), expected.plan(query))
+                self.assertListEqual(snapshot.query(query), expected.query(query))
+
+    def test_snapshot__from_columns(self):
+        records = [
+            record._replace(first_name=f"{record.first_name}{number}")
+            for number in range(30)
+            for record in self.records
+        ]
+        store = RecordStore(records, identity=self.identity)
+        for deleted in ((), records[::7]):
+            for record in deleted:
+                store.delete((record.last_name, record.first_name))
+            expected = store.snapshot()
+            file = io.BytesIO()
+            expected.write_columns(file)
+            snapshot, end = RecordSnapshot.from_columns(7, file.getvalue())
+
+            self.assertEqual(end, len(file.getvalue()))
+            self.assertEqual(snapshot.version, 7)
+            self.assert_snapshot_matches(snapshot, expected)
+
+        with self.assertRaises(ValueError):
+            RecordSnapshot.from_columns(0, file.getvalue()[:-1])
+
+    def test_snapshot__with_changes(self):
+        records = [
+            record._replace(first_name=f"{record.first_name}{number}")
+            for number in range(40)
+            for record in self.records
+        ]
+        store = RecordStore(records[:100], identity=self.identity)
+        base = store.snapshot()
+        file = io.BytesIO()
+        base.write_columns(file)
+        mapped, _ = RecordSnapshot.from_columns(base.version, file.getvalue())
+
+        for record in records[:100:9]:
+            store.delete((record.last_name, record.first_name))
+        # teal is a color no record of the base has
+        store.upsert(
+            [record._replace(favorite_color="teal") for record in records[50:60]]
+        )
+        store.extend(records[100:])
+        expected = store.snapshot()
+        changes = expected.changes_since(base)
+
+        for snapshot in (base, mapped):
+            changed = snapshot.with_changes(expected.version, changes)
+            self.assertEqual(changed.version, expected.version)
+            self.assert_snapshot_matches(changed, expected)
+        self.assertIsNone(expected.changes_since(base, 10))
+
+    def test_snapshot__from_columns_reads_only_returned_rows(self):
+        records = [
+            record._replace(first_name=f"{record.first_name}{number}")
+            for number in range(20_000)
+            for record in self.records[:3]
+        ]
+        file = io.BytesIO()
+        RecordStore(records).snapshot().write_columns(file)
+        snapshot, _ = RecordSnapshot.from_columns(0, file.getvalue())
+
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        page, _ = snapshot.page(RecordSortOrder.DATE_OF_BIRTH_ASCENDING, 100, 30_000)
+        _, peak = tracemalloc.get_traced_memory()
+
+        self.assertEqual(len(page), 100)
+        # a copy of a single column of the 60,000 rows takes 240,000 bytes
+        self.assertLess(peak, 100_000)
+
+    def test_snapshot__encoded_while_in_store(self):
+        encoded = []
+
+        def encode(record):
+            encoded.append(record)
+            return repr(record).encode()
+
+        store = RecordStore(self.records, identity=self.identity)
+        snapshot = store.snapshot()
+        for _ in range(2):
+            for record in snapshot:
+                self.assertEqual(
+                    snapshot.encoded(record, encode), repr(record).encode()
+                )
+        self.assertListEqual(encoded, self.records)
+
+        store.delete(("Trate", "Josh"))
+        encoded.clear()
+        # the deleted record's encoding is dropped, and an older snapshot no
+        # longer adds any
+        for _ in range(2):
+            snapshot.encoded(self.records[0], encode)
+            store.snapshot().encoded(self.records[1], encode)
+        self.assertListEqual(encoded, [self.records[0]] * 2)
+
+    def test_snapshot__encoded_from_columns(self):
+        def encode(record):
+            return ",".join(map(str, record)).encode()
+
+        store = RecordStore(self.records[:3], identity=self.identity)
+        base = store.snapshot()
+        file = io.BytesIO()
+        base.write_columns(file, encode)
+        mapped, _ = RecordSnapshot.from_columns(base.version, file.getvalue())
+        store.extend(self.records[3:])
+        latest = store.snapshot()
+        changed = mapped.with_changes(
+            latest.version, latest.changes_since(base, encode=encode)
+        )
+
+        def fail(record):
+            raise AssertionError(f"encoded {record} again")
+
+        for snapshot in (mapped, changed):
+            for record in snapshot:
+                self.assertEqual(
+                    snapshot.encoded(record, fail), ",".join(map(str, record)).encode()
+                )
+
+    def test_record_store__invalid_identity(self):
+        with self.assertRaises(ValueError):
+            RecordStore(identity=("last_name", "age"))
+        self.assertIsNone(RecordStore(identity=()).identity)
+
+
+class TestTopKAndRange(TestCase):
+    records = TestRecordStore.records * 3
+
+    def test_records_top_k__matches_sorted_prefix(self):
+        for order in RecordSortOrder:
+            for k in (0, 1, 4, 100):
+                with self.subTest(order=order, k=k):
+                    self.assertListEqual(
+                        records_top_k(self.records, order, k),
+                        records_sorted_by_order(self.records, order)[:k],
+                    )
+
+    def test_records_in_range__last_names(self):
+        order = RecordSortOrder.LAST_NAME_DESCENDING
+        selected = records_in_range(self.records, order, "Smith", "Zwicki")
+        self.assertListEqual(
+            selected,
+            [
+                record
+                for record in records_sorted_by_order(self.records, order)
+                if record.last_name in ("Smith", "Trate")
+            ],
+        )
+        self.assertListEqual(
+            records_in_range(self.records, order, "Smith", "Zwicki", k=2),
+            selected[:2],
+        )
+
+    def test_records_in_range__dates(self):
+        order = RecordSortOrder.DATE_OF_BIRTH_ASCENDING
+        self.assertListEqual(
+            records_in_range(self.records, order, high=datetime.date(1995, 8, 14)),
+            [self.records[4]] * 3,
+        )
+
+    def test_record_store__page_in_range(self):
+        store = RecordStore(self.records)
+        bounds = {
+            RecordSortOrder.GENDER_AND_LAST_NAME_ASCENDING: (Gender.MALE, None),
+            RecordSortOrder.DATE_OF_BIRTH_ASCENDING: (
+                datetime.date(1995, 8, 14),
+                datetime.date(2001, 6, 5),
+            ),
+            RecordSortOrder.LAST_NAME_DESCENDING: ("Smith", "Zwicki"),
+        }
+        for order, (low, high) in bounds.items():
+            with self.subTest(order=order):
+                expected = records_in_range(self.records, order, low, high)
+                self.assertEqual(
+                    store.snapshot().count(order, low, high), len(expected)
+                )
+                paged, cursor = store.page(order, 2, low=low, high=high)
+                while cursor is not None:
+                    page, cursor = store.page(order, 2, 0, cursor, low, high)
+                    paged.extend(page)
+                self.assertListEqual(paged, expected)
+
+    def test_records_top_k__unknown_order(self):
+        with self.assertRaises(ValueError):
+            records_top_k(self.records, "unknown", 1)
+
+
+class TestRecordQuery(TestCase):
+    records = TestRecordStore.records * 3 + [
+        Record("Young", "Brigham", Gender.MALE, "blue", datetime.date(1801, 6, 1))
+    ]
+
+    def test_record_store__query_matches_filter(self):
+        store = RecordStore(self.records)
+        dates = (None, datetime.date(1995, 8, 14), datetime.date(1999, 1, 1))
+        for gender in (None, *Gender):
+            for color in (None, "blue", "purple"):
+                for born_after in dates:
+                    for born_before in dates:
+                        query = RecordQuery(gender, color, born_after, born_before)
+                        with self.subTest(query=query):
+                            self.assertListEqual(
+                                store.query(query),
+                                list(filter_records(self.records, query)),
+                            )
+
+    def test_record_store__plan_uses_most_selective_index(self):
+        snapshot = RecordStore(self.records).snapshot()
+        self.assertEqual(
+            snapshot.plan(RecordQuery(Gender.MALE, "blue")), ("favorite_color", 4)
+        )
+        self.assertEqual(
+            snapshot.plan(
+                RecordQuery(Gender.FEMALE, born_before=datetime.date(1990, 1, 1))
+            ),
+            ("date_of_birth", 4),
+        )
+        self.assertEqual(snapshot.plan(RecordQuery()), (None, len(self.records)))
+
+
+class TestRecordTable(TestCase):
+    records = TestRecordStore.records * 3
+
+    def test_record_table__round_trip(self):
+        table = RecordTable(self.records)
+        self.assertEqual(len(self.records), len(table))
+        self.assertEqual(self.records[2], table[2])
+        self.assertListEqual(self.records, list(table))
+
+    def test_record_table__sorted_by_matches_sorted_records(self):
+        table = RecordTable(self.records)
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                self.assertListEqual(
+                    records_sorted_by_order(self.records, order),
+                    list(table.sorted_by(order)),
+                )
+
+    def test_record_table__empty(self):
+        self.assertListEqual(
+            [], list(RecordTable().sorted_by(RecordSortOrder.LAST_NAME_DESCENDING))
+        )
+
+    def test_record_table__unknown_order(self):
+        with self.assertRaises(ValueError):
+            RecordTable(self.records).argsort("unknown")
+
+    def test_record_table__take(self):
+        table = RecordTable(self.records)
+        many_rows = list(reversed(range(len(table)))) * 1000
+        for rows in ([], [2], [3, 0, 3], many_rows):
+            with self.subTest(rows=len(rows)):
+                self.assertListEqual(
+                    list(table.take(rows)), [self.records[row] for row in rows]
+                )
+
+    def test_record_table__distinct(self):
+        table = RecordTable(self.records)
+        for field in Record._fields:
+            with self.subTest(field=field):
+                self.assertCountEqual(
+                    {getattr(record, field) for record in self.records},
+                    table.distinct(field),
+                )
+        with self.assertRaises(ValueError):
+            table.distinct("age")
+
+    def test_record_table__write_and_read(self):
+        records = self.records + [
+            Record("Ångström", "Zoë", Gender.FEMALE, "grün", datetime.date(1, 1, 1))
+        ]
+        for table in (RecordTable(records), RecordTable()):
+            with self.subTest(rows=len(table)):
+                file = io.BytesIO(b"header")
+                file.seek(0, io.SEEK_END)
+                table.write(file)
+                restored, end = RecordTable.read(file.getvalue(), len(b"header"))
+                self.assertEqual(end, len(file.getvalue()))
+                self.assertListEqual(list(table), list(restored))
+                # the restored string columns can still be added to
+                restored.append(records[-1])
+                self.assertEqual(restored[len(table)], records[-1])
+
+    def test_record_table__read_truncated(self):
+        file = io.BytesIO()
+        RecordTable(self.records).write(file)
+        for size in (4, len(file.getvalue()) - 1):
+            with self.subTest(size=size):
+                with self.assertRaises(ValueError):
+                    RecordTable.read(file.getvalue()[:size])
+
+    def test_record_table__write_and_read_newline(self):
+        records = [
+            Record("Tr\nate", "", Gender.MALE, "\n", datetime.date(1995, 8, 14)),
+            Record("Trate", "Jo\nsh", Gender.MALE, "", datetime.date(1995, 8, 14)),
+        ]
+        file = io.BytesIO()
+        RecordTable(records).write(file)
+        restored, _ = RecordTable.read(file.getvalue())
+        self.assertListEqual(list(restored), records)
+
+
+class TestNumpyBackend(TestCase):
+    """Runs each test with the pure python backend and with numpy if installed"""
+
+    records = TestRecordsSortedBySpec.records * 3
+    lines = [
+        "Trate, Josh, Male, green, 08/14/1995",
+        "Smith, Zoë, Female, blue, 02/29/2000",
+        "Smith, David, Male, red, 12/31/0001",
+        "Young, Brigham, Male, blue, 01/01/9999",
+    ]
+
+    def run(self, result=None):
+        backends = [None]
+        if record_lib.numpy is not None:
+            backends.append(record_lib.numpy)
+        for numpy in backends:
+            with mock.patch.object(record_lib, "numpy", numpy), mock.patch.object(
+                record_lib, "NUMPY_SORT_MIN_RECORDS", 1
+            ):
+                super().run(result)
+
+    def test_records_sorted_by_order__matches_sorted(self):
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                key, reverse = record_lib.sort_key(record_lib.SORT_SPECS[order])
+                self.assertListEqual(
+                    sorted(self.records, key=key, reverse=reverse),
+                    records_sorted_by_order(self.records, order),
+                )
+                self.assertListEqual(
+                    records_sorted_by_order(self.records, order),
+                    list(RecordTable(self.records).sorted_by(order)),
+                )
+
+    def test_records_sorted_by_spec__mixed_directions(self):
+        spec = (
+            SortField("gender", descending=True),
+            SortField("date_of_birth"),
+            SortField("favorite_color", descending=True),
+            SortField("first_name"),
+        )
+        key, reverse = record_lib.sort_key(spec)
+        self.assertListEqual(
+            sorted(self.records, key=key, reverse=reverse),
+            records_sorted_by_spec(self.records, spec),
+        )
+
+    def test_parse_table__same_as_update_records(self):
+        lines = self.lines * 3
+        self.assertListEqual(
+            update_records([], lines, ","), list(parse_table(lines, ","))
+        )
+        self.assertEqual(len(parse_table([], ",")), 0)
+
+    def test_parse_table__dates_parse_date_accepts(self):
+        # not two digit months and days, or too long, so numpy leaves them to
+        # parse_date
+        lines = self.lines + ["Trate, Josh, Male, green, 8/4/1995"]
+        self.assertListEqual(
+            update_records([], lines, ","), list(parse_table(lines, ","))
+        )
+
+    def test_parse_table__invalid_lines(self):
+        for line in (
+            "Trate, Josh, Male, green, 02/29/2001",
+            "Trate, Josh, Male, green, 13/01/2001",
+            "Trate, Josh, Male, green, 01/01/0000",
+            "Trate, Josh, Male, green, 01/0a/2001",
+            "Trate, Josh, Other, green, 01/01/2001",
+            "Trate, Josh, Male, green",
+        ):
+            lines = self.lines + [line]
+            with self.subTest(line=line):
+                with self.assertRaises(ValueError) as expected:
+                    update_records([], lines, ",")
+                with self.assertRaisesRegex(
+                    ValueError, re.escape(str(expected.exception))
+                ):
+                    parse_table(lines, ",")
+
+
+class TestExternalSort(TestCase):
+    records = TestRecordStore.records * 7 + [
+        Record("Ångström", "Zoë", Gender.FEMALE, "grün", datetime.date(1, 1, 1))
+    ]
+
+    def test_encode_record__round_trip(self):
+        file = io.BytesIO(b"".join(encode_record(record) for record in self.records))
+        self.assertListEqual(self.records, list(read_encoded_records(file)))
+
+    def test_decode_records__from_buffer(self):
+        buffer = b"".join(encode_record(record) for record in self.records)
+        self.assertListEqual(self.records, decode_records(memoryview(buffer)))
+        with self.assertRaises(ValueError):
+            decode_records(buffer, 0, len(buffer) - 1)
+
+    def test_external_sort__spills_runs(self):
+        for order in RecordSortOrder:
+            with self.subTest(order=order):
+                self.assertListEqual(
+                    records_sorted_by_order(self.records, order),
+                    list(external_sort(self.records, order, memory_limit=1000)),
+                )
+
+    def test_external_sort__in_memory(self):
+        order = RecordSortOrder.GENDER_AND_LAST_NAME_ASCENDING
+        self.assertListEqual(
+            records_sorted_by_order(self.records, order),
+            list(external_sort(self.records, order, memory_limit=1 << 30)),
+        )
+
+    def test_external_sort__unknown_order(self):
+        with self.assertRaises(ValueError):
+            list(external_sort(self.records, "unknown", memory_limit=1000))
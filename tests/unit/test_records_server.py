@@ -1,7 +1,12 @@
 import json
 import unittest
+from unittest import mock
 
-from record_server import app
+from flask import jsonify
+
+import record_server
+from record_lib import RecordStore, parse_record
+from record_server import JsonArrayDecoder, app, record_json, serialize_records
 
 
 class TestRecordServer(unittest.TestCase):
@@ -99,3 +104,457 @@ class TestRecordServer(unittest.TestCase):
 
         resp = self.app.get("/records/name")
         self.assertEqual(resp.status_code, 200)
+
+    def test_add_record__return_created_record(self):
+        resp = self.app.post(
+            "/records?return=record",
+            data=json.dumps(
+                {
+                    "separator": "|",
+                    "record": "Zwicki | Allison | Female | brown | 06/05/2001",
+                }
+            ),
+            content_type="application/json",
+        )
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(
+            resp.get_json(),
+            {
+                "last_name": "Zwicki",
+                "first_name": "Allison",
+                "gender": "Female",
+                "favorite_color": "brown",
+                "date_of_birth": "06/05/2001",
+            },
+        )
+
+    def test_put_and_delete_record__by_identity(self):
+        store = RecordStore(identity=("last_name", "first_name"))
+        patcher = mock.patch.object(record_server, "current_records", store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def put(line):
+            return self.app.put("/records", json={"separator": ",", "record": line})
+
+        self.assertEqual(put("Trate, Josh, Male, green, 08/14/1995").status_code, 201)
+        resp = put("Trate, Josh, Male, teal, 08/14/1995")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()["favorite_color"], "teal")
+        resp = self.app.post(
+            "/records?return=record",
+            json={"separator": ",", "record": "Trate, Josh, Male, teal, 08/14/1995"},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(store), 1)
+        resp = self.app.post(
+            "/records/bulk?separator=,",
+            data="Trate, Josh, Male, red, 08/14/1995\nSmith, Anna, Female, gold, 01/02/1980\n",
+            content_type="text/plain",
+        )
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(
+            [
+                record["favorite_color"]
+                for record in self.app.get("/records/name").get_json()
+            ],
+            ["red", "gold"],
+        )
+
+        self.assertEqual(self.app.delete("/records?last_name=Trate").status_code, 400)
+        resp = self.app.delete("/records?last_name=Trate&first_name=Josh")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()["favorite_color"], "red")
+        resp = self.app.delete("/records?last_name=Trate&first_name=Josh")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(len(store), 1)
+
+    def test_put_and_delete_record__without_identity(self):
+        resp = self.app.put(
+            "/records",
+            json={"separator": ",", "record": "Trate, Josh, Male, green, 08/14/1995"},
+        )
+        self.assertEqual(resp.status_code, 400)
+        resp = self.app.delete("/records?last_name=Trate&first_name=Josh")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_add_records_in_bulk__json_array(self):
+        resp = self.app.post(
+            "/records/bulk?separator=,",
+            data=json.dumps(
+                [
+                    "Trate, Josh, Male, green, 08/14/1995",
+                    "Trate, Josh, Male",
+                    42,
+                    "Smith, Anna, Female, gold, 01/02/1980",
+                ]
+            ),
+            content_type="application/json",
+        )
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()["accepted"], 2)
+        self.assertEqual([error["line"] for error in resp.get_json()["errors"]], [2, 3])
+
+    def test_add_records_in_bulk__ndjson(self):
+        resp = self.app.post(
+            "/records/bulk?separator=|",
+            data='"Trate | Josh | Male | green | 08/14/1995"\n'
+            "not json\n"
+            "\n"
+            '"Smith | Anna | Female | gold | 01/02/1980"\n',
+            content_type="application/x-ndjson",
+        )
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()["accepted"], 2)
+        self.assertEqual([error["line"] for error in resp.get_json()["errors"]], [2])
+
+    def test_add_records_in_bulk__text(self):
+        resp = self.app.post(
+            "/records/bulk?separator=%20",
+            data="Trate Josh Male green 08/14/1995\nSmith Anna Female gold 13/02/1980\n",
+            content_type="text/plain",
+        )
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()["accepted"], 1)
+        self.assertEqual(resp.get_json()["errors"][0]["line"], 2)
+
+    def test_add_records_in_bulk__malformed_json(self):
+        resp = self.app.post(
+            "/records/bulk?separator=,",
+            data='["Trate, Josh, Male, green, 08/14/1995", oops]',
+            content_type="application/json",
+        )
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()["accepted"], 1)
+
+    def test_add_records_in_bulk__data_after_json_array(self):
+        resp = self.app.post(
+            "/records/bulk?separator=,",
+            data='["Trate, Josh, Male, green, 08/14/1995"] ["Smith, Anna"]',
+            content_type="application/json",
+        )
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json()["message"], "Unexpected data after json array")
+        self.assertEqual(resp.get_json()["accepted"], 1)
+
+    def test_add_records_in_bulk__missing_separator(self):
+        resp = self.app.post(
+            "/records/bulk",
+            data="Trate Josh Male green 08/14/1995\n",
+            content_type="text/plain",
+        )
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_records__paged_with_cursor(self):
+        for record in (
+            "Trate, Josh, Male, green, 08/14/1995",
+            "Smith, Anna, Female, gold, 01/02/1980",
+            "Zwicki, Allison, Female, brown, 06/05/2001",
+        ):
+            self.app.post(
+                "/records",
+                data=json.dumps({"separator": ",", "record": record}),
+                content_type="application/json",
+            )
+
+        for url in ("/records/gender", "/records/birthdate", "/records/name"):
+            with self.subTest(url=url):
+                everything = self.app.get(url).get_json()
+                resp = self.app.get(f"{url}?limit=2")
+                self.assertEqual(resp.headers["X-Total-Count"], str(len(everything)))
+                paged = resp.get_json()
+                while "X-Next-Cursor" in resp.headers:
+                    cursor = resp.headers["X-Next-Cursor"]
+                    resp = self.app.get(f"{url}?limit=2&cursor={cursor}")
+                    self.assertLessEqual(len(resp.get_json()), 2)
+                    paged.extend(resp.get_json())
+                self.assertEqual(everything, paged)
+
+    def test_get_records__limit_and_offset(self):
+        everything = self.app.get("/records/name").get_json()
+        resp = self.app.get("/records/name?limit=1&offset=1")
+        self.assertEqual(resp.get_json(), everything[1:2])
+
+    def test_get_records__invalid_paging(self):
+        for query in ("limit=-1", "offset=a", "cursor=nonsense"):
+            with self.subTest(query=query):
+                resp = self.app.get(f"/records/name?{query}")
+                self.assertEqual(resp.status_code, 400)
+
+    def test_get_records__cursor_for_other_order(self):
+        self.app.post(
+            "/records",
+            data=json.dumps(
+                {"separator": ",", "record": "Trate, Josh, Male, green, 08/14/1995"}
+            ),
+            content_type="application/json",
+        )
+        self.app.post(
+            "/records",
+            data=json.dumps(
+                {"separator": ",", "record": "Trate, Josh, Male, green, 08/14/1995"}
+            ),
+            content_type="application/json",
+        )
+        cursor = self.app.get("/records/name?limit=1").headers["X-Next-Cursor"]
+        resp = self.app.get(f"/records/birthdate?cursor={cursor}")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_records__ndjson(self):
+        self.app.post(
+            "/records",
+            data=json.dumps(
+                {"separator": ",", "record": "Trate, Josh, Male, green, 08/14/1995"}
+            ),
+            content_type="application/json",
+        )
+        everything = self.app.get("/records/birthdate").get_json()
+
+        resp = self.app.get(
+            "/records/birthdate", headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertEqual(
+            [json.loads(line) for line in resp.get_data(as_text=True).splitlines()],
+            everything,
+        )
+
+    def test_get_records__json_by_default(self):
+        resp = self.app.get("/records/gender", headers={"Accept": "*/*"})
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertIsInstance(resp.get_json(), list)
+
+    def test_get_records__cached_until_records_change(self):
+        # the body is only cached once it has been read
+        self.app.get("/records/name").get_data()
+        before = self.app.get("/cache/stats").get_json()
+        first = self.app.get("/records/name")
+        after = self.app.get("/cache/stats").get_json()
+        self.assertEqual(after["hits"], before["hits"] + 1)
+
+        self.app.post(
+            "/records",
+            data=json.dumps(
+                {"separator": ",", "record": "Aaron, Hank, Male, red, 02/05/1934"}
+            ),
+            content_type="application/json",
+        )
+        second = self.app.get("/records/name")
+        self.assertEqual(
+            self.app.get("/cache/stats").get_json()["misses"], after["misses"] + 1
+        )
+        self.assertEqual(second.get_json(), first.get_json() + [second.get_json()[-1]])
+
+    def test_get_records__not_modified(self):
+        etag = self.app.get("/records/birthdate").headers["ETag"]
+
+        resp = self.app.get("/records/birthdate", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+
+        self.app.post(
+            "/records",
+            data=json.dumps(
+                {"separator": ",", "record": "Trate, Josh, Male, green, 08/14/1995"}
+            ),
+            content_type="application/json",
+        )
+        resp = self.app.get("/records/birthdate", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_get_records__etag_per_page(self):
+        for record in (
+            "Trate, Josh, Male, green, 08/14/1995",
+            "Smith, Anna, Female, gold, 01/02/1980",
+        ):
+            self.app.post(
+                "/records",
+                data=json.dumps({"separator": ",", "record": record}),
+                content_type="application/json",
+            )
+        etags = {}
+        for query in ("", "limit=1", "limit=1&offset=1", "from=S", "from=S&to=T"):
+            etag = self.app.get(f"/records/name?{query}").headers["ETag"]
+            resp = self.app.get(
+                f"/records/name?{query}", headers={"If-None-Match": etag}
+            )
+            self.assertEqual(resp.status_code, 304)
+            etags[query] = etag
+        self.assertEqual(len(set(etags.values())), len(etags))
+
+        # parameters selecting the same records share the etag
+        resp = self.app.get(
+            "/records/name?top=1&offset=0", headers={"If-None-Match": etags["limit=1"]}
+        )
+        self.assertEqual(resp.status_code, 304)
+        resp = self.app.get(
+            "/records/name?limit=1",
+            headers={"If-None-Match": etags["limit=1&offset=1"]},
+        )
+        self.assertEqual(resp.status_code, 200)
+
+    def test_get_records__top_and_range(self):
+        for record in (
+            "Trate, Josh, Male, green, 08/14/1995",
+            "Smith, Anna, Female, gold, 01/02/1980",
+            "Zwicki, Allison, Female, brown, 06/05/2001",
+        ):
+            self.app.post(
+                "/records",
+                data=json.dumps({"separator": ",", "record": record}),
+                content_type="application/json",
+            )
+
+        everything = self.app.get("/records/birthdate").get_json()
+        self.assertEqual(
+            self.app.get("/records/birthdate?top=2").get_json(), everything[:2]
+        )
+
+        resp = self.app.get("/records/name?from=Smith&to=Zwicki")
+        self.assertEqual(
+            {record["last_name"] for record in resp.get_json()}, {"Smith", "Trate"}
+        )
+        self.assertEqual(resp.headers["X-Total-Count"], str(len(resp.get_json())))
+
+        resp = self.app.get("/records/birthdate?from=01/01/2001")
+        self.assertTrue(
+            all(record["date_of_birth"].endswith("2001") for record in resp.get_json())
+        )
+        resp = self.app.get("/records/gender?from=Male")
+        self.assertTrue(all(record["gender"] == "Male" for record in resp.get_json()))
+
+    def test_get_records__invalid_range(self):
+        for query in ("from=13/01/2000", "top=2&limit=2"):
+            with self.subTest(query=query):
+                resp = self.app.get(f"/records/birthdate?{query}")
+                self.assertEqual(resp.status_code, 400)
+
+    def test_query_records(self):
+        for record in (
+            "Trate, Josh, Male, green, 08/14/1995",
+            "Smith, Anna, Female, green, 01/02/1980",
+            "Zwicki, Allison, Female, brown, 06/05/2001",
+        ):
+            self.app.post(
+                "/records",
+                data=json.dumps({"separator": ",", "record": record}),
+                content_type="application/json",
+            )
+
+        resp = self.app.get(
+            "/records/query?color=green&gender=Female&born_before=01/01/1990"
+            "&order=last_name_descending"
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.get_json())
+        self.assertTrue(
+            all(
+                record["favorite_color"] == "green" and record["gender"] == "Female"
+                for record in resp.get_json()
+            )
+        )
+        self.assertEqual(resp.headers["X-Total-Count"], str(len(resp.get_json())))
+
+    def test_query_records__invalid(self):
+        for query in ("gender=Other", "born_after=yesterday", "order=shuffled"):
+            with self.subTest(query=query):
+                resp = self.app.get(f"/records/query?{query}")
+                self.assertEqual(resp.status_code, 400)
+
+    def test_record_json__matches_jsonify(self):
+        for line in (
+            "Trate, Josh, Male, green, 08/14/1995",
+            "M\u00fcller, J\u00fcrgen, Male, gr\u00fcn, 01/02/1980",
+            'Tab\tbed, Quo"te, Female, back\\slash, 03/04/1970',
+            "Del\x7f, Zo\u00eb, Female, \U0001f600, 05/06/2001",
+        ):
+            record = parse_record(line, ",")
+            with self.subTest(line=line), app.app_context():
+                self.assertEqual(
+                    b"[" + record_json(record) + b"]\n",
+                    jsonify([record.to_dict()]).get_data(),
+                )
+
+    def test_record_json__without_orjson(self):
+        record = parse_record("M\u00fcller, Josh, Male, green, 08/14/1995", ",")
+        expected = record_json(record)
+        orjson = record_server.orjson
+        record_server.orjson = None
+        try:
+            self.assertEqual(record_json(record), expected)
+        finally:
+            record_server.orjson = orjson
+
+    def test_serialize_records__matches_jsonify(self):
+        records = [
+            parse_record("Trate, Josh, Male, green, 08/14/1995", ","),
+            parse_record("Smith, Zo\u00eb, Female, blue, 01/02/1980", ","),
+        ]
+        body = b"".join(serialize_records(records, "application/json"))
+        with app.app_context():
+            expected = jsonify([record.to_dict() for record in records]).get_data()
+        self.assertEqual(body, expected)
+        self.assertEqual(b"".join(serialize_records([], "application/json")), b"[]\n")
+
+    def test_metrics(self):
+        self.app.post(
+            "/records",
+            data=json.dumps({"separator": ",", "record": "Trate, Josh"}),
+            content_type="application/json",
+            buffered=True,
+        )
+        self.app.get("/records/name", buffered=True)
+
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "text/plain")
+        text = resp.get_data(as_text=True)
+        self.assertRegex(text, r"(?m)^record_server_parse_errors_total [1-9]")
+        self.assertRegex(text, r"(?m)^record_server_store_records \d+$")
+        self.assertIn(
+            'record_server_request_seconds_count{route="/records/name",'
+            'method="GET",status="200"}',
+            text,
+        )
+
+
+class TestJsonArrayDecoder(unittest.TestCase):
+    def test_feed__items_cut_off_anywhere(self):
+        body = '[ "Trate, Jo\\u00e9", true, null, -1.5, {"a": ["b"]}, "\\"x\\"" ]'
+        for size in (1, 2, 3, 5):
+            with self.subTest(size=size):
+                decoder = JsonArrayDecoder()
+                items = []
+                for start in range(0, len(body), size):
+                    items.extend(decoder.feed(body[start : start + size].encode()))
+                items.extend(decoder.feed(b"", final=True))
+                self.assertEqual([item for _, item in items], json.loads(body))
+
+    def test_feed__malformed_item_fails_before_the_end(self):
+        decoder = JsonArrayDecoder()
+        self.assertEqual(list(decoder.feed(b'["Trate, Josh", ')), [(1, "Trate, Josh")])
+        # the rest of the body is never read
+        with self.assertRaises(ValueError):
+            list(decoder.feed(b'oops, "Smith, Anna"' + b', "x"' * 10000))
+
+    def test_feed__data_after_the_array(self):
+        for rest in (b"]", b' "x"', b"[]"):
+            with self.subTest(rest=rest):
+                decoder = JsonArrayDecoder()
+                self.assertEqual(list(decoder.feed(b'["x"] \n')), [(1, "x")])
+                with self.assertRaisesRegex(
+                    ValueError, "^Unexpected data after json array$"
+                ):
+                    list(decoder.feed(rest, final=True))
+
+        decoder = JsonArrayDecoder()
+        self.assertEqual(list(decoder.feed(b"[] ")), [])
+        self.assertEqual(list(decoder.feed(b"\r\n", final=True)), [])